@@ -6,6 +6,7 @@ All contained processes get used in the modeling pipeline.
 """
 
 import os
+import copy
 import pickle
 import datetime
 import pandas as pd
@@ -15,36 +16,16 @@ from sklearn.ensemble import GradientBoostingClassifier
 from sklearn.model_selection import train_test_split
 from collections import defaultdict
 
-# Use all the features from the original dataset (note typo in 'average_montly_hours')
-FEATURES = [
-    'satisfaction_level',
-    'last_evaluation',
-    'number_project',
-    'average_montly_hours',
-    'time_spend_company',
-    'Work_accident',
-    'promotion_last_5years',
-    'department', 'salary'
-]
-
-DEPARTMENT_OPTIONS = [
-    'IT',
-    'RandD',
-    'accounting',
-    'hr',
-    'management',
-    'marketing',
-    'product_mng',
-    'sales',
-    'support',
-    'technical']
-
-SALARY_OPTIONS = ['high', 'low', 'medium']
-
-# sklearn doesn't handle categorical features automatically, so we need to change them to columns of integer values.
-NONNUMERIC_COLUMNS = ['department', 'salary']
+import config
+import drift
+import inference_client
+import metrics
+import prediction_cache
+from model_registry import registry
+from schema import DEPARTMENT_OPTIONS, FEATURES, NONNUMERIC_COLUMNS, SALARY_OPTIONS, TRAINER_BACKENDS
 
 
+@metrics.timed('proc_df')
 def proc_df(df, d=None):
     """
     Pre-process data frame, applying label encoding.
@@ -62,32 +43,143 @@ def proc_df(df, d=None):
     return df, d
 
 
-def train_model(train_df, n_est=100, seed=1234):
+def make_classifier(backend, n_est=100, seed=1234, n_jobs=None, params=None):
     """
-    This example uses Gradient Boosted Decision Trees from scikit-learn
+    Set up an untrained gradient boosted trees classifier from one of the supported libraries.
+
+    :param backend: One of TRAINER_BACKENDS
+    :param n_est: Number of estimators to use
+    :param seed: Random seed for reporducible results
+    :param n_jobs: Number of threads used by xgboost. Will use config.TRAINER_N_JOBS if not provided.
+    :param params: Parameters of the classifier to override, e.g. as found by tuning.search
+    :return: Classifier with a scikit-learn interface
+    """
+    if params:
+        return make_classifier(backend, n_est, seed, n_jobs).set_params(**params)
+
+    if backend == 'gbc':
+        return GradientBoostingClassifier(n_estimators=n_est, random_state=seed)
+
+    if backend == 'hist':
+        try:
+            from sklearn.ensemble import HistGradientBoostingClassifier
+        except ImportError:
+            # scikit-learn before 1.0, where histogram gradient boosting was experimental
+            from sklearn.experimental import enable_hist_gradient_boosting  # noqa: F401
+            from sklearn.ensemble import HistGradientBoostingClassifier
+        return HistGradientBoostingClassifier(max_iter=n_est, early_stopping=False, random_state=seed)
+
+    if backend == 'xgboost':
+        from xgboost import XGBClassifier
+        return XGBClassifier(n_estimators=n_est, tree_method='hist', random_state=seed,
+                             n_jobs=config.TRAINER_N_JOBS if n_jobs is None else n_jobs)
+
+    raise ValueError("Unknown trainer backend '{}', expected one of {}".format(backend, TRAINER_BACKENDS))
+
+
+def backend_of(GB):
+    """
+    :param GB: Trained model
+    :return: Name of the backend that the model was trained with
+    """
+    name = type(GB).__name__
+    if name == 'HistGradientBoostingClassifier':
+        return 'hist'
+    if name == 'XGBClassifier':
+        return 'xgboost'
+    return 'gbc'
+
+
+def n_trees(GB):
+    """
+    :param GB: Trained model
+    :return: Number of boosting rounds in the model
+    """
+    backend = backend_of(GB)
+    if backend == 'hist':
+        return GB.n_iter_
+    if backend == 'xgboost':
+        return len(GB.get_booster().get_dump())
+    return len(GB.estimators_)
+
+
+@metrics.timed('train_model')
+def train_model(train_df, n_est=100, seed=1234, monitor=None, backend=None, params=None):
+    """
+    This example uses Gradient Boosted Decision Trees from scikit-learn by default
 
     :param train_df: training data frame for the model
     :param n_est: Number of estimators to use
     :param seed: Random seed for reporducible results
+    :param monitor: Called after each tree is fit with the tree index, the model and its locals, e.g. to report
+        progress. Only supported by the 'gbc' backend.
+    :param backend: One of TRAINER_BACKENDS. Will use config.TRAINER_BACKEND if not provided.
+    :param params: Parameters of the classifier to override, e.g. as found by tuning.search
     :return: Trained model
     """
-    GB = GradientBoostingClassifier(n_estimators=n_est,
-                                    random_state=seed
-                                    ).fit(train_df[FEATURES], train_df['left'])
+    backend = backend or config.TRAINER_BACKEND
+    GB = make_classifier(backend, n_est, seed, params=params)
+    fit_params = {'monitor': monitor} if backend == 'gbc' and monitor is not None else {}
+    GB.fit(train_df[FEATURES], train_df['left'], **fit_params)
     return GB
 
 
+def continue_training(GB, train_df, n_extra, monitor=None):
+    """
+    Add trees to a trained model, fit only on the given (new) data. Each new tree is fit to the residuals of the
+    existing ensemble, so the model picks up what changed without revisiting the data it was already trained on.
+
+    :param GB: Trained model, which is left untouched
+    :param train_df: New training data, already label encoded with the encodings of the model
+    :param n_extra: Number of estimators to add
+    :param monitor: Called after each tree is fit, as in train_model
+    :return: New model with n_extra more estimators
+    """
+    X, y = train_df[FEATURES], train_df['left']
+    backend = backend_of(GB)
+
+    if backend == 'xgboost':
+        # xgboost continues from the booster of the previous model rather than warm starting in place
+        extra = copy.deepcopy(GB)
+        extra.set_params(n_estimators=n_extra)
+        return extra.fit(X, y, xgb_model=GB.get_booster())
+
+    GB = copy.deepcopy(GB)
+    if backend == 'hist':
+        GB.set_params(warm_start=True, max_iter=GB.n_iter_ + n_extra)
+        GB.fit(X, y)
+    else:
+        GB.set_params(warm_start=True, n_estimators=GB.n_estimators + n_extra)
+        GB.fit(X, y, monitor=monitor)
+    GB.set_params(warm_start=False)
+    return GB
+
+
+def save_model(GB, d, metadata=None):
+    """
+    Publish a trained model and its encodings as a single bundle, which then gets picked up for predictions.
+
+    :param GB: Trained model
+    :param d: Lookup table for label encoding, used to train the model
+    :param metadata: Dictionary to save alongside the model, e.g. the range of employee IDs it was trained on
+    :return: Version of the saved model, i.e. its time stamp
+    """
+    return registry.publish(GB, d, FEATURES, metadata)
+
+
 def dump_pickle(object, out_path):
     """
-    Dump an object into a pickle serialization for later use
+    Dump an object into a pickle serialization for later use. The file is written under a temporary name and then
+    renamed, so that readers never pick up a partially written artifact.
 
     :param object: Object that we wish to serialize
     :param out_path: Where to write object out to
     :return: None
     """
-    output = open(out_path, 'wb')
-    pickle.dump(object, output)
-    output.close()
+    tmp_path = out_path + '.tmp'
+    with open(tmp_path, 'wb') as output:
+        pickle.dump(object, output)
+    os.replace(tmp_path, out_path)
 
 
 def df_new_emp(satisfaction_level, last_evaluation, number_project,
@@ -117,35 +209,109 @@ def df_new_emp(satisfaction_level, last_evaluation, number_project,
     return test_df
 
 
+@metrics.timed('most_recent_model')
 def most_recent_model():
     """
-    Get most recently trained model and encodings for use in model predictions
+    Get most recently trained model and encodings for use in model predictions. These are held in memory by the
+    model registry, and only reloaded from disk when a new model has been published.
+
     :return: Model and encodings
     """
-    GB_path = max([m.split("_", 1)[1] for m in os.listdir("models")])
-    le_path = max([m.split("_", 1)[1] for m in os.listdir("encodings")])
-
-    d = pickle.load(open('encodings/le_{}'.format(le_path), "rb"))
-    GB = pickle.load(open('models/GB_{}'.format(GB_path), "rb"))
+    _, GB, d = registry.get()
     return GB, d
 
 
+@metrics.timed('predict_employee_churn')
 def predict_employee_churn(test_df):
     """
-    When given the information about an employee, predict whether or not they will churn and return related info
+    When given the information about an employee, predict whether or not they will churn and return related info.
+    Predictions are cached by model version and feature values, so a repeated lookup doesn't score the employee again.
 
     :param test_df:
     :return:
     """
-    GB, d = most_recent_model()
-    test_df, _ = proc_df(test_df, d)
-    pred = GB.predict(test_df)[0]
-    proba = GB.predict_proba(test_df)[0][pred]
+    features = test_df[FEATURES].values.tolist()[0]
+    if inference_client.client is not None:
+        # scoring is handed off to the inference server, so don't load the model in this process
+        version = registry.current_version()
+    else:
+        version, GB, d, compiled = registry.compiled()
+    cached = prediction_cache.get_prediction(version, features)
+    if cached is not None:
+        pred, proba = cached
+        return pred, proba, test_df
+
+    if inference_client.client is not None:
+        try:
+            result = inference_client.client.predict([features])
+            pred, churn = result['prediction'][0], result['churn_probability'][0]
+            proba = round(churn if pred else 1 - churn, 4)
+            prediction_cache.set_prediction(result['version'], features, pred, proba)
+            drift.monitor.observe('scored', [features], [churn], result['version'])
+            return pred, proba, test_df
+        except OSError:
+            # the server can't be reached, or didn't score the employee in time, so score here rather than fail the
+            # request
+            version, GB, d, compiled = registry.compiled()
+
+    if compiled is not None:
+        proba = compiled.predict_proba(compiled.encode([features]))[0]
+        pred, proba = bool(compiled.classes[proba.argmax()]), round(float(proba.max()), 4)
+    else:
+        test_df, _ = proc_df(test_df, d)
+        pred = GB.predict(test_df)[0]
+        proba = GB.predict_proba(test_df)[0][pred]
+        pred, proba = bool(pred), round(proba, 4)
 
-    # recomstruct original info
-    test_df[NONNUMERIC_COLUMNS] = test_df[NONNUMERIC_COLUMNS].apply(lambda x: d[x.name].inverse_transform(x))
+        # recomstruct original info
+        test_df[NONNUMERIC_COLUMNS] = test_df[NONNUMERIC_COLUMNS].apply(lambda x: d[x.name].inverse_transform(x))
 
-    return bool(pred), round(proba, 4), test_df
+    prediction_cache.set_prediction(version, features, pred, proba)
+    drift.monitor.observe('scored', [features], [proba if pred else 1 - proba], version)
+    return pred, proba, test_df
+
+
+def predict_employee_churn_batch(test_df, GB=None, d=None, version=None):
+    """
+    Predict churn for many employees at once. All rows are encoded in one step and scored with a single call to
+    predict_proba, with the hard prediction derived from the class probabilities.
+
+    :param test_df: Data frame holding the model features for each employee, and optionally their Emp_ID
+    :param GB: Model to score with. Will use most recent model if not provided.
+    :param d: Lookup table for label encoding, matching the model
+    :param version: Version of the model, whose reference the scores are counted against for drift. Should be given
+        along with GB, as a newer model may have been published since it was fetched.
+    :return: Data frame of Emp_ID (if given), prediction, probability of the prediction, and probability of churn
+    """
+    if GB is None:
+        version, GB, d = registry.get()
+
+    features, _ = proc_df(test_df[FEATURES].copy(), d)
+    probas = np.asarray(GB.predict_proba(features), dtype=np.float64)
+    best = np.argmax(probas, axis=1)
+
+    results = pd.DataFrame(index=test_df.index)
+    if 'Emp_ID' in test_df.columns:
+        results['Emp_ID'] = test_df['Emp_ID']
+    results['prediction'] = GB.classes_.take(best).astype(bool)
+    results['probability'] = probas[np.arange(len(best)), best].round(4)
+    results['churn_probability'] = probas[:, list(GB.classes_).index(1)].round(4)
+    drift.monitor.observe('scored', test_df, results['churn_probability'].values, version)
+    return results
+
+
+def iter_churn_predictions(frames):
+    """
+    Score a stream of employee data frames chunk by chunk, so that memory use stays flat regardless of how many
+    employees are scored. The model is fetched once, so every chunk is scored by the same version.
+
+    :param frames: Iterable of data frames, as accepted by predict_employee_churn_batch
+    :return: Generator of prediction data frames, one per input chunk
+    """
+    version, GB, d = registry.get()
+    for frame in frames:
+        if len(frame):
+            yield predict_employee_churn_batch(frame, GB, d, version)
 
 
 def df_row_to_dict(df):
@@ -164,9 +330,6 @@ def df_row_to_dict(df):
 
 if __name__ == "__main__":
 
-    # Grab time stamp
-    now = str(datetime.datetime.now()).replace(" ", "_")
-
     # Load the train and test data frames, as provided in the challenge zip file
     train_df = pd.read_csv('data/train.csv', header=0)
     test_df = pd.read_csv('data/test.csv', header=0)
@@ -176,16 +339,14 @@ if __name__ == "__main__":
     GB = train_model(train_df=train_df)
 
     # Run model on test data set - it gets a precision of 0.97 and recall of 0.93
-    predictions = GB.predict(test_df[FEATURES])
     test_score = GB.score(test_df[FEATURES], test_df['left'])
     print("Score: ", test_score)
 
-    dump_pickle(d, 'encodings/le_{}.pkl'.format(now))
-    dump_pickle(GB, 'models/GB_{}.pkl'.format(now))
+    version = save_model(GB, d)
 
-    # Change categoricals back to original values
-    test_df[NONNUMERIC_COLUMNS] = test_df[NONNUMERIC_COLUMNS].apply(lambda x: d[x.name].inverse_transform(x))
-    test_df['Prediction'] = pd.Series(predictions, index=test_df.index)
+    # Submit final predictions on test data set, read, scored and written out a chunk at a time
+    from database_operations import iter_csv_frames
+    from export import export_predictions
 
-    # Submit final predictions on test data set
-    test_df.to_csv("predictions/submission_GB.csv", index=False)
+    with open("predictions/submission_GB.csv", 'wb') as f:
+        export_predictions(f, iter_csv_frames('data/test.csv'), 'csv', GB=GB, d=d, version=version)
@@ -0,0 +1,217 @@
+"""
+Versioned JSON API, for other services to score employees without going through the HTML forms:
+    POST /api/v1/predict             Score an employee, given {"emp_id": ...} or {"employee": {<feature>: ...}}
+    GET  /api/v1/employees/<emp_id>  An employee's features and churn score
+    GET  /api/v1/scores              Employees most likely to leave, optionally ?department=...&n=...
+
+The API is served by aiohttp, alongside the gunicorn workers serving the HTML pages, and a single event loop handles
+every client. Database lookups run on a thread pool the size of the connection pool, since SQLAlchemy blocks, and
+scoring runs on a pool of processes, each holding the model, so neither holds up the loop. Employees are looked up
+and scored through scoring.py, as on the prediction page, so the API gives the same probabilities.
+
+Run as main method:
+    $ python api.py --port 8081
+"""
+
+import argparse
+import asyncio
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from aiohttp import web
+
+import config
+import database_operations
+from HRmodel import predict_employee_churn
+from churn_scores import score_coverage, top_at_risk
+from model_registry import registry
+from schema import DEPARTMENT_OPTIONS, FEATURES
+from scoring import lookup_employee, new_employee_df
+
+
+routes = web.RouteTableDef()
+
+# Most employees returned by /api/v1/scores
+MAX_SCORES = 1000
+
+
+def _to_python(value):
+    # NumPy scalars, as found in data frames, know how to turn themselves into plain Python values
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+json_response = partial(web.json_response, dumps=partial(json.dumps, default=_to_python))
+
+
+def error(status, message):
+    return json_response({'error': message}, status=status)
+
+
+async def run_query(request, func, *args):
+    """
+    Run a function that uses the database on the database thread pool.
+
+    :return: Result of the function
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(request.app['db_executor'], partial(_in_session, func, *args))
+
+
+def _in_session(func, *args):
+    # give the thread's connection back to the pool once done, as the request teardown does for the HTML pages
+    try:
+        return func(*args)
+    finally:
+        database_operations.remove_session()
+
+
+async def run_scoring(request, func, *args):
+    """
+    Run a function that scores employees on the scoring process pool.
+
+    :return: Result of the function
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(request.app['scoring_executor'], partial(func, *args))
+
+
+def predict_features(test_df):
+    """
+    Score an employee with the most recent model. Runs in a scoring process.
+
+    :param test_df: Data frame holding the employee's model features
+    :return: Hard prediction, probability of the prediction and the employee's features
+    """
+    pred, proba, _ = predict_employee_churn(test_df.copy())
+    return pred, proba, test_df
+
+
+def predict_new_employee(fields):
+    """
+    Score a hypothetical employee from their raw field values. Runs in a scoring process.
+
+    :param fields: Dictionary of feature name to value, as for the prediction page's new employee form
+    :return: Hard prediction, probability of the prediction and the employee's features after cleaning them up
+    """
+    return predict_features(new_employee_df(**fields))
+
+
+def prediction_json(emp_id, pred, proba, test_df, source):
+    """
+    :return: Dictionary describing a prediction, with the probability of churn as well as that of the prediction
+    """
+    return {
+        'emp_id': emp_id,
+        'prediction': pred,
+        'probability': proba,
+        'churn_probability': proba if pred else round(1 - proba, 4),
+        'source': source,
+        'employee': dict(zip(FEATURES, test_df[FEATURES].values.tolist()[0]))
+    }
+
+
+async def employee_prediction(request, emp_id):
+    # the version is read from the manifest, so the model is only ever loaded in the scoring processes
+    found = await run_query(request, lookup_employee, emp_id, registry.current_version())
+    if found is None:
+        return error(404, "No employee with Emp_ID {}".format(emp_id))
+
+    test_df, scored = found
+    if scored is not None:
+        return json_response(prediction_json(emp_id, scored[0], scored[1], test_df, 'churn_scores'))
+    pred, proba, test_df = await run_scoring(request, predict_features, test_df)
+    return json_response(prediction_json(emp_id, pred, proba, test_df, 'model'))
+
+
+@routes.post('/api/v1/predict')
+async def predict(request):
+    try:
+        payload = await request.json()
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict):
+        return error(400, "Expected a JSON object")
+
+    if 'emp_id' in payload:
+        try:
+            emp_id = int(payload['emp_id'])
+        except (TypeError, ValueError):
+            return error(400, "emp_id must be an integer")
+        return await employee_prediction(request, emp_id)
+
+    employee = payload.get('employee')
+    if not isinstance(employee, dict) or any(field not in employee for field in FEATURES):
+        return error(400, "Expected emp_id, or an employee with the fields {}".format(', '.join(FEATURES)))
+    try:
+        pred, proba, test_df = await run_scoring(request, predict_new_employee,
+                                                 {field: employee[field] for field in FEATURES})
+    except (TypeError, ValueError) as e:
+        return error(400, "Invalid employee: {}".format(e))
+    return json_response(prediction_json(None, pred, proba, test_df, 'model'))
+
+
+@routes.get('/api/v1/employees/{emp_id:\\d+}')
+async def employee(request):
+    return await employee_prediction(request, int(request.match_info['emp_id']))
+
+
+def _top_scores(n, department, version):
+    scores = top_at_risk(n, department, version)
+    n_scored, n_employees = score_coverage(version)
+    return {
+        'model_version': version,
+        'n_scored': n_scored,
+        'n_employees': n_employees,
+        'scores': [{'emp_id': s.Emp_ID, 'department': s.department, 'churn_probability': round(s.probability, 4),
+                    'prediction': bool(s.label), 'scored_at': s.scored_at.isoformat() if s.scored_at else None}
+                   for s in scores]
+    }
+
+
+@routes.get('/api/v1/scores')
+async def scores(request):
+    department = request.query.get('department') or None
+    if department is not None and department not in DEPARTMENT_OPTIONS:
+        return error(400, "Unknown department, expected one of {}".format(', '.join(DEPARTMENT_OPTIONS)))
+    try:
+        n = int(request.query.get('n', 10))
+    except ValueError:
+        return error(400, "n must be an integer")
+    if not 1 <= n <= MAX_SCORES:
+        return error(400, "n must be between 1 and {}".format(MAX_SCORES))
+
+    return json_response(await run_query(request, _top_scores, n, department, registry.current_version()))
+
+
+def create_app(scoring_workers=config.API_SCORING_WORKERS):
+    """
+    Build the aiohttp application. The pools don't start any threads or processes until first used.
+
+    :param scoring_workers: Number of scoring processes
+    :return: aiohttp application
+    """
+    app = web.Application()
+    app.add_routes(routes)
+    app['db_executor'] = ThreadPoolExecutor(config.DB_POOL_SIZE)
+    app['scoring_executor'] = ProcessPoolExecutor(scoring_workers)
+    app.on_cleanup.append(shutdown_pools)
+    return app
+
+
+async def shutdown_pools(app):
+    app['db_executor'].shutdown()
+    app['scoring_executor'].shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=config.API_PORT)
+    parser.add_argument('--scoring-workers', type=int, default=config.API_SCORING_WORKERS,
+                        help="Number of processes scoring employees")
+    args = parser.parse_args()
+
+    web.run_app(create_app(args.scoring_workers), host=args.host, port=args.port)
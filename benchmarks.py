@@ -0,0 +1,920 @@
+"""
+Benchmarks for the slow paths of the application. Everything runs against synthetic HR tables, written to a
+temporary SQLite database, so that results can be reproduced on any machine without the original data.
+
+Run as main method with the name of a benchmark, e.g.:
+    $ python benchmarks.py loader --sizes 15000 150000 1500000
+
+The suite runs the prediction, web, loader, query and model loading benchmarks together, and writes the results to a
+JSON file along with the commit and library versions they were measured on, so that two commits can be compared:
+    $ python benchmarks.py suite --rows 15000 --output before.json
+    $ python benchmarks.py compare before.json after.json
+"""
+
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+import sklearn
+import sqlalchemy
+from sklearn.model_selection import train_test_split
+from sqlalchemy import create_engine
+
+import config
+import database_operations
+import feature_store
+import loadtest
+import prediction_cache
+import queries
+from churn_scores import refresh_churn_scores
+from fast_predict import CompiledEnsemble
+from index import create_app
+from model_registry import registry
+from sqlite_declarative import Base, Employee
+from training_jobs import TERMINAL_STATES, retrain, training_queue
+from HRmodel import DEPARTMENT_OPTIONS, FEATURES, NONNUMERIC_COLUMNS, SALARY_OPTIONS, TRAINER_BACKENDS, proc_df, \
+    predict_employee_churn, predict_employee_churn_batch, train_model
+
+
+# Malformed spellings of the accepted field values, like those found in the raw data
+DEPARTMENT_VARIANTS = DEPARTMENT_OPTIONS + ['R&D', 'Sales ', 'mngmt', 'Technical', 'support ', 'acounting']
+SALARY_VARIANTS = SALARY_OPTIONS + ['Low', 'med', 'HIGH']
+
+# Gunicorn worker classes the load benchmark knows how to start: one request at a time per worker process, a pool of
+# threads per worker, and greenlets (which needs gevent installed)
+WORKER_CLASSES = ('sync', 'gthread', 'gevent')
+
+# Fields of a result describing what was measured rather than a measurement, which results are matched on when
+# comparing two files
+SETTINGS = ('rows', 'workers', 'threads', 'clients')
+
+
+def synthetic_employees(n_rows, seed=1234, start_id=1):
+    """
+    Generate employees matching the Employee schema, with churn loosely driven by satisfaction, hours and salary.
+
+    :param n_rows: Number of employees to generate
+    :param seed: Random seed for reproducible results
+    :param start_id: First employee ID
+    :return: Data frame with a column for each Employee attribute
+    """
+    rng = np.random.RandomState(seed)
+    df = pd.DataFrame({
+        'Emp_ID': np.arange(start_id, start_id + n_rows),
+        'satisfaction_level': rng.uniform(0.09, 1.0, n_rows).round(2),
+        'last_evaluation': rng.uniform(0.36, 1.0, n_rows).round(2),
+        'number_project': rng.randint(2, 8, n_rows),
+        'average_montly_hours': rng.randint(96, 311, n_rows),
+        'time_spend_company': rng.randint(2, 11, n_rows),
+        'Work_accident': (rng.rand(n_rows) < 0.15).astype(int),
+        'promotion_last_5years': (rng.rand(n_rows) < 0.02).astype(int),
+        'department': np.array(DEPARTMENT_VARIANTS)[rng.randint(0, len(DEPARTMENT_VARIANTS), n_rows)],
+        'salary': np.array(SALARY_VARIANTS)[rng.randint(0, len(SALARY_VARIANTS), n_rows)],
+    })
+    risk = (1.5 - 3 * df['satisfaction_level'] + (df['average_montly_hours'] - 200) / 100.
+            + df['salary'].str.lower().str.startswith('l') - 2 * df['promotion_last_5years'])
+    df['left'] = (rng.rand(n_rows) < 1 / (1 + np.exp(-risk))).astype(int)
+    return df
+
+
+def create_synthetic_db(path, n_rows, seed=1234, chunksize=100000):
+    """
+    Write a synthetic all_HR_data table to a new SQLite database.
+
+    :param path: Where to write the database file
+    :param n_rows: Number of employees to generate
+    :param seed: Random seed for reproducible results
+    :param chunksize: Number of employees generated and inserted at a time
+    :return: None
+    """
+    engine = create_engine('sqlite:///{}'.format(path))
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for start in range(0, n_rows, chunksize):
+            chunk = synthetic_employees(min(chunksize, n_rows - start), seed=seed + start, start_id=start + 1)
+            conn.execute(Employee.__table__.insert(), chunk.to_dict(orient='records'))
+    engine.dispose()
+
+
+def use_database(path):
+    """
+    Point database_operations at another SQLite database.
+
+    :param path: Path to the database file
+    :return: None
+    """
+    config.DATABASE_URL = 'sqlite:///{}'.format(path)
+    database_operations.dispose_engine()
+
+
+def timed(func, *args, **kwargs):
+    """
+    :return: Wall clock seconds taken by func, and its result
+    """
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def peak_memory(func, *args, **kwargs):
+    """
+    :return: Peak memory allocated while running func, in MB. Run separately from timing, as tracing slows every
+        allocation down.
+    """
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        return round(tracemalloc.get_traced_memory()[1] / 2. ** 20, 1)
+    finally:
+        tracemalloc.stop()
+
+
+def retained_memory(func, *args, **kwargs):
+    """
+    :return: Memory still allocated once func has returned, i.e. held by its result, in MB, and its result
+    """
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        return round(tracemalloc.get_traced_memory()[0] / 2. ** 20, 1), result
+    finally:
+        tracemalloc.stop()
+
+
+def latency_summary(prefix, latencies):
+    """
+    :return: Dictionary of the median and 99th percentile of a list of latencies, in milliseconds
+    """
+    return {prefix + '_p50_ms': round(1000 * np.percentile(latencies, 50), 3),
+            prefix + '_p99_ms': round(1000 * np.percentile(latencies, 99), 3)}
+
+
+@contextmanager
+def workspace(n_rows, seed=1234):
+    """
+    Run in a temporary directory holding a synthetic database, so that the models, caches, job files and metrics
+    written along the way never touch the real ones.
+
+    :param n_rows: Number of employees in the database
+    :param seed: Random seed for reproducible results
+    :return: Context manager, giving the path of the temporary directory
+    """
+    cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        os.chdir(tmp_dir)
+        create_synthetic_db('HR_sqlite.db', n_rows, seed)
+        use_database(os.path.join(tmp_dir, 'HR_sqlite.db'))
+        yield tmp_dir
+    finally:
+        training_queue.shutdown()
+        database_operations.dispose_engine()
+        prediction_cache.predictions.close()
+        prediction_cache.employee_features.close()
+        os.chdir(cwd)
+        shutil.rmtree(tmp_dir)
+
+
+def orm_loader(max_id):
+    return database_operations.employee_group_to_df(database_operations.get_employees_by_max_id(max_id))
+
+
+def bench_loader(sizes, orm_max_rows=None):
+    """
+    Compare loading employees for retraining through Employee objects against the bulk loader.
+
+    :param sizes: Table sizes to benchmark
+    :param orm_max_rows: Skip the Employee object path for tables larger than this
+    :return: List of result dictionaries, one per table size
+    """
+    results = []
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for n_rows in sizes:
+            path = os.path.join(tmp_dir, 'HR_{}.db'.format(n_rows))
+            create_synthetic_db(path, n_rows)
+            use_database(path)
+
+            result = {'rows': n_rows}
+            if orm_max_rows is None or n_rows <= orm_max_rows:
+                result['orm_seconds'], orm_df = timed(orm_loader, n_rows)
+                database_operations.remove_session()
+                result['orm_peak_mb'] = peak_memory(orm_loader, n_rows)
+                database_operations.remove_session()
+            result['bulk_seconds'], bulk_df = timed(database_operations.load_employees_df, n_rows)
+            result['bulk_chunked_seconds'], _ = timed(database_operations.load_employees_df, n_rows,
+                                                      chunksize=100000)
+            result['bulk_peak_mb'] = peak_memory(database_operations.load_employees_df, n_rows)
+            if 'orm_seconds' in result:
+                result['speedup'] = round(result['orm_seconds'] / result['bulk_seconds'], 1)
+                assert orm_df.equals(bulk_df[orm_df.columns]), "Bulk loader disagrees with employee_group_to_df"
+            database_operations.dispose_engine()
+            results.append(result)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def bench_backends(n_rows, backends=TRAINER_BACKENDS, n_est=100, n_predictions=200):
+    """
+    Compare the trainer backends on the same synthetic data: fit time, latency of scoring a single employee, and
+    test score on a held out fifth of the data.
+
+    :param n_rows: Number of employees to generate
+    :param backends: Backends to benchmark
+    :param n_est: Number of estimators to use
+    :param n_predictions: Number of single employee predictions to time
+    :return: List of result dictionaries, one per backend
+    """
+    employee_df = database_operations.canonicalize_df(synthetic_employees(n_rows))
+    train_df, test_df = train_test_split(employee_df, train_size=0.8, random_state=1234)
+    train_df, d = proc_df(train_df)
+    test_df, _ = proc_df(test_df, d)
+    single_row = test_df[FEATURES].iloc[:1]
+
+    results = []
+    for backend in backends:
+        try:
+            fit_seconds, GB = timed(train_model, train_df, n_est=n_est, backend=backend)
+        except ImportError as e:
+            print("Skipping {}: {}".format(backend, e))
+            continue
+
+        latencies = []
+        for _ in range(n_predictions):
+            seconds, _ = timed(GB.predict_proba, single_row)
+            latencies.append(seconds)
+        batch_seconds, _ = timed(GB.predict_proba, test_df[FEATURES])
+
+        results.append({
+            'backend': backend,
+            'rows': n_rows,
+            'fit_seconds': round(fit_seconds, 3),
+            'predict_p50_ms': round(1000 * np.percentile(latencies, 50), 3),
+            'predict_p99_ms': round(1000 * np.percentile(latencies, 99), 3),
+            'batch_rows_per_second': int(len(test_df) / batch_seconds),
+            'test_score': round(GB.score(test_df[FEATURES], test_df['left']), 4)
+        })
+    return results
+
+
+def bench_inference(n_rows, backends=('gbc', 'hist'), n_est=100, n_predictions=1000):
+    """
+    Compare scoring a single employee through pandas and scikit-learn, as predict_employee_churn used to, against
+    the compiled ensemble, and check that both give the same probabilities for every held out employee.
+
+    :param n_rows: Number of employees to generate
+    :param backends: Backends to benchmark
+    :param n_est: Number of estimators to use
+    :param n_predictions: Number of single employee predictions to time per path
+    :return: List of result dictionaries, one per backend
+    """
+    employee_df = database_operations.canonicalize_df(synthetic_employees(n_rows))
+    train_df, test_df = train_test_split(employee_df, train_size=0.8, random_state=1234)
+    train_df, d = proc_df(train_df)
+    raw_rows = test_df[FEATURES].values.tolist()
+    single_df = test_df[FEATURES].iloc[:1]
+
+    def sklearn_path(GB):
+        df, _ = proc_df(single_df.copy(), d)
+        pred = GB.predict(df)[0]
+        proba = GB.predict_proba(df)[0][pred]
+        df[NONNUMERIC_COLUMNS] = df[NONNUMERIC_COLUMNS].apply(lambda x: d[x.name].inverse_transform(x))
+        return pred, proba
+
+    def compiled_path(compiled):
+        proba = compiled.predict_proba(compiled.encode(raw_rows[:1]))[0]
+        return compiled.classes[proba.argmax()], proba.max()
+
+    results = []
+    for backend in backends:
+        GB = train_model(train_df, n_est=n_est, backend=backend)
+        compile_seconds, compiled = timed(CompiledEnsemble.from_model, GB, d, FEATURES)
+        if compiled is None:
+            print("Skipping {}: model can't be compiled".format(backend))
+            continue
+
+        result = {'backend': backend, 'rows': len(raw_rows), 'compile_ms': round(1000 * compile_seconds, 1)}
+        for name, func, arg in [('sklearn', sklearn_path, GB), ('compiled', compiled_path, compiled)]:
+            latencies = [timed(func, arg)[0] for _ in range(n_predictions)]
+            result[name + '_p50_ms'] = round(1000 * np.percentile(latencies, 50), 3)
+            result[name + '_p99_ms'] = round(1000 * np.percentile(latencies, 99), 3)
+        result['speedup'] = round(result['sklearn_p50_ms'] / result['compiled_p50_ms'], 1)
+
+        expected = GB.predict_proba(proc_df(test_df[FEATURES].copy(), d)[0])
+        result['max_abs_diff'] = float(np.abs(compiled.predict_proba(compiled.encode(raw_rows)) - expected).max())
+        results.append(result)
+    return results
+
+
+def bench_prediction(n_rows, backend='gbc', n_predictions=500):
+    """
+    Time predictions the way the application makes them, against a model trained and published by retrain: single
+    employees through predict_employee_churn, both before and after they are in the prediction cache, every held out
+    employee at once through predict_employee_churn_batch, and the whole table through refresh_churn_scores.
+
+    :param n_rows: Number of employees to generate
+    :param backend: Backend to train with
+    :param n_predictions: Number of single employee predictions to time
+    :return: List holding one result dictionary
+    """
+    with workspace(n_rows):
+        train_seconds, trained = timed(retrain, n_rows, backend=backend)
+        employee_df = database_operations.load_employees_df(n_rows)
+        test_df = employee_df.sample(min(n_predictions, n_rows), random_state=1234)[FEATURES]
+        singles = [test_df.iloc[i:i + 1] for i in range(len(test_df))]
+
+        result = {'backend': backend, 'rows': n_rows, 'retrain_seconds': round(train_seconds, 3),
+                  'test_score': trained['test_score']}
+        prediction_cache.predictions.clear()
+        for name in ['uncached', 'cached']:
+            latencies = [timed(predict_employee_churn, single.copy())[0] for single in singles]
+            result.update(latency_summary(name, latencies))
+
+        batch_seconds, _ = timed(predict_employee_churn_batch, employee_df)
+        result['batch_rows_per_second'] = int(len(employee_df) / batch_seconds)
+        refresh_seconds, refreshed = timed(refresh_churn_scores, trained['version'])
+        result['refresh_rows_per_second'] = int(refreshed['n_rows'] / refresh_seconds)
+        return [result]
+
+
+def bench_web(n_rows, n_requests=200, n_jobs=4, backend='gbc'):
+    """
+    Measure throughput of the /prediction and /new_model endpoints through the Flask test client, which covers
+    routing, forms, database lookups and template rendering but not the network. /prediction by employee ID is
+    timed before the churn score table is filled, when every employee is scored on demand, and after. /new_model
+    is timed both for submitting jobs, and for the jobs to run to completion.
+
+    :param n_rows: Number of employees to generate
+    :param n_requests: Number of /prediction requests per case
+    :param n_jobs: Number of retraining jobs submitted through /new_model
+    :param backend: Backend to train with
+    :return: List of result dictionaries, one per case
+    """
+    with workspace(n_rows):
+        retrain(n_rows, backend=backend)
+        client = create_app().test_client()
+        rng = np.random.RandomState(1234)
+        emp_ids = rng.randint(1, n_rows + 1, n_requests).tolist()
+        custom = synthetic_employees(n_requests, seed=4321).drop(columns=['Emp_ID', 'left'])
+        custom[['Work_accident', 'promotion_last_5years']] = custom[['Work_accident', 'promotion_last_5years']] \
+            .astype(bool).astype(str)
+
+        def run_case(case, path, forms):
+            latencies, locations = [], []
+            for form in forms:
+                seconds, response = timed(client.post, path, data=form)
+                assert response.status_code in (200, 302), "{} returned {}".format(path, response.status_code)
+                latencies.append(seconds)
+                locations.append(response.location)
+            result = {'case': case, 'rows': n_rows, 'requests': len(forms),
+                      'requests_per_second': round(len(forms) / sum(latencies), 1)}
+            result.update(latency_summary('latency', latencies))
+            return result, locations
+
+        by_id = [{'emp_id': emp_id} for emp_id in emp_ids]
+        results = [run_case('prediction_by_id', '/prediction', by_id)[0]]
+        refresh_churn_scores()
+        results.append(run_case('prediction_by_id_scored', '/prediction', by_id)[0])
+        prediction_cache.predictions.clear()
+        results.append(run_case('prediction_custom', '/prediction', custom.to_dict(orient='records'))[0])
+
+        # distinct cutoffs, so that every request starts a job of its own
+        start = time.perf_counter()
+        cutoffs = np.linspace(n_rows // 2, n_rows, n_jobs).astype(int).tolist()
+        result, locations = run_case('new_model', '/new_model', [{'emp_id': emp_id, 'backend': backend}
+                                                                 for emp_id in cutoffs])
+        job_ids = [location.rstrip('/').split('/')[-1] for location in locations]
+        while any(training_queue.status(job_id)['state'] not in TERMINAL_STATES for job_id in job_ids):
+            time.sleep(0.1)
+        result['jobs_per_minute'] = round(60 * len(job_ids) / (time.perf_counter() - start), 2)
+        results.append(result)
+        return results
+
+
+def bench_model_load(n_rows, backends=('gbc', 'hist'), n_loads=20):
+    """
+    Time loading a published model from disk, as every process does on its first prediction and after each retrain,
+    and flattening it for the compiled inference path.
+
+    :param n_rows: Number of employees to train on
+    :param backends: Backends to benchmark
+    :param n_loads: Number of loads to time per backend
+    :return: List of result dictionaries, one per backend
+    """
+    results = []
+    with workspace(n_rows):
+        for backend in backends:
+            try:
+                version = retrain(n_rows, backend=backend)['version']
+            except ImportError as e:
+                print("Skipping {}: {}".format(backend, e))
+                continue
+
+            latencies = [timed(registry.load, version)[0] for _ in range(n_loads)]
+            _, GB, d = registry.load(version)
+            compile_seconds, compiled = timed(CompiledEnsemble.from_model, GB, d, FEATURES)
+            result = {'backend': backend, 'rows': n_rows,
+                      'size_kb': round(registry.metadata(version)['size_bytes'] / 1024., 1),
+                      'compile_ms': round(1000 * compile_seconds, 1) if compiled is not None else None}
+            result.update(latency_summary('load', latencies))
+            results.append(result)
+    return results
+
+
+# Segments of the employee table paged through by the query benchmark
+QUERY_CASES = [
+    ('department', {'department': 'sales'}),
+    ('department_left', {'department': 'sales', 'left': 1}),
+    ('salary_satisfaction', {'salary': 'high', 'ranges': {'satisfaction_level': (None, 0.2)}}),
+    ('ranges_only', {'ranges': {'time_spend_company': (8, 10), 'last_evaluation': (0.9, None)}}),
+]
+
+
+def bench_queries(n_rows, n_pages=50, limit=queries.PAGE_SIZE):
+    """
+    Page through segments of the employee table with the query layer, and compare against loading the whole table
+    and filtering it in pandas.
+
+    :param n_rows: Number of employees to generate
+    :param n_pages: Number of consecutive pages read per segment
+    :param limit: Number of employees per page
+    :return: List of result dictionaries, one per segment
+    """
+    results = []
+    with workspace(n_rows):
+        queries.canonicalize_stored_fields()
+        full_seconds, _ = timed(database_operations.load_employees_df)
+        for case, filters in QUERY_CASES:
+            latencies, cursor = [], None
+            for _ in range(n_pages):
+                seconds, (_, cursor) = timed(queries.query_employees, limit, **dict(filters, after=cursor))
+                latencies.append(seconds)
+                if cursor is None:
+                    break
+            result = {'case': case, 'rows': n_rows, 'pages': len(latencies),
+                      'plan': '; '.join(queries.explain_query(limit, **filters)),
+                      'full_load_seconds': round(full_seconds, 3)}
+            result.update(latency_summary('page', latencies))
+            results.append(result)
+    return results
+
+
+def bench_feature_store(n_rows, orm_max_rows=150000, n_lookups=1000):
+    """
+    Compare holding the workforce in the in-memory feature store against Employee objects and the data frame from
+    the bulk loader: memory held per million employees, load time, single employee lookups and getting a training
+    frame ready.
+
+    :param n_rows: Number of employees to generate
+    :param orm_max_rows: Measure Employee objects on at most this many employees, and scale up
+    :param n_lookups: Number of single employee lookups to time
+    :return: List of result dictionaries, one per path
+    """
+    results = []
+    with workspace(n_rows):
+        per_million = 10 ** 6 / float(n_rows)
+        rng = np.random.RandomState(1234)
+        emp_ids = rng.randint(1, n_rows + 1, n_lookups).tolist()
+
+        store = feature_store.FeatureStore()
+        load_seconds, _ = timed(store.load)
+        store_mb, _ = retained_memory(feature_store.FeatureStore().load)
+        latencies = [timed(store.lookup, emp_id)[0] for emp_id in emp_ids]
+        frame_seconds, _ = timed(store.training_frame)
+        result = {'path': 'feature_store', 'rows': n_rows, 'load_seconds': round(load_seconds, 3),
+                  'mb_per_million': round(store_mb * per_million, 1), 'training_frame_seconds': round(frame_seconds, 3)}
+        result.update(latency_summary('lookup', latencies))
+        results.append(result)
+
+        load_seconds, employee_df = timed(database_operations.load_employees_df)
+        df_mb = employee_df.memory_usage(index=True, deep=True).sum() / 2. ** 20
+        frame_seconds, _ = timed(lambda: proc_df(database_operations.load_employees_df()))
+        latencies = [timed(lambda i: database_operations.employee_to_df(database_operations.get_employee_by_id(i)),
+                           emp_id)[0] for emp_id in emp_ids]
+        database_operations.remove_session()
+        result = {'path': 'data_frame', 'rows': n_rows, 'load_seconds': round(load_seconds, 3),
+                  'mb_per_million': round(df_mb * per_million, 1), 'training_frame_seconds': round(frame_seconds, 3)}
+        result.update(latency_summary('lookup', latencies))
+        results.append(result)
+        del employee_df
+
+        n_orm = min(n_rows, orm_max_rows)
+        load_seconds, _ = timed(database_operations.get_employees_by_max_id, n_orm)
+        database_operations.remove_session()
+        orm_mb, employees = retained_memory(database_operations.get_employees_by_max_id, n_orm)
+        database_operations.remove_session()
+        results.append({'path': 'employee_objects', 'rows': n_orm, 'load_seconds': round(load_seconds, 3),
+                        'mb_per_million': round(orm_mb * 10 ** 6 / float(n_orm), 1)})
+        del employees
+
+    for result in results:
+        result['vs_store'] = round(result['mb_per_million'] / results[0]['mb_per_million'], 1)
+    return results
+
+
+def free_port():
+    """
+    :return: A local TCP port that nothing is listening on
+    """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def child_pids(pid):
+    """
+    :return: IDs of the processes whose parent is the given one, e.g. the workers of a gunicorn master
+    """
+    pids = []
+    for entry in os.listdir('/proc'):
+        try:
+            with open('/proc/{}/stat'.format(entry)) as f:
+                stat = f.read()
+        except (IOError, OSError):
+            continue
+        # the parent ID follows the state, after the command name which may itself hold spaces
+        if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+            pids.append(int(entry))
+    return pids
+
+
+def memory_of(pid):
+    """
+    :return: Dictionary of the resident set size of a process, its proportional set size (shared pages split evenly
+        between the processes sharing them) and its unique set size (pages no other process shares), in MB
+    """
+    sizes = {}
+    with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == 'kB':
+                sizes[fields[0].rstrip(':')] = int(fields[1]) / 1024.
+    return {'rss_mb': sizes['Rss'], 'pss_mb': sizes['Pss'], 'uss_mb': sizes['Private_Clean'] + sizes['Private_Dirty']}
+
+
+@contextmanager
+def gunicorn(app_dir, tmp_dir, options=(), preload=1, timeout=120, probe_emp_id=1):
+    """
+    Start gunicorn the way the deploy scripts do, in a workspace, and wait until it answers a /prediction request.
+    The server is stopped on leaving the context, along with any training processes its workers started.
+
+    :param app_dir: Checkout of the application to start
+    :param tmp_dir: Workspace holding the database, as from workspace
+    :param options: Extra gunicorn command line options, e.g. ['--workers', '4'], which take precedence over
+        gunicorn.conf.py
+    :param preload: Whether to build the app in the master before forking the workers
+    :param timeout: Seconds to wait for the first request to succeed
+    :param probe_emp_id: Employee ID the first request looks up
+    :return: Context manager, giving the server process, its base URL and the seconds until the first request
+        succeeded
+    """
+    command = [sys.executable, '-m', 'gunicorn'] + list(options) + ['wsgi:app']
+    if os.path.exists(os.path.join(app_dir, 'gunicorn.conf.py')):
+        command[3:3] = ['--config', os.path.join(app_dir, 'gunicorn.conf.py')]
+    port = free_port()
+    base_url = 'http://127.0.0.1:{}'.format(port)
+    env = dict(os.environ, PYTHONPATH=app_dir, HR_DATABASE_URL=config.DATABASE_URL, HR_PRELOAD=str(preload))
+    start = time.perf_counter()
+    server = subprocess.Popen(command + ['--bind', '127.0.0.1:{}'.format(port)], cwd=tmp_dir, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        data = urllib.parse.urlencode({'emp_id': probe_emp_id}).encode()
+        while True:
+            try:
+                urllib.request.urlopen(base_url + '/prediction', data).read()
+                break
+            except (IOError, OSError):
+                if server.poll() is not None or time.perf_counter() - start > timeout:
+                    raise RuntimeError("gunicorn didn't start serving requests")
+                time.sleep(0.01)
+        yield server, base_url, time.perf_counter() - start
+    finally:
+        # the workers' training processes outlive them if they are busy with a job
+        trainers = [pid for worker in child_pids(server.pid) for pid in child_pids(worker)]
+        server.terminate()
+        server.wait()
+        for pid in trainers:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+
+def bench_startup(n_rows, n_workers=4, n_requests=100, app_dir=None, timeout=120):
+    """
+    Start gunicorn the way the deploy scripts do, with and without building the app in the master before forking,
+    and measure the time until the first /prediction request succeeds, the latency of the requests that follow (the
+    slowest of which land on workers that haven't loaded anything yet) and the memory held by each worker. Linux only,
+    as memory is read from /proc.
+
+    :param n_rows: Number of employees to generate and train on
+    :param n_workers: Number of gunicorn workers
+    :param n_requests: Number of /prediction requests sent after the first one
+    :param app_dir: Checkout of the application to start, e.g. a worktree of an older commit to compare against.
+        Will use the one holding this file if not provided.
+    :param timeout: Seconds to wait for the first request to succeed
+    :return: List of result dictionaries, one per mode
+    """
+    app_dir = os.path.abspath(app_dir or os.path.dirname(os.path.abspath(__file__)))
+    rng = np.random.RandomState(1234)
+    emp_ids = rng.randint(1, n_rows + 1, n_requests + 1).tolist()
+
+    results = []
+    with workspace(n_rows) as tmp_dir:
+        retrain(n_rows)
+        for preload in (0, 1):
+            with gunicorn(app_dir, tmp_dir, ['--workers', str(n_workers)], preload, timeout, emp_ids[0]) \
+                    as (server, base_url, first_request_seconds):
+                latencies = []
+                for emp_id in emp_ids[1:]:
+                    data = urllib.parse.urlencode({'emp_id': emp_id}).encode()
+                    latencies.append(timed(lambda: urllib.request.urlopen(base_url + '/prediction', data).read())[0])
+
+                workers = [memory_of(pid) for pid in child_pids(server.pid)]
+                master = memory_of(server.pid)
+
+            result = {'preload': bool(preload), 'rows': n_rows, 'workers': len(workers),
+                      'first_request_seconds': round(first_request_seconds, 3)}
+            result.update(latency_summary('request', latencies))
+            result['request_max_ms'] = round(1000 * max(latencies), 3)
+            for key in ['rss_mb', 'pss_mb', 'uss_mb']:
+                result['worker_' + key] = round(np.mean([w[key] for w in workers]), 1)
+            result['total_pss_mb'] = round(master['pss_mb'] + sum(w['pss_mb'] for w in workers), 1)
+            results.append(result)
+    return results
+
+
+def bench_load(n_rows, worker_counts=(1, 2, 4), worker_classes=WORKER_CLASSES, threads=4, clients=(16,), mix=None,
+               duration=30.0, warmup=5.0, preload=1, app_dir=None):
+    """
+    Start gunicorn on a synthetic database with each worker class and number of workers, replay a mix of employee
+    lookups, custom employee predictions and retrains against it from many clients at once (see loadtest.py), and
+    report the latency percentiles, throughput and error rate of each kind of request. Every combination gets a
+    fresh server. The clients run on the same machine as the server, so leave them some room on small machines.
+
+    :param n_rows: Number of employees to generate and train on
+    :param worker_counts: Numbers of gunicorn workers to try
+    :param worker_classes: Gunicorn worker classes to try, out of WORKER_CLASSES. gevent is skipped if it isn't
+        installed.
+    :param threads: Number of threads per worker, for the gthread worker class
+    :param clients: Numbers of clients sending requests at the same time to try
+    :param mix: Dictionary of request type to its relative weight. Will use loadtest.DEFAULT_MIX if not provided.
+    :param duration: Seconds to measure each combination for
+    :param warmup: Seconds to send requests for before measuring
+    :param preload: Whether to build the app in the master before forking the workers
+    :param app_dir: Checkout of the application to start. Will use the one holding this file if not provided.
+    :return: List of result dictionaries, one per combination and request type
+    """
+    app_dir = os.path.abspath(app_dir or os.path.dirname(os.path.abspath(__file__)))
+    mix = mix or loadtest.DEFAULT_MIX
+    results = []
+    with workspace(n_rows) as tmp_dir:
+        retrain(n_rows)
+        for worker_class in worker_classes:
+            if worker_class == 'gevent' and importlib.util.find_spec('gevent') is None:
+                print("Skipping gevent: it isn't installed")
+                continue
+            worker_threads = threads if worker_class == 'gthread' else 1
+            for n_workers in worker_counts:
+                options = ['--worker-class', worker_class, '--workers', str(n_workers),
+                           '--threads', str(worker_threads)]
+                for n_clients in clients:
+                    with gunicorn(app_dir, tmp_dir, options, preload) as (_, base_url, _):
+                        rows = loadtest.run_load(base_url, mix, n_clients, duration, warmup, max_id=n_rows)
+                    for row in rows:
+                        result = {'worker_class': worker_class, 'workers': n_workers, 'threads': worker_threads,
+                                  'clients': n_clients, 'rows': n_rows, 'mix': loadtest.format_mix(mix)}
+                        result.update(row)
+                        results.append(result)
+    return results
+
+
+def run_suite(n_rows, backend='gbc'):
+    """
+    Run the benchmarks that cover the paths taken by the web application and retraining, at one table size.
+
+    :param n_rows: Number of employees to generate
+    :param backend: Backend to train with
+    :return: Dictionary of benchmark name to its list of results
+    """
+    return {
+        'prediction': bench_prediction(n_rows, backend),
+        'web': bench_web(n_rows, backend=backend),
+        'loader': bench_loader([n_rows]),
+        'queries': bench_queries(n_rows),
+        'model_load': bench_model_load(n_rows)
+    }
+
+
+def environment():
+    """
+    :return: Dictionary describing what the benchmarks ran on: the commit, whether there were uncommitted changes,
+        and the versions of Python and the main libraries
+    """
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repo_dir).decode().strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=repo_dir))
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+    return {
+        'commit': commit,
+        'dirty': dirty,
+        'created_at': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'libraries': {'numpy': np.__version__, 'pandas': pd.__version__, 'sklearn': sklearn.__version__,
+                      'sqlalchemy': sqlalchemy.__version__}
+    }
+
+
+def write_results(path, benchmarks, arguments=None):
+    """
+    Write benchmark results to a JSON file, along with the environment they were measured in.
+
+    :param path: Path of the JSON file
+    :param benchmarks: Dictionary of benchmark name to its list of results
+    :param arguments: Dictionary of the arguments the benchmarks were run with
+    :return: None
+    """
+    document = dict(environment(), arguments=arguments or {}, benchmarks=benchmarks)
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+
+
+def compare_results(base_path, new_path):
+    """
+    Line up the numbers of two results files, matching results by benchmark, by their non-numeric fields (e.g.
+    backend or case) and by their SETTINGS (e.g. table size).
+
+    :param base_path: Path of the results to compare against
+    :param new_path: Path of the newer results
+    :return: Data frame with a row per metric found in both, and the relative change
+    """
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+
+    def is_metric(key, value):
+        return key not in SETTINGS and isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    def index(document):
+        results = {}
+        for benchmark, rows in document['benchmarks'].items():
+            for row in rows:
+                case = ' '.join(str(v) for k, v in sorted(row.items()) if not is_metric(k, v))
+                for key, value in row.items():
+                    if is_metric(key, value):
+                        results[(benchmark, case, key)] = value
+        return results
+
+    base_results, new_results = index(base), index(new)
+    comparison = pd.DataFrame([
+        {'benchmark': benchmark, 'case': case, 'metric': metric, 'base': value, 'new': new_results[key],
+         'change': '{:+.1%}'.format(new_results[key] / value - 1) if value else None}
+        for key, value in sorted(base_results.items()) if key in new_results
+        for benchmark, case, metric in [key]
+    ])
+    print("Comparing {} ({}) against {} ({})".format(new_path, new['commit'], base_path, base['commit']))
+    return comparison
+
+
+def print_results(results):
+    print(pd.DataFrame(results).to_string(index=False))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    loader_parser = subparsers.add_parser('loader', help="Load employees for retraining")
+    loader_parser.add_argument('--sizes', type=int, nargs='+', default=[15000, 150000, 1500000])
+    loader_parser.add_argument('--orm-max-rows', type=int, default=None,
+                               help="Skip the Employee object path for tables larger than this")
+
+    backends_parser = subparsers.add_parser('backends', help="Train and score with each trainer backend")
+    backends_parser.add_argument('--rows', type=int, default=150000)
+    backends_parser.add_argument('--backends', nargs='+', default=TRAINER_BACKENDS, choices=TRAINER_BACKENDS)
+    backends_parser.add_argument('--n-est', type=int, default=100)
+
+    inference_parser = subparsers.add_parser('inference', help="Score single employees with and without compiling")
+    inference_parser.add_argument('--rows', type=int, default=15000)
+    inference_parser.add_argument('--backends', nargs='+', default=['gbc', 'hist'], choices=TRAINER_BACKENDS)
+    inference_parser.add_argument('--n-est', type=int, default=100)
+
+    prediction_parser = subparsers.add_parser('prediction', help="Single and batch prediction latency")
+    prediction_parser.add_argument('--rows', type=int, default=15000)
+    prediction_parser.add_argument('--backend', default='gbc', choices=TRAINER_BACKENDS)
+
+    web_parser = subparsers.add_parser('web', help="Throughput of /prediction and /new_model")
+    web_parser.add_argument('--rows', type=int, default=15000)
+    web_parser.add_argument('--requests', type=int, default=200, help="Number of /prediction requests per case")
+    web_parser.add_argument('--jobs', type=int, default=4, help="Number of retraining jobs submitted")
+    web_parser.add_argument('--backend', default='gbc', choices=TRAINER_BACKENDS)
+
+    startup_parser = subparsers.add_parser('startup', help="Start gunicorn with and without preloading the app")
+    startup_parser.add_argument('--rows', type=int, default=15000)
+    startup_parser.add_argument('--workers', type=int, default=4)
+    startup_parser.add_argument('--app-dir', default=None, help="Checkout of the application to start, e.g. a "
+                                                                "worktree of another commit")
+
+    load_parser = subparsers.add_parser('load', help="Replay a mix of requests against gunicorn with each number and "
+                                                     "class of workers")
+    load_parser.add_argument('--rows', type=int, default=15000)
+    load_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    load_parser.add_argument('--worker-classes', nargs='+', default=list(WORKER_CLASSES), choices=WORKER_CLASSES)
+    load_parser.add_argument('--threads', type=int, default=4, help="Threads per worker, for gthread")
+    load_parser.add_argument('--clients', type=int, nargs='+', default=[16],
+                             help="Numbers of clients sending requests at the same time")
+    load_parser.add_argument('--mix', type=loadtest.parse_mix, default=loadtest.DEFAULT_MIX,
+                             help="Relative weight of each request type (default: {})".format(
+                                 loadtest.format_mix(loadtest.DEFAULT_MIX)))
+    load_parser.add_argument('--duration', type=float, default=30.0, help="Seconds to measure each combination for")
+    load_parser.add_argument('--warmup', type=float, default=5.0)
+    load_parser.add_argument('--preload', type=int, default=1, choices=[0, 1])
+    load_parser.add_argument('--app-dir', default=None, help="Checkout of the application to start, e.g. a "
+                                                             "worktree of another commit")
+
+    queries_parser = subparsers.add_parser('queries', help="Page through segments of the employee table")
+    queries_parser.add_argument('--rows', type=int, default=1500000)
+
+    feature_store_parser = subparsers.add_parser('feature_store', help="Memory held by the in-memory feature store, "
+                                                                          "Employee objects and data frames")
+    feature_store_parser.add_argument('--rows', type=int, default=1000000)
+    feature_store_parser.add_argument('--orm-max-rows', type=int, default=150000,
+                                      help="Measure Employee objects on at most this many employees, and scale up")
+
+    model_load_parser = subparsers.add_parser('model_load', help="Load published models from disk")
+    model_load_parser.add_argument('--rows', type=int, default=15000)
+    model_load_parser.add_argument('--backends', nargs='+', default=['gbc', 'hist'], choices=TRAINER_BACKENDS)
+
+    suite_parser = subparsers.add_parser('suite', help="Run the prediction, web, loader, queries and model_load "
+                                                          "benchmarks")
+    suite_parser.add_argument('--rows', type=int, default=15000)
+    suite_parser.add_argument('--backend', default='gbc', choices=TRAINER_BACKENDS)
+
+    for benchmark_parser in subparsers.choices.values():
+        benchmark_parser.add_argument('--output', default=None, help="Write the results to this JSON file")
+
+    compare_parser = subparsers.add_parser('compare', help="Compare two JSON results files")
+    compare_parser.add_argument('base', help="Results to compare against, e.g. from the previous commit")
+    compare_parser.add_argument('new', help="Newer results")
+
+    args = parser.parse_args()
+    if args.benchmark == 'loader':
+        benchmarks = {'loader': bench_loader(args.sizes, args.orm_max_rows)}
+    elif args.benchmark == 'backends':
+        benchmarks = {'backends': bench_backends(args.rows, args.backends, args.n_est)}
+    elif args.benchmark == 'inference':
+        benchmarks = {'inference': bench_inference(args.rows, args.backends, args.n_est)}
+    elif args.benchmark == 'prediction':
+        benchmarks = {'prediction': bench_prediction(args.rows, args.backend)}
+    elif args.benchmark == 'web':
+        benchmarks = {'web': bench_web(args.rows, args.requests, args.jobs, args.backend)}
+    elif args.benchmark == 'startup':
+        benchmarks = {'startup': bench_startup(args.rows, args.workers, app_dir=args.app_dir)}
+    elif args.benchmark == 'load':
+        benchmarks = {'load': bench_load(args.rows, args.workers, args.worker_classes, args.threads, args.clients,
+                                         args.mix, args.duration, args.warmup, args.preload, args.app_dir)}
+    elif args.benchmark == 'queries':
+        benchmarks = {'queries': bench_queries(args.rows)}
+    elif args.benchmark == 'feature_store':
+        benchmarks = {'feature_store': bench_feature_store(args.rows, args.orm_max_rows)}
+    elif args.benchmark == 'model_load':
+        benchmarks = {'model_load': bench_model_load(args.rows, args.backends)}
+    elif args.benchmark == 'suite':
+        benchmarks = run_suite(args.rows, args.backend)
+    elif args.benchmark == 'compare':
+        print_results(compare_results(args.base, args.new))
+        sys.exit()
+    else:
+        parser.print_help()
+        sys.exit()
+
+    for name, results in benchmarks.items():
+        print(name)
+        print_results(results)
+    if args.output:
+        write_results(args.output, benchmarks, vars(args))
+        print("Wrote results to {}".format(args.output))
@@ -0,0 +1,137 @@
+"""
+Map malformed text fields, such as department and salary band, onto their accepted values. The raw values in the HR
+data are a small vocabulary that repeats over and over, so once a term has been fuzzy matched the result is kept,
+either in a bounded cache or, for values seen in the data itself, in an alias table persisted to disk.
+"""
+
+import fcntl
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from jellyfish import jaro_winkler
+
+
+class Canonicalizer(object):
+    """
+    Resolve terms to the closest of a fixed set of options. Lookups go through, in order:
+    1. exact (or case-insensitive) matches of an option
+    2. the alias table of terms resolved before, which can be persisted with an AliasTable
+    3. a bounded LRU cache of recent fuzzy matches
+    4. Jaro-Winkler scoring against every option
+    """
+
+    def __init__(self, options, aliases=None, cache_size=1024):
+        """
+        :param options: Accepted field values
+        :param aliases: Dictionary of previously resolved terms to accepted values
+        :param cache_size: Max number of fuzzy matches to keep in the LRU cache
+        """
+        self.options = list(options)
+        self._exact = {o.lower(): o for o in self.options}
+        self._exact.update({o: o for o in self.options})
+        self.aliases = dict(aliases or {})
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.counts = {'exact': 0, 'alias': 0, 'cache': 0, 'scored': 0}
+
+    def __call__(self, term, learn=False):
+        """
+        :param term: Term to canonicalize
+        :param learn: Record a fuzzy match in the alias table, so that it is never scored again
+        :return: Closest accepted field value
+        """
+        match = self._exact.get(term)
+        if match is None:
+            match = self._exact.get(term.lower())
+        if match is not None:
+            self.counts['exact'] += 1
+            return match
+
+        match = self.aliases.get(term)
+        if match is not None:
+            self.counts['alias'] += 1
+            return match
+
+        with self._lock:
+            match = self._cache.get(term)
+            if match is not None:
+                self._cache.move_to_end(term)
+                self.counts['cache'] += 1
+            else:
+                match = self.score(term)
+                self.counts['scored'] += 1
+                self._cache[term] = match
+                if len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        if learn:
+            self.aliases[term] = match
+        return match
+
+    def score(self, term):
+        """
+        Fuzzy match a term against every option, skipping all lookups.
+
+        :param term: Term to fuzzy match
+        :return: Closest accepted field value
+        """
+        scores = [jaro_winkler(term.lower(), o.lower()) for o in self.options]
+        return self.options[np.argmax(scores)]
+
+    def canonicalize(self, terms, learn=True):
+        """
+        Canonicalize a whole column at once. Terms are deduplicated first, so each distinct value is resolved once
+        and the results are mapped back onto the rows.
+
+        :param terms: Series of terms to canonicalize
+        :param learn: Record fuzzy matches in the alias table
+        :return: Series of accepted field values
+        """
+        codes, uniques = pd.factorize(terms.astype(str))
+        matches = np.array([self(term, learn=learn) for term in uniques], dtype=object)
+        return pd.Series(matches[codes], index=terms.index, dtype=object)
+
+
+class AliasTable(object):
+    """
+    JSON file holding the learned aliases of a set of canonicalizers, keyed by field name, so that they are shared
+    between processes and survive restarts.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """
+        :return: Dictionary of field name to aliases, empty if nothing has been saved yet
+        """
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def save(self, canonicalizers):
+        """
+        Merge the aliases of the canonicalizers with those already on disk, and write them out atomically.
+
+        :param canonicalizers: Dictionary of field name to Canonicalizer
+        :return: None
+        """
+        # hold a lock across the read and the write, as several workers may learn new spellings at once
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            table = self.load()
+            for field, canonicalizer in canonicalizers.items():
+                table.setdefault(field, {}).update(canonicalizer.aliases)
+                canonicalizer.aliases.update(table[field])
+
+            tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(table, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
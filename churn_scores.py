@@ -0,0 +1,164 @@
+"""
+Keep a churn score for every employee in the churn_scores table, so that predictions for known employees are a
+primary key lookup, and questions about the whole workforce (e.g. who is most at risk in each department) are an
+index scan rather than scoring everyone.
+
+Scores are refreshed in batches. Only stale rows are rescored: employees without a score, such as those added since
+the last refresh, and those scored by a model other than the current one. A refresh runs after every retraining job,
+and can be run on a schedule, or kept running in the background, as main method:
+    $ python churn_scores.py
+    $ python churn_scores.py --every 300
+"""
+
+import argparse
+import datetime
+import time
+from collections import OrderedDict
+
+import pandas as pd
+from sqlalchemy import func, or_
+
+import metrics
+from HRmodel import DEPARTMENT_OPTIONS, FEATURES, predict_employee_churn_batch
+from database_operations import BATCH_SIZE, canonicalize_df, get_session
+from model_registry import registry
+from sqlite_declarative import ChurnScore, Employee
+
+
+def iter_stale_frames(version, chunksize=BATCH_SIZE):
+    """
+    Stream the employees whose score is missing or was made by another model version, in fixed size chunks.
+
+    :param version: Version of the model scores should come from
+    :param chunksize: Number of employees per chunk
+    :return: Generator of data frames holding Emp_ID and the model features
+    """
+    columns = [Employee.Emp_ID] + [getattr(Employee, f) for f in FEATURES]
+    colnames = ["Emp_ID"] + FEATURES
+    session = get_session()
+
+    last_id = None
+    while True:
+        query = session.query(*columns).outerjoin(ChurnScore, ChurnScore.Emp_ID == Employee.Emp_ID) \
+            .filter(or_(ChurnScore.Emp_ID.is_(None), ChurnScore.model_version != version))
+        if last_id is not None:
+            query = query.filter(Employee.Emp_ID > last_id)
+        rows = query.order_by(Employee.Emp_ID).limit(chunksize).all()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield canonicalize_df(pd.DataFrame.from_records(rows, columns=colnames))
+
+
+def refresh_churn_scores(version=None, chunksize=BATCH_SIZE):
+    """
+    Rescore every stale employee, one chunk at a time. Each chunk is committed on its own, so readers see scores as
+    they come in and the database is never locked for long.
+
+    :param version: Version of the model to score with. Will use the most recent model if not provided.
+    :param chunksize: Number of employees scored at a time
+    :return: Dictionary of the model version and the number of employees rescored
+    """
+    if version is None:
+        version, GB, d = registry.get()
+    else:
+        version, GB, d = registry.load(version)
+
+    session = get_session()
+    n_rows = 0
+    for frame in iter_stale_frames(version, chunksize):
+        results = predict_employee_churn_batch(frame, GB, d, version)
+        now = datetime.datetime.now()
+        records = [{
+            'Emp_ID': int(emp_id),
+            'model_version': version,
+            'probability': float(probability),
+            'label': int(label),
+            'department': department,
+            'scored_at': now
+        } for emp_id, probability, label, department in zip(
+            results['Emp_ID'], results['churn_probability'], results['prediction'], frame['department'])]
+
+        try:
+            session.query(ChurnScore).filter(ChurnScore.Emp_ID.in_([r['Emp_ID'] for r in records])) \
+                .delete(synchronize_session=False)
+            session.execute(ChurnScore.__table__.insert(), records)
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        n_rows += len(records)
+    return {'version': version, 'n_rows': n_rows}
+
+
+@metrics.timed('get_churn_score')
+def get_churn_score(Emp_ID, version=None):
+    """
+    :param Emp_ID: Employee ID number
+    :param version: Version of the model the score must come from. Will use the most recent model if not provided.
+    :return: ChurnScore of the employee, or None if they haven't been scored by that model yet
+    """
+    if version is None:
+        version = registry.current_version()
+    score = get_session().query(ChurnScore).filter(ChurnScore.Emp_ID == Emp_ID).first()
+    if score is None or score.model_version != version:
+        return None
+    return score
+
+
+def top_at_risk(n=10, department=None, version=None):
+    """
+    Get the employees most likely to leave, according to the most recent model.
+
+    :param n: Number of employees
+    :param department: Only consider employees of this department, one of HRmodel.DEPARTMENT_OPTIONS
+    :param version: Version of the model scores should come from. Will use the most recent model if not provided.
+    :return: List of ChurnScore, highest probability first
+    """
+    if version is None:
+        version = registry.current_version()
+    query = get_session().query(ChurnScore).filter(ChurnScore.model_version == version)
+    if department is not None:
+        query = query.filter(ChurnScore.department == department)
+    return query.order_by(ChurnScore.probability.desc()).limit(n).all()
+
+
+def top_at_risk_by_department(n=10, version=None):
+    """
+    :param n: Number of employees per department
+    :param version: Version of the model scores should come from. Will use the most recent model if not provided.
+    :return: Ordered dictionary of department to the list of its n most at risk employees
+    """
+    if version is None:
+        version = registry.current_version()
+    return OrderedDict((department, top_at_risk(n, department, version)) for department in DEPARTMENT_OPTIONS)
+
+
+def score_coverage(version=None):
+    """
+    :param version: Version of the model scores should come from. Will use the most recent model if not provided.
+    :return: Number of employees scored by that model, and the total number of employees
+    """
+    if version is None:
+        version = registry.current_version()
+    session = get_session()
+    n_scored = session.query(func.count(ChurnScore.Emp_ID)).filter(ChurnScore.model_version == version).scalar()
+    n_employees = session.query(func.count(Employee.Emp_ID)).scalar()
+    return n_scored, n_employees
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunksize', type=int, default=BATCH_SIZE, help="Number of employees scored at a time")
+    parser.add_argument('--every', type=float, default=None,
+                        help="Keep running, refreshing every this many seconds, rather than refreshing once")
+    args = parser.parse_args()
+
+    while True:
+        start = time.time()
+        result = refresh_churn_scores(chunksize=args.chunksize)
+        print("Rescored {} employees with model {} in {:.2f}s".format(result['n_rows'], result['version'],
+                                                                       time.time() - start))
+        if args.every is None:
+            break
+        time.sleep(args.every)
@@ -0,0 +1,100 @@
+"""
+Settings for the application and its database connections. Each can be overridden with an environment variable of
+the same name, prefixed with HR_ (e.g. HR_DATABASE_URL), so deployments don't need to edit the code.
+"""
+
+import os
+
+
+def _env(name, default, cast=str):
+    value = os.environ.get('HR_' + name)
+    return default if value is None else cast(value)
+
+
+# Database connection
+DATABASE_URL = _env('DATABASE_URL', 'sqlite:///HR_sqlite.db')
+
+# Connection pool, shared by all requests handled within a process
+DB_POOL_SIZE = _env('DB_POOL_SIZE', 5, int)
+DB_MAX_OVERFLOW = _env('DB_MAX_OVERFLOW', 10, int)
+DB_POOL_TIMEOUT = _env('DB_POOL_TIMEOUT', 30, int)
+DB_POOL_RECYCLE = _env('DB_POOL_RECYCLE', 3600, int)
+
+# Applied to every new SQLite connection. WAL lets readers carry on while a writer commits, and a negative
+# cache_size is in KiB rather than pages.
+SQLITE_PRAGMAS = {
+    'journal_mode': _env('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': _env('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'mmap_size': _env('SQLITE_MMAP_SIZE', 256 * 1024 * 1024, int),
+    'cache_size': _env('SQLITE_CACHE_SIZE', -64 * 1024, int),
+}
+
+# Learned spellings of department and salary band values, shared by all processes
+ALIAS_PATH = _env('ALIAS_PATH', 'aliases.json')
+
+# Background retraining. Job status files are kept on disk, so that any worker can report on any job, and at most
+# MAX_TRAINING_JOBS fits run at once across every worker.
+JOB_DIR = _env('JOB_DIR', 'jobs')
+MAX_TRAINING_JOBS = _env('MAX_TRAINING_JOBS', 2, int)
+
+# Library used to train new models, one of HRmodel.TRAINER_BACKENDS, and the number of threads xgboost may use
+TRAINER_BACKEND = _env('TRAINER_BACKEND', 'gbc')
+TRAINER_N_JOBS = _env('TRAINER_N_JOBS', -1, int)
+
+# Prediction and employee feature caches, shared by all processes through one SQLite file. Sizes are numbers of
+# entries, and time to live is in seconds.
+CACHE_PATH = _env('CACHE_PATH', 'cache.db')
+PREDICTION_CACHE_SIZE = _env('PREDICTION_CACHE_SIZE', 10000, int)
+PREDICTION_CACHE_TTL = _env('PREDICTION_CACHE_TTL', 24 * 3600, int)
+EMPLOYEE_CACHE_SIZE = _env('EMPLOYEE_CACHE_SIZE', 10000, int)
+EMPLOYEE_CACHE_TTL = _env('EMPLOYEE_CACHE_TTL', 3600, int)
+
+# Hold every employee's features in memory, in each process, rather than reading them from the database (see
+# feature_store.py). Worth it when lookups and retrains are frequent and the table fits in memory, at about 43 MB per
+# million employees.
+FEATURE_STORE = _env('FEATURE_STORE', 0, int)
+# Employees written in place are appended here, for every process's store to read them again
+FEATURE_STORE_JOURNAL = _env('FEATURE_STORE_JOURNAL', 'feature_store.journal')
+
+# Inference server, which scores single employees for every web worker. Web workers only hand scoring off to it when
+# INFERENCE_SOCKET is set, and score locally if it can't be reached.
+INFERENCE_SOCKET = _env('INFERENCE_SOCKET', '')
+INFERENCE_TIMEOUT = _env('INFERENCE_TIMEOUT', 5.0, float)
+INFERENCE_WORKERS = _env('INFERENCE_WORKERS', os.cpu_count() or 1, int)
+# Requests arriving within this many seconds of each other are scored together, up to this many employees
+INFERENCE_MAX_WAIT = _env('INFERENCE_MAX_WAIT', 0.002, float)
+INFERENCE_MAX_BATCH = _env('INFERENCE_MAX_BATCH', 1024, int)
+
+# Cross-validated search over boosting parameters, run when retraining with tuning. Candidates are fit in parallel on
+# this many cores.
+TUNING_FOLDS = _env('TUNING_FOLDS', 5, int)
+TUNING_N_JOBS = _env('TUNING_N_JOBS', -1, int)
+
+# Request and stage timings. Each process writes its latency histograms to a file in METRICS_DIR, for /metrics to add
+# up. Requests taking at least SLOW_REQUEST_SECONDS are written to SLOW_REQUEST_LOG, unless it is 0.
+METRICS_DIR = _env('METRICS_DIR', 'metrics')
+SLOW_REQUEST_SECONDS = _env('SLOW_REQUEST_SECONDS', 0.0, float)
+SLOW_REQUEST_LOG = _env('SLOW_REQUEST_LOG', 'slow_requests.log')
+
+# Drift of incoming employees and churn scores from what the current model was trained on. Each process writes its
+# counts to a file in DRIFT_DIR. A feature or the scores count as shifting at a population stability index of
+# DRIFT_PSI_WARN, and as drifted, so that a retrain is recommended, at DRIFT_PSI_ALERT, once there are at least
+# DRIFT_MIN_OBSERVATIONS employees to go on.
+DRIFT_DIR = _env('DRIFT_DIR', 'drift')
+DRIFT_PSI_WARN = _env('DRIFT_PSI_WARN', 0.1, float)
+DRIFT_PSI_ALERT = _env('DRIFT_PSI_ALERT', 0.25, float)
+DRIFT_MIN_OBSERVATIONS = _env('DRIFT_MIN_OBSERVATIONS', 500, int)
+
+# Web workers. With PRELOAD, the app is built in the gunicorn master, which imports everything and loads the current
+# model before forking the workers, so that they share that memory. Without it, each worker loads what it needs on its
+# first request. Each worker of the gthread class serves WEB_THREADS requests at a time, see `benchmarks.py load` for
+# measuring which class and how many workers suit a machine.
+WEB_BIND = _env('WEB_BIND', '0.0.0.0:8080')
+WEB_WORKERS = _env('WEB_WORKERS', 2 * (os.cpu_count() or 1) + 1, int)
+WEB_WORKER_CLASS = _env('WEB_WORKER_CLASS', 'sync')
+WEB_THREADS = _env('WEB_THREADS', 1, int)
+PRELOAD = _env('PRELOAD', 1, int)
+
+# JSON API, served by aiohttp alongside the web workers. Employees are scored on this many processes.
+API_PORT = _env('API_PORT', 8081, int)
+API_SCORING_WORKERS = _env('API_SCORING_WORKERS', os.cpu_count() or 1, int)
@@ -4,32 +4,145 @@ Helper functions for querying and writing to the SQLite database
 
 import os
 import sys
-from sqlalchemy import create_engine, func, funcfilter
-from sqlalchemy.orm import sessionmaker
+import threading
+from sqlalchemy import create_engine, event, func, funcfilter
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 from jellyfish import jaro_winkler
 import pandas as pd
 import numpy as np
 
 
-from sqlite_declarative import Employee, Base
-from HRmodel import FEATURES, DEPARTMENT_OPTIONS, SALARY_OPTIONS
+import config
+import drift
+import feature_store
+import metrics
+import prediction_cache
+from canonicalizer import AliasTable, Canonicalizer
+from sqlite_declarative import ChurnScore, Employee, Base
+from schema import FEATURES, DEPARTMENT_OPTIONS, SALARY_OPTIONS
 
 
-def get_session(database_address):
+# Resolve malformed department and salary values, remembering every spelling found in the data
+alias_table = AliasTable(config.ALIAS_PATH)
+_aliases = alias_table.load()
+CANONICALIZERS = {
+    'department': Canonicalizer(DEPARTMENT_OPTIONS, _aliases.get('department')),
+    'salary': Canonicalizer(SALARY_OPTIONS, _aliases.get('salary'))
+}
+_CANONICALIZERS_BY_OPTIONS = {tuple(c.options): c for c in CANONICALIZERS.values()}
+
+# Number of employees pulled from the database (or a posted payload) at a time when scoring in bulk
+BATCH_SIZE = 5000
+
+
+# One engine, and so one connection pool, per process. It is created on first use rather than at import time, and
+# recreated if the process has forked since, so that child processes never share connections with their parent.
+_engine = None
+_engine_pid = None
+_engine_lock = threading.Lock()
+
+# Sessions are scoped to the current thread, i.e. to the request being handled, and removed on request teardown.
+# Objects keep their loaded attributes after a commit, so they can still be read once the session is gone.
+Session = scoped_session(sessionmaker(expire_on_commit=False))
+
+
+def get_engine():
+    """
+    Get the engine for the configured database, creating it the first time it is needed in this process.
+
+    :return: Engine object
     """
-    Helper function for instantiating a database session.
+    global _engine, _engine_pid
+    if _engine is not None and _engine_pid != os.getpid():
+        dispose_engine(close=False)
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = _create_engine(config.DATABASE_URL)
+                _engine_pid = os.getpid()
+                Base.metadata.bind = _engine
+                Session.configure(bind=_engine)
+                # databases built before the churn_scores table was added don't have it yet
+                ChurnScore.__table__.create(_engine, checkfirst=True)
+    return _engine
+
+
+def _create_engine(database_address):
+    """
+    Create an engine with the configured connection pool. SQLite connections get the configured pragmas applied as
+    they are opened.
 
     :param database_address: Address of the database
+    :return: Engine object
+    """
+    url = make_url(database_address)
+    if url.drivername.startswith('sqlite') and url.database in (None, '', ':memory:'):
+        # an in-memory database only exists within its one connection, so keep sqlalchemy's default pool
+        return create_engine(database_address)
+
+    kwargs = dict(poolclass=QueuePool,
+                  pool_size=config.DB_POOL_SIZE,
+                  max_overflow=config.DB_MAX_OVERFLOW,
+                  pool_timeout=config.DB_POOL_TIMEOUT,
+                  pool_recycle=config.DB_POOL_RECYCLE)
+    if url.drivername.startswith('sqlite'):
+        # pooled connections get handed between threads, but never used by two at once
+        kwargs['connect_args'] = {'check_same_thread': False}
+    engine = create_engine(database_address, **kwargs)
+
+    if engine.dialect.name == 'sqlite':
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma, value in config.SQLITE_PRAGMAS.items():
+                cursor.execute('PRAGMA {}={}'.format(pragma, value))
+            cursor.close()
+
+    return engine
+
+
+def dispose_engine(close=True):
+    """
+    Forget the engine and its pooled connections, so that the next use opens new ones.
+
+    :param close: Close the pooled connections. Pass False in a forked child process, whose inherited connections
+        still belong to the parent and must be left alone.
+    :return: None
+    """
+    global _engine
+    if close:
+        Session.remove()
+        if _engine is not None:
+            _engine.dispose()
+    else:
+        Session.registry.clear()
+    _engine = None
+
+
+def get_session():
+    """
+    Helper function for getting the database session of the current thread.
+
     :return: Session object
     """
-    engine = create_engine(database_address)
-    Base.metadata.bind = engine
-    DBSession = sessionmaker(bind=engine)
-    session = DBSession()
-    return session
+    get_engine()
+    return Session()
+
+
+def remove_session(exception=None):
+    """
+    Close the session of the current thread, returning its connection to the pool. Called on request teardown.
+
+    :param exception: Exception that ended the request, if any
+    :return: None
+    """
+    Session.remove()
 
 
+@metrics.timed('get_employee_by_id')
 def get_employee_by_id(Emp_ID):
     """
     Ideally, we can generalize this to allow for querying employees by any of their features
@@ -37,12 +150,35 @@ def get_employee_by_id(Emp_ID):
     :param Emp_ID: Employee ID number
     :return: employee record or empty if employee not found.
     """
-    session = get_session('sqlite:///HR_sqlite.db')
+    session = get_session()
     employee = session.query(Employee).filter(Employee.Emp_ID == Emp_ID).first()
-    session.commit()
     return employee
 
 
+@metrics.timed('get_employee_features')
+def get_employee_features(Emp_ID):
+    """
+    Look up the model features of an employee, with string fields fuzzy matched. Served from the in-memory feature
+    store if it is enabled, and otherwise only goes to the database if the employee isn't in the shared employee
+    feature cache.
+
+    :param Emp_ID: Employee ID number
+    :return: List of feature values in model feature order, or None if employee not found.
+    """
+    if feature_store.enabled():
+        return feature_store.store.lookup(int(Emp_ID))
+
+    key = str(Emp_ID)
+    features = prediction_cache.employee_features.get(key)
+    if features is None:
+        employee = get_employee_by_id(Emp_ID)
+        if employee is None:
+            return None
+        features = employee_to_df(employee).iloc[0].tolist()
+        prediction_cache.employee_features.set(key, features)
+    return features
+
+
 def get_employees_by_max_id(Emp_ID):
     """
     Get a set of all employees, up to a nax enmoloyee ID, for use in retraining model.
@@ -50,12 +186,39 @@ def get_employees_by_max_id(Emp_ID):
     :param Emp_ID: MAx employee ID considered
     :return: Set of employees
     """
-    session = get_session('sqlite:///HR_sqlite.db')
+    session = get_session()
     employees = session.query(Employee).filter(Employee.Emp_ID <= Emp_ID).all()
-    session.commit()
     return employees
 
 
+def load_employees_df(Emp_ID=None, chunksize=None, min_Emp_ID=None):
+    """
+    Load all employees, up to a max employee ID, straight into a data frame for use in retraining the model. Only
+    the needed columns are read, with a single query, and no Employee objects are built along the way. String fields
+    are fuzzy matched once per distinct value rather than once per row.
+
+    :param Emp_ID: Max employee ID considered. Will load every employee if not provided.
+    :param chunksize: If provided, read this many rows at a time to bound the memory used by intermediate results
+    :param min_Emp_ID: If provided, only load employees with a greater ID, e.g. those added since the last retrain
+    :return: Data frame with the same columns as employee_group_to_df
+    """
+    columns = [Employee.Emp_ID] + [getattr(Employee, f) for f in FEATURES] + [Employee.left]
+    query = get_session().query(*columns)
+    if Emp_ID is not None:
+        query = query.filter(Employee.Emp_ID <= Emp_ID)
+    if min_Emp_ID is not None:
+        query = query.filter(Employee.Emp_ID > min_Emp_ID)
+    query = query.order_by(Employee.Emp_ID)
+
+    if chunksize is None:
+        return canonicalize_df(pd.read_sql(query.statement, get_engine()))
+
+    chunks = [canonicalize_df(chunk) for chunk in pd.read_sql(query.statement, get_engine(), chunksize=chunksize)]
+    if not chunks:
+        return pd.DataFrame(columns=["Emp_ID"] + FEATURES + ["left"])
+    return pd.concat(chunks, ignore_index=True)
+
+
 def employee_to_df(employee):
     """
     Wnen given an Employee instance, return observation in the form of a data frame. Fuzzy match appropriate fields.
@@ -108,13 +271,124 @@ def employee_group_to_df(employees):
     return pd.DataFrame(payload, columns=colnames)
 
 
+def iter_employee_frames(emp_ids=None, min_id=None, max_id=None, chunksize=BATCH_SIZE):
+    """
+    Stream employees out of the database in fixed size chunks, either for a list of employee IDs or for a range of
+    them. Only the columns used by the model are read, and string fields are fuzzy matched per chunk.
+
+    :param emp_ids: Employee ID numbers to look up. Takes precedence over the ID range.
+    :param min_id: Smallest employee ID considered, inclusive
+    :param max_id: Largest employee ID considered, inclusive
+    :param chunksize: Number of employees per chunk
+    :return: Generator of data frames holding Emp_ID and the model features
+    """
+    columns = [Employee.Emp_ID] + [getattr(Employee, f) for f in FEATURES]
+    colnames = ["Emp_ID"] + FEATURES
+    session = get_session()
+
+    if emp_ids is not None:
+        emp_ids = sorted(set(emp_ids))
+        for start in range(0, len(emp_ids), chunksize):
+            chunk = emp_ids[start:start + chunksize]
+            rows = session.query(*columns).filter(Employee.Emp_ID.in_(chunk)).order_by(Employee.Emp_ID).all()
+            yield canonicalize_df(pd.DataFrame.from_records(rows, columns=colnames))
+        return
+
+    # keyset pagination, so that every chunk is an index range scan on the primary key
+    last_id = min_id - 1 if min_id is not None else None
+    while True:
+        query = session.query(*columns)
+        if last_id is not None:
+            query = query.filter(Employee.Emp_ID > last_id)
+        if max_id is not None:
+            query = query.filter(Employee.Emp_ID <= max_id)
+        rows = query.order_by(Employee.Emp_ID).limit(chunksize).all()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield canonicalize_df(pd.DataFrame.from_records(rows, columns=colnames))
+
+
+def iter_csv_frames(csv_file, chunksize=BATCH_SIZE, learn=False):
+    """
+    Stream employees out of a CSV file in fixed size chunks. The file must have a column for each model feature, and
+    may have an Emp_ID column.
+
+    :param csv_file: Path or file-like object holding the CSV
+    :param chunksize: Number of employees per chunk
+    :param learn: Add new spellings to the persisted alias table. Leave off for files posted by clients, which could
+        otherwise grow the table without limit.
+    :return: Generator of data frames holding the model features
+    :raises ValueError: As chunks are read, if the file is missing a model feature
+    """
+    for chunk in pd.read_csv(csv_file, header=0, chunksize=chunksize):
+        check_features(chunk)
+        yield canonicalize_df(chunk, learn)
+
+
+def iter_record_frames(records, chunksize=BATCH_SIZE, learn=False):
+    """
+    Split a list of employee records, such as a posted JSON payload, into data frames of a fixed size. Every record
+    is checked up front, so that bad input fails before any of it is scored.
+
+    :param records: List of dictionaries, each with a key for every model feature and optionally Emp_ID
+    :param chunksize: Number of employees per chunk
+    :param learn: Add new spellings to the persisted alias table. Leave off for records posted by clients.
+    :return: Generator of data frames holding the model features
+    :raises ValueError: If records isn't a list of dictionaries, or a record is missing a model feature
+    """
+    if not isinstance(records, list):
+        raise ValueError("Expected a list of employee records")
+    for i, record in enumerate(records):
+        if not isinstance(record, dict):
+            raise ValueError("Employee record {} is not an object".format(i))
+        missing = [f for f in FEATURES if f not in record]
+        if missing:
+            raise ValueError("Employee record {} is missing {}".format(i, ', '.join(missing)))
+
+    def generate():
+        for start in range(0, len(records), chunksize):
+            yield canonicalize_df(pd.DataFrame.from_records(records[start:start + chunksize]), learn)
+
+    return generate()
+
+
+def check_features(df):
+    """
+    :param df: Data frame of employees
+    :return: None
+    :raises ValueError: If the data frame is missing a column for any model feature
+    """
+    missing = [f for f in FEATURES if f not in df.columns]
+    if missing:
+        raise ValueError("Employees are missing the columns {}".format(', '.join(missing)))
+
+
+def canonicalize_df(df, learn=True):
+    """
+    Fuzzy match the string fields of a data frame of employees, in place. Unless learn is off, any new spellings found
+    are added to the persisted alias table.
+
+    :param df: Data frame with department and salary columns
+    :param learn: Add new spellings to the alias table. Only for data already in, or going into, the database, never
+        for input from clients, who could otherwise grow the table without limit.
+    :return: Data frame with accepted field values
+    """
+    n_aliases = sum(len(c.aliases) for c in CANONICALIZERS.values())
+    for field, canonicalizer in CANONICALIZERS.items():
+        df[field] = canonicalizer.canonicalize(df[field], learn=learn)
+
+    if sum(len(c.aliases) for c in CANONICALIZERS.values()) > n_aliases:
+        alias_table.save(CANONICALIZERS)
+    return df
+
+
 def get_max_id():
     """
     :return: Maximum employee ID from database, for use in adding new employees
     """
-    session = get_session('sqlite:///HR_sqlite.db')
-    max_id = session.query(Employee, func.max(Employee.Emp_ID)).first()[1]
-    session.commit()
+    session = get_session()
+    max_id = session.query(func.max(Employee.Emp_ID)).scalar()
     return max_id
 
 
@@ -144,42 +418,75 @@ def add_employee(Emp_ID=None, satisfaction_level=None, last_evaluation=None, num
     salary = fuzzy_match(salary, SALARY_OPTIONS)
 
     # auto increment employee ID
+    overwrite = Emp_ID is not None
     if Emp_ID is None:
-        Emp_ID = get_max_id() + 1
+        Emp_ID = (get_max_id() or 0) + 1
 
-    # record employee information
-    session = get_session('sqlite:///HR_sqlite.db')
+    # record employee information, replacing any current employee with the same ID
+    session = get_session()
     try:
-        session.add(Emp_ID=Emp_ID,
-                    satisfaction_level=satisfaction_level,
-                    last_evaluation=last_evaluation,
-                    number_project=number_project,
-                    average_montly_hours=average_montly_hours,
-                    time_spend_company=time_spend_company,
-                    Work_accident=Work_accident,
-                    promotion_last_5years=promotion_last_5years,
-                    department=department, salary=salary, left=left
-                    )
+        session.merge(Employee(Emp_ID=Emp_ID,
+                               satisfaction_level=satisfaction_level,
+                               last_evaluation=last_evaluation,
+                               number_project=number_project,
+                               average_montly_hours=average_montly_hours,
+                               time_spend_company=time_spend_company,
+                               Work_accident=Work_accident,
+                               promotion_last_5years=promotion_last_5years,
+                               department=department, salary=salary, left=left
+                               ))
+        # drop any score of an overwritten employee, so that the churn score refresher picks it up again
+        session.query(ChurnScore).filter(ChurnScore.Emp_ID == Emp_ID).delete(synchronize_session=False)
+        session.commit()
     except Exception:
+        session.rollback()
         return False
 
-    session.commit()
+    # an overwritten employee must not be served from the cache, or from any process's feature store
+    if overwrite:
+        feature_store.record_writes([Emp_ID])
+    prediction_cache.employee_features.delete(str(Emp_ID))
+    drift.monitor.observe('incoming', [[satisfaction_level, last_evaluation, number_project, average_montly_hours,
+                                        time_spend_company, Work_accident, promotion_last_5years, department,
+                                        salary]])
     return True
 
 
+@metrics.timed('fuzzy_match')
 def fuzzy_match(term, options):
     """
-    Helper function for fuzzy matching malformed text fields
+    Helper function for fuzzy matching malformed text fields. Department and salary values go through their
+    canonicalizer, so that repeated terms are not scored again.
 
     :param term: Term to fuzzy match
     :param options: Accepted field values for column of given term
     :return: Closest accepted field value
     """
+    canonicalizer = _CANONICALIZERS_BY_OPTIONS.get(tuple(options))
+    if canonicalizer is not None:
+        return canonicalizer(term)
+
     scores = [jaro_winkler(term.lower(), o.lower()) for o in options]
     closest = options[np.argmax(scores)]
     return closest
 
 
+def fuzzy_match_series(terms, options):
+    """
+    Fuzzy match a whole column at once. Each distinct value is only scored once, and the results are mapped back.
+
+    :param terms: Series of terms to fuzzy match
+    :param options: Accepted field values for column of given terms
+    :return: Series of closest accepted field values
+    """
+    canonicalizer = _CANONICALIZERS_BY_OPTIONS.get(tuple(options))
+    if canonicalizer is not None:
+        return canonicalizer.canonicalize(terms, learn=False)
+
+    matches = {term: fuzzy_match(term, options) for term in terms.astype(str).unique()}
+    return terms.astype(str).map(matches)
+
+
 def clip_numeric(val, min_val=None, max_val=None):
     """
     Helper function for keeping search and input terms in bounds.
@@ -0,0 +1,346 @@
+"""
+Watch for the employees coming in, and the churn scores going out, drifting away from what the current model was
+trained on, so that we know when it is time to retrain rather than retraining blindly.
+
+Every fully retrained model is published with a reference histogram of each of its features, over the employees it
+was trained on, and of the churn scores it gave its held out test set. Numeric features are binned at deciles of the
+training data, or at each value if they only take a few, and department and salary get a bin per value.
+
+Each process then counts the employees added to the database ('incoming') and the employees it scores ('scored'),
+along with their scores, into the same bins. That takes a fixed handful of counters per feature, however many
+employees go by, and like the request timings in metrics.py, every process writes its counts to a file of its own in
+config.DRIFT_DIR, which a report adds up. Drift is measured on demand from the counts alone, with the population
+stability index (PSI) and, for ordered features, the largest gap between the cumulative distributions (a binned
+Kolmogorov-Smirnov statistic), without reading the employee table again.
+
+Run as main method to print the report, e.g. from cron. Exits with status 1 if a retrain is recommended:
+    $ python drift.py
+"""
+
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+import config
+from schema import FEATURES, NONNUMERIC_COLUMNS
+
+
+STREAMS = ('incoming', 'scored')
+
+# Name under which the churn scores of the scored stream are counted
+SCORES = 'churn_probability'
+
+# Numeric features are binned at these quantiles of the training data, unless they take few enough values to give
+# each its own bin
+N_QUANTILE_BINS = 10
+
+# Inner edges of the churn score bins
+SCORE_EDGES = [round(0.1 * i, 1) for i in range(1, 10)]
+
+# Floor on the share of a bin, so that an empty bin doesn't make the PSI infinite
+EPSILON = 1e-4
+
+# Seconds between writes of this process's counts to the drift directory
+FLUSH_INTERVAL = 5.0
+
+
+def _bin_edges(values):
+    """
+    :param values: Values of a numeric feature in the training data
+    :return: Inner edges of its bins: halfway between each value if it takes few values, otherwise at its deciles,
+        each moved up to halfway to the next value
+    """
+    distinct = np.unique(values)
+    if len(distinct) <= 2 * N_QUANTILE_BINS:
+        return ((distinct[1:] + distinct[:-1]) / 2.).tolist()
+    deciles = np.percentile(values, np.linspace(0, 100, N_QUANTILE_BINS + 1)[1:-1])
+    # a decile is often a value itself. Models trained from the feature store see it as float32, and the employees
+    # observed later as float64, which can fall on the other side of it, so move the edge off the value
+    above = np.searchsorted(distinct, deciles, side='right')
+    inner = above < len(distinct)
+    deciles[inner] = (distinct[above[inner] - 1] + distinct[above[inner]]) / 2.
+    return np.unique(deciles).tolist()
+
+
+def reference_histograms(df, scores, d=None):
+    """
+    Describe the population a model was trained on, for publishing with the model.
+
+    :param df: Data frame of the employees the model was trained on, with department and salary either by name or,
+        given d, as label encoded codes
+    :param scores: Churn probabilities the model gave its held out test set
+    :param d: Lookup table for label encoding, if department and salary are encoded
+    :return: Dictionary of the bins and counts of each feature, and of the scores
+    """
+    features = {}
+    for feature in FEATURES:
+        if feature in NONNUMERIC_COLUMNS:
+            if d is not None and df[feature].dtype.kind in 'iuf':
+                categories = [str(c) for c in d[feature].classes_]
+                counts = np.bincount(df[feature].values.astype(int), minlength=len(categories))
+            else:
+                value_counts = df[feature].value_counts()
+                categories = sorted(str(c) for c in value_counts.index)
+                counts = [value_counts[c] for c in categories]
+            # the last bin counts values the model wasn't trained on
+            features[feature] = {'categories': categories, 'counts': [int(c) for c in counts] + [0]}
+        else:
+            values = np.asarray(df[feature].values, dtype=np.float64)
+            edges = _bin_edges(values)
+            counts = np.bincount(np.searchsorted(edges, values, side='right'), minlength=len(edges) + 1)
+            features[feature] = {'edges': edges, 'counts': counts.tolist()}
+
+    scores = np.asarray(scores, dtype=np.float64)
+    score_counts = np.bincount(np.searchsorted(SCORE_EDGES, scores, side='right'), minlength=len(SCORE_EDGES) + 1)
+    return {'n_rows': len(df), 'features': features, 'scores': {'edges': SCORE_EDGES, 'counts': score_counts.tolist()}}
+
+
+def psi(expected, actual):
+    """
+    :param expected: Counts per bin of the reference population
+    :param actual: Counts per bin of the observed population
+    :return: Population stability index: under 0.1 is usually read as stable, over 0.25 as a significant shift
+    """
+    e = np.maximum(np.asarray(expected, dtype=np.float64) / max(np.sum(expected), 1), EPSILON)
+    a = np.maximum(np.asarray(actual, dtype=np.float64) / max(np.sum(actual), 1), EPSILON)
+    return float(np.sum((a - e) * np.log(a / e)))
+
+
+def ks(expected, actual):
+    """
+    :param expected: Counts per bin of the reference population, with the bins in order
+    :param actual: Counts per bin of the observed population
+    :return: Largest gap between the two cumulative distributions, as measured at the bin edges
+    """
+    e = np.cumsum(expected) / float(max(np.sum(expected), 1))
+    a = np.cumsum(actual) / float(max(np.sum(actual), 1))
+    return float(np.max(np.abs(a - e)))
+
+
+def status_of(psi_value, observations):
+    """
+    :return: How a drift score reads: 'not enough data', 'stable', 'shifting' or 'drifted'
+    """
+    if observations < config.DRIFT_MIN_OBSERVATIONS:
+        return 'not enough data'
+    if psi_value >= config.DRIFT_PSI_ALERT:
+        return 'drifted'
+    if psi_value >= config.DRIFT_PSI_WARN:
+        return 'shifting'
+    return 'stable'
+
+
+class DriftMonitor(object):
+    """
+    Counts of the employees and scores seen by this process in the bins of the current model's reference, kept by
+    model version and stream.
+    """
+
+    def __init__(self, directory=config.DRIFT_DIR):
+        """
+        :param directory: Directory each process writes its counts to
+        """
+        self.directory = directory
+        self._counts = {}  # (version, stream, name) -> array of counts per bin
+        self._references = {}  # version -> reference histograms, or None for models published without them
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._last_flush = 0.0
+
+    def _check_fork(self):
+        # a forked process starts with a copy of its parent's counts, which the parent already reports
+        if os.getpid() != self._pid:
+            self._counts, self._pid, self._last_flush = {}, os.getpid(), 0.0
+
+    def reference(self, version):
+        """
+        :param version: Model version
+        :return: Reference histograms published with the model, or None if it has none
+        """
+        if version not in self._references:
+            from model_registry import registry
+            self._references[version] = (registry.metadata(version) or {}).get('drift_reference')
+        return self._references[version]
+
+    def observe(self, stream, employees, scores=None, version=None):
+        """
+        Count employees, and optionally their churn scores, into the bins of a model's reference. Does nothing if
+        there is no model yet, or it was published without a reference.
+
+        :param stream: One of STREAMS
+        :param employees: Data frame of the model features, with department and salary by name; or list of rows, each
+            a list of feature values in model feature order
+        :param scores: Churn probability of each employee
+        :param version: Version of the model that scored them. Will use the most recent model if not provided.
+        :return: None
+        """
+        if version is None:
+            from model_registry import registry
+            try:
+                version = registry.current_version()
+            except IOError:
+                return
+        reference = self.reference(version)
+        if reference is None or not len(employees):
+            return
+
+        if isinstance(employees, list):
+            columns = dict(zip(FEATURES, zip(*employees)))
+        else:
+            columns = {feature: employees[feature].values for feature in FEATURES}
+
+        observed = []
+        for feature in FEATURES:
+            bins = reference['features'][feature]
+            if 'categories' in bins:
+                index = {c: i for i, c in enumerate(bins['categories'])}
+                positions = [index.get(str(value), len(index)) for value in columns[feature]]
+                counts = np.bincount(positions, minlength=len(index) + 1)
+            else:
+                values = np.asarray(columns[feature], dtype=np.float64)
+                counts = np.bincount(np.searchsorted(bins['edges'], values, side='right'),
+                                     minlength=len(bins['edges']) + 1)
+            observed.append((feature, counts))
+        if scores is not None:
+            scores = np.asarray(scores, dtype=np.float64)
+            observed.append((SCORES, np.bincount(np.searchsorted(reference['scores']['edges'], scores, side='right'),
+                                                 minlength=len(reference['scores']['edges']) + 1)))
+
+        with self._lock:
+            self._check_fork()
+            for name, counts in observed:
+                key = (version, stream, name)
+                if key in self._counts:
+                    self._counts[key] += counts
+                else:
+                    self._counts[key] = counts.astype(np.int64)
+        if time.time() - self._last_flush >= FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """
+        Write this process's counts to its file in the drift directory.
+
+        :return: None
+        """
+        if not self.directory:
+            return
+        with self._lock:
+            self._check_fork()
+            self._last_flush = time.time()
+            if not self._counts:
+                return
+            snapshot = [[version, stream, name, counts.tolist()]
+                        for (version, stream, name), counts in self._counts.items()]
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '{}.json'.format(os.getpid()))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+
+    def collect(self, version):
+        """
+        :param version: Model version
+        :return: Dictionary of (stream, name) to counts per bin, summed over every process
+        """
+        if not self.directory:
+            with self._lock:
+                return {(s, n): c.copy() for (v, s, n), c in self._counts.items() if v == version}
+
+        self.flush()
+        totals = {}
+        if not os.path.isdir(self.directory):
+            return totals
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, file_name)) as f:
+                    snapshot = json.load(f)
+            except (IOError, ValueError):
+                continue
+            for counts_version, stream, name, counts in snapshot:
+                if counts_version != version:
+                    continue
+                if (stream, name) in totals:
+                    totals[(stream, name)] += np.asarray(counts, dtype=np.int64)
+                else:
+                    totals[(stream, name)] = np.asarray(counts, dtype=np.int64)
+        return totals
+
+    def report(self, version=None):
+        """
+        Measure how far the employees and scores seen since a model was published have drifted from its reference.
+
+        :param version: Model version. Will use the most recent model if not provided.
+        :return: Dictionary holding the version, whether it has a reference, the drift of each feature (and of the
+            scores) in each stream, and whether a retrain is recommended along with the reasons why
+        """
+        if version is None:
+            from model_registry import registry
+            try:
+                version = registry.latest_version()
+            except IOError:
+                version = None
+        reference = self.reference(version) if version is not None else None
+        report = {'version': version, 'has_reference': reference is not None, 'streams': {},
+                  'retrain_recommended': False, 'reasons': []}
+        if reference is None:
+            return report
+
+        counts = self.collect(version)
+        for stream in STREAMS:
+            names = FEATURES + ([SCORES] if stream == 'scored' else [])
+            rows = []
+            for name in names:
+                bins = reference['scores'] if name == SCORES else reference['features'][name]
+                expected = np.asarray(bins['counts'], dtype=np.int64)
+                actual = counts.get((stream, name), np.zeros(len(expected), dtype=np.int64))
+                observations = int(actual.sum())
+                psi_value = round(psi(expected, actual), 4) if observations else None
+                ordered = 'categories' not in bins
+                rows.append({
+                    'name': name,
+                    'observations': observations,
+                    'psi': psi_value,
+                    'ks': round(ks(expected, actual), 4) if observations and ordered else None,
+                    'status': status_of(psi_value or 0.0, observations)
+                })
+                if rows[-1]['status'] == 'drifted':
+                    report['reasons'].append("{} of {} employees has a PSI of {}".format(
+                        'the churn score' if name == SCORES else name, stream, psi_value))
+            report['streams'][stream] = rows
+        report['retrain_recommended'] = bool(report['reasons'])
+        return report
+
+
+# One monitor per process, counting into the drift directory
+monitor = DriftMonitor()
+
+# write out whatever was counted since the last flush when the process exits
+atexit.register(monitor.flush)
+
+
+if __name__ == "__main__":
+    drift_report = monitor.report()
+    if not drift_report['has_reference']:
+        print("Model {} was published without reference histograms, retrain it to start monitoring drift".format(
+            drift_report['version']))
+        sys.exit()
+
+    print("Drift since model {}".format(drift_report['version']))
+    for stream_name, stream_rows in drift_report['streams'].items():
+        print("\n{} employees".format(stream_name.capitalize()))
+        for row in stream_rows:
+            print("{name:<24}{observations:>10}  psi={psi}  ks={ks}  {status}".format(**row))
+    if drift_report['retrain_recommended']:
+        print("\nRetrain recommended: " + "; ".join(drift_report['reasons']))
+        sys.exit(1)
@@ -0,0 +1,248 @@
+"""
+Export churn predictions for many employees to a file, or stream them out over HTTP, without ever holding them all in
+memory. Employees are read from the database (or a CSV file) a fixed size chunk at a time, each chunk is scored with
+the vectorized batch path, and written out before the next one is read, so that peak memory depends on the chunk size
+and not on the size of the workforce.
+
+Results can be written as CSV, as one JSON object per line, or as Parquet (which needs pyarrow), with one row group
+per chunk.
+
+Run as main method, e.g.:
+    $ python export.py predictions/workforce.parquet
+    $ python export.py predictions/submission_GB.csv --csv data/test.csv
+"""
+
+import argparse
+import importlib.util
+import sys
+import time
+
+import config
+import metrics
+from HRmodel import predict_employee_churn_batch
+from database_operations import BATCH_SIZE, iter_csv_frames, iter_employee_frames
+from model_registry import registry
+
+
+EXPORT_FORMATS = ('csv', 'json', 'parquet')
+
+MIMETYPES = {'csv': 'text/csv', 'json': 'application/x-ndjson', 'parquet': 'application/vnd.apache.parquet'}
+
+
+def format_of(path):
+    """
+    :param path: Path of the file to export to
+    :return: Export format matching the file extension, CSV if there is no match
+    """
+    extension = path.rsplit('.', 1)[-1].lower()
+    if extension in ('parquet', 'pq'):
+        return 'parquet'
+    if extension in ('json', 'jsonl', 'ndjson'):
+        return 'json'
+    return 'csv'
+
+
+def iter_scored_frames(frames, features=True, GB=None, d=None, version=None):
+    """
+    Score a stream of employee data frames chunk by chunk, with the same model throughout.
+
+    :param frames: Iterable of data frames holding the model features of employees, and optionally their Emp_ID
+    :param features: Keep every input column alongside the predictions, rather than just the Emp_ID
+    :param GB: Model to score with. Will use most recent model if not provided.
+    :param d: Lookup table for label encoding, matching the model
+    :param version: Version of the model, to count the scores against for drift
+    :return: Generator of data frames of predictions, one per input chunk
+    """
+    if GB is None:
+        version, GB, d = registry.get()
+    for frame in frames:
+        if not len(frame):
+            continue
+        with metrics.span('score_chunk'):
+            results = predict_employee_churn_batch(frame, GB, d, version)
+        if features:
+            results = frame.join(results.drop(columns=[c for c in ['Emp_ID'] if c in results.columns]))
+        yield results
+
+
+class ChunkSink(object):
+    """
+    Write-only binary file that hands back whatever was written to it since it was last drained, so that a file can
+    be streamed out while it is still being written. Keeps count of the bytes written, as Parquet needs the offsets.
+    """
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def writable(self):
+        return True
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+class ExportWriter(object):
+    """
+    Write data frames of predictions to a binary file one after another, in one of EXPORT_FORMATS.
+    """
+
+    def __init__(self, out, out_format='csv'):
+        """
+        :param out: Binary file object to write to
+        :param out_format: One of EXPORT_FORMATS
+        """
+        if out_format not in EXPORT_FORMATS:
+            raise ValueError("Unknown format '{}', expected one of {}".format(out_format, EXPORT_FORMATS))
+        self.out = out
+        self.out_format = out_format
+        self.n_rows = 0
+        self._parquet_writer = None
+        if out_format == 'parquet':
+            # fail before anything is scored, rather than on the first chunk. Raises ImportError if pyarrow is missing
+            if importlib.util.find_spec('pyarrow.parquet') is None:
+                raise ImportError("No module named 'pyarrow.parquet'")
+
+    def write(self, df):
+        """
+        :param df: Data frame of predictions. Every chunk must have the same columns.
+        :return: None
+        """
+        if self.out_format == 'csv':
+            self.out.write(df.to_csv(index=False, header=self.n_rows == 0).encode('utf-8'))
+        elif self.out_format == 'json':
+            self.out.write((df.to_json(orient='records', lines=True).rstrip('\n') + '\n').encode('utf-8'))
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if self._parquet_writer is None:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                self._parquet_writer = pq.ParquetWriter(self.out, table.schema)
+            else:
+                # a chunk whose column happens to be all integers must still match a float column of the schema
+                table = pa.Table.from_pandas(df, schema=self._parquet_writer.schema, preserve_index=False)
+            self._parquet_writer.write_table(table)
+        self.n_rows += len(df)
+
+    def close(self):
+        """
+        Finish the file, e.g. writing the Parquet footer. Doesn't close the file object itself.
+
+        :return: None
+        """
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+
+
+def export_predictions(out, frames, out_format='csv', features=True, GB=None, d=None, version=None, progress=None):
+    """
+    Score employees and write the predictions to a file, a chunk at a time.
+
+    :param out: Binary file object to write to
+    :param frames: Iterable of data frames of employees, e.g. from database_operations.iter_employee_frames
+    :param out_format: One of EXPORT_FORMATS
+    :param features: Keep every input column alongside the predictions, rather than just the Emp_ID
+    :param GB: Model to score with. Will use most recent model if not provided.
+    :param d: Lookup table for label encoding, matching the model
+    :param version: Version of the model, to count the scores against for drift
+    :param progress: Called with the number of rows written so far and the seconds taken, after each chunk
+    :return: Dictionary holding the number of rows and chunks written, seconds taken and rows per second
+    """
+    start = time.perf_counter()
+    writer = ExportWriter(out, out_format)
+    n_chunks = 0
+    for results in iter_scored_frames(frames, features, GB, d, version):
+        writer.write(results)
+        n_chunks += 1
+        if progress is not None:
+            progress(writer.n_rows, time.perf_counter() - start)
+    writer.close()
+
+    seconds = time.perf_counter() - start
+    return {'rows': writer.n_rows, 'chunks': n_chunks, 'seconds': round(seconds, 3),
+            'rows_per_second': int(writer.n_rows / seconds) if seconds else None}
+
+
+def iter_export(frames, out_format='csv', features=True):
+    """
+    Score employees and stream the predictions file out as it is written, e.g. as the body of a response.
+
+    :param frames: Iterable of data frames of employees
+    :param out_format: One of EXPORT_FORMATS
+    :param features: Keep every input column alongside the predictions, rather than just the Emp_ID
+    :return: Generator of bytes, one piece per chunk of employees
+    :raises ValueError: If the format is unknown, or the first chunk of employees can't be scored, e.g. for a missing
+        feature
+    :raises ImportError: If the format is Parquet and pyarrow isn't installed
+    """
+    sink = ChunkSink()
+    writer = ExportWriter(sink, out_format)
+
+    def generate():
+        for results in iter_scored_frames(frames, features):
+            writer.write(results)
+            yield sink.drain()
+        writer.close()
+        tail = sink.drain()
+        if tail:
+            yield tail
+
+    # score the first chunk now too, so that bad input fails before a response is started rather than cutting it short
+    pieces = generate()
+    first = next(pieces, None)
+
+    def primed():
+        if first is not None:
+            yield first
+            yield from pieces
+
+    return primed()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help="File to write. The format follows the extension unless --format is given.")
+    parser.add_argument('--format', default=None, choices=EXPORT_FORMATS)
+    parser.add_argument('--database', default=None, help="Database address. Will use config.DATABASE_URL if not "
+                                                         "provided.")
+    parser.add_argument('--csv', default=None, help="Score the employees in this CSV file rather than the database")
+    parser.add_argument('--min-id', type=int, default=None, help="Smallest employee ID exported, inclusive")
+    parser.add_argument('--max-id', type=int, default=None, help="Largest employee ID exported, inclusive")
+    parser.add_argument('--chunksize', type=int, default=BATCH_SIZE, help="Number of employees scored at a time")
+    parser.add_argument('--ids-only', action='store_true', help="Only write Emp_ID alongside the predictions")
+    args = parser.parse_args()
+
+    if args.database is not None:
+        config.DATABASE_URL = args.database
+
+    if args.csv is not None:
+        frames = iter_csv_frames(args.csv, args.chunksize)
+    else:
+        frames = iter_employee_frames(min_id=args.min_id, max_id=args.max_id, chunksize=args.chunksize)
+
+    def report(n_rows, seconds):
+        sys.stderr.write("\r{} rows, {} rows/s".format(n_rows, int(n_rows / seconds) if seconds else '-'))
+
+    with open(args.path, 'wb') as f:
+        result = export_predictions(f, frames, args.format or format_of(args.path), not args.ids_only,
+                                    progress=report)
+    sys.stderr.write('\n')
+    print("Wrote {rows} rows in {chunks} chunks to {path} in {seconds}s, {rows_per_second} rows/s".format(
+        path=args.path, **result))
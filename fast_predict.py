@@ -0,0 +1,200 @@
+"""
+Score employees without going through pandas or scikit-learn. A trained ensemble is flattened into a handful of NumPy
+arrays (the feature, threshold and children of every node, and the value of every leaf), and all trees are walked at
+once for every row. For a single employee this takes microseconds, where building a data frame, label encoding it and
+calling into scikit-learn takes milliseconds.
+
+Only scikit-learn's gradient boosting models are supported. Anything else, or any model whose flattened form doesn't
+reproduce its own probabilities, is left to the regular scoring path.
+"""
+
+import warnings
+
+import numpy as np
+
+
+# Largest difference in class probabilities, between the flattened ensemble and the model, that we accept
+TOLERANCE = 1e-6
+
+
+class CompiledEnsemble(object):
+    """
+    Binary classifier made of flattened regression trees, whose leaf values are summed onto a constant baseline and
+    passed through the logistic function.
+    """
+
+    def __init__(self, feature, threshold, left, right, value, roots, max_depth, baseline, scale, classes,
+                 categories, features, dtype=np.float64):
+        """
+        :param feature: Feature index split on at each node
+        :param threshold: Rows with a feature value at or below the threshold go left
+        :param left: Index of the left child of each node. Leaves point at themselves.
+        :param right: Index of the right child of each node. Leaves point at themselves.
+        :param value: Value of each node, only used at leaves
+        :param roots: Index of the root node of each tree
+        :param max_depth: Depth of the deepest tree
+        :param baseline: Raw score before any tree is added
+        :param scale: Multiplier applied to the summed leaf values, i.e. the learning rate
+        :param classes: Class labels, negative class first
+        :param categories: Dictionary of column name to {category: code}, for encoding raw rows
+        :param features: Names of the model features, in order
+        :param dtype: Type that feature values are cast to before comparing with thresholds, as done by the model
+        """
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        self.roots = roots
+        self.max_depth = max_depth
+        self.baseline = baseline
+        self.scale = scale
+        self.classes = classes
+        self.categories = categories
+        self.features = features
+        self.dtype = dtype
+        self._categorical = [(i, categories[f]) for i, f in enumerate(features) if f in categories]
+
+    @classmethod
+    def from_model(cls, model, encodings, features):
+        """
+        Flatten a trained model, checking that the result reproduces the model's own probabilities.
+
+        :param model: Trained model
+        :param encodings: Lookup table for label encoding, used to train the model
+        :param features: Names of the model features, in order
+        :return: CompiledEnsemble, or None if the model isn't supported
+        """
+        name = type(model).__name__
+        if len(getattr(model, 'classes_', [])) != 2:
+            return None
+        if name == 'GradientBoostingClassifier' and getattr(model, 'loss', None) in ('deviance', 'log_loss'):
+            trees = [(e.tree_.feature, e.tree_.threshold, e.tree_.children_left, e.tree_.children_right,
+                      e.tree_.value[:, 0, 0]) for e in model.estimators_[:, 0]]
+            scale, dtype = model.learning_rate, np.float32
+        elif name == 'HistGradientBoostingClassifier' and not _has_categorical_splits(model):
+            trees = [_hist_tree(predictors[0].nodes) for predictors in model._predictors]
+            scale, dtype = 1.0, np.float64
+        else:
+            return None
+
+        categories = {column: {c: i for i, c in enumerate(encoder.classes_)} for column, encoder in encodings.items()}
+        compiled = cls(*_flatten(trees), baseline=0.0, scale=scale, classes=np.asarray(model.classes_),
+                       categories=categories, features=list(features), dtype=dtype)
+
+        # the baseline is whatever the model adds on top of its trees, which is constant for the default init
+        probe = compiled.probe_rows()
+        with warnings.catch_warnings():
+            # the probe is a plain array, while the model may have been fitted on a data frame
+            warnings.simplefilter('ignore', UserWarning)
+            decision, expected = model.decision_function(probe).ravel(), model.predict_proba(probe)
+        offsets = decision - compiled.raw_scores(probe)
+        if np.ptp(offsets) > TOLERANCE:
+            return None
+        compiled.baseline = float(np.mean(offsets))
+
+        if np.max(np.abs(compiled.predict_proba(probe) - expected)) > TOLERANCE:
+            return None
+        return compiled
+
+    def probe_rows(self, n_rows=256, seed=1234):
+        """
+        :return: Feature matrix of rows that land on either side of the thresholds used by the trees
+        """
+        rng = np.random.RandomState(seed)
+        split = self.left != np.arange(len(self.left))
+        X = np.zeros((n_rows, len(self.features)))
+        for i in range(len(self.features)):
+            thresholds = self.threshold[split & (self.feature == i)]
+            if len(thresholds):
+                X[:, i] = rng.choice(thresholds, n_rows) + rng.choice([-1e-3, 1e-3], n_rows)
+        return X
+
+    def encode(self, rows):
+        """
+        Encode raw rows, holding category names rather than codes, into a feature matrix.
+
+        :param rows: Sequence of rows, each a sequence of values in model feature order
+        :return: 2-D feature matrix
+        :raises ValueError: If a category wasn't seen when training the model
+        """
+        rows = [list(row) for row in rows]
+        for i, codes in self._categorical:
+            for row in rows:
+                try:
+                    row[i] = codes[row[i]]
+                except KeyError:
+                    raise ValueError("y contains previously unseen labels: {}".format(row[i]))
+        return np.array(rows, dtype=np.float64)
+
+    def raw_scores(self, X):
+        """
+        :param X: 2-D feature matrix
+        :return: Summed leaf values of every row, scaled and without the baseline
+        """
+        X = np.asarray(X, dtype=self.dtype)
+        rows = np.arange(X.shape[0])[:, None]
+        nodes = np.broadcast_to(self.roots, (X.shape[0], len(self.roots)))
+        for _ in range(self.max_depth):
+            go_left = X[rows, self.feature[nodes]] <= self.threshold[nodes]
+            nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+        return self.scale * self.value[nodes].sum(axis=1)
+
+    def predict_proba(self, X):
+        """
+        :param X: 2-D feature matrix
+        :return: Class probabilities of every row, as from the model's predict_proba
+        """
+        positive = 1.0 / (1.0 + np.exp(-(self.baseline + self.raw_scores(X))))
+        return np.column_stack([1.0 - positive, positive])
+
+
+def _hist_tree(nodes):
+    """
+    :return: Arrays describing a histogram gradient boosting tree, in the same layout as scikit-learn's Tree
+    """
+    threshold = nodes['num_threshold'] if 'num_threshold' in nodes.dtype.names else nodes['threshold']
+    leaf = nodes['is_leaf'].astype(bool)
+    left = np.where(leaf, -1, nodes['left'].astype(np.int64))
+    right = np.where(leaf, -1, nodes['right'].astype(np.int64))
+    return nodes['feature_idx'], threshold, left, right, nodes['value']
+
+
+def _has_categorical_splits(model):
+    return any(p.nodes.dtype.names and 'is_categorical' in p.nodes.dtype.names and p.nodes['is_categorical'].any()
+               for predictors in model._predictors for p in predictors)
+
+
+def _flatten(trees):
+    """
+    Concatenate trees into one set of node arrays. Leaves get feature 0 and point at themselves, so that walking a
+    fixed number of steps from any root ends at a leaf.
+
+    :param trees: List of (feature, threshold, children_left, children_right, value) arrays per tree
+    :return: feature, threshold, left, right, value, roots and max_depth
+    """
+    features, thresholds, lefts, rights, values, roots = [], [], [], [], [], []
+    offset, max_depth = 0, 0
+    for feature, threshold, children_left, children_right, value in trees:
+        n_nodes = len(feature)
+        index = np.arange(n_nodes)
+        leaf = np.asarray(children_left) < 0
+        features.append(np.where(leaf, 0, feature))
+        thresholds.append(np.asarray(threshold, dtype=np.float64))
+        lefts.append(np.where(leaf, index, children_left) + offset)
+        rights.append(np.where(leaf, index, children_right) + offset)
+        values.append(np.asarray(value, dtype=np.float64))
+        roots.append(offset)
+        max_depth = max(max_depth, _depth(children_left, children_right))
+        offset += n_nodes
+
+    return (np.concatenate(features).astype(np.intp), np.concatenate(thresholds), np.concatenate(lefts),
+            np.concatenate(rights), np.concatenate(values), np.array(roots), max_depth)
+
+
+def _depth(children_left, children_right):
+    depth, level = 0, [0]
+    while level:
+        level = [c for node in level for c in (children_left[node], children_right[node]) if c >= 0]
+        depth += 1 if level else 0
+    return depth
@@ -0,0 +1,405 @@
+"""
+Hold the whole workforce in memory as compact NumPy arrays, loaded once per process, rather than building Employee
+objects or data frames of Python strings from the database every time features are needed.
+
+The model features live in a single C-contiguous float32 matrix, in model feature order, with department and salary
+stored as codes into their sorted accepted values. That is exactly how the models encode them (see encoders), and
+float32 is what scikit-learn's gradient boosting and xgboost convert their input to, so the matrix, or any range of
+employees from it, goes to training and scoring as it is, without a copy. Histogram gradient boosting compares in
+float64, where features only agree with the database to float32 precision, i.e. about 7 significant digits. The
+label is kept as int8 and employee IDs as a sorted int64 array, which doubles as the Emp_ID to row index through a
+binary search.
+
+Employees added since the last load, i.e. with a greater Emp_ID, are appended on refresh, which a lookup of an
+employee past the last one loaded triggers. Employees written in place, by add_employee overwriting an employee or
+by an ingest with --on-conflict replace, are recorded in a journal file shared by every process (see record_writes).
+Each store checks the size of the journal before a lookup or refresh, and re-reads the rows written since it last
+did, or reloads everything after a bulk replace. Employees added with an Emp_ID below the last one loaded, other
+than through those two, are only picked up by a full reload.
+
+With gunicorn preloading the app, the store is loaded in the master and shared by the workers, whose refreshes only
+touch the pages they append to.
+"""
+
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn import preprocessing
+
+import config
+import metrics
+from schema import DEPARTMENT_OPTIONS, FEATURES, NONNUMERIC_COLUMNS, SALARY_OPTIONS
+
+
+# Accepted values of each string feature, in the order of their codes
+CATEGORIES = {'department': sorted(DEPARTMENT_OPTIONS), 'salary': sorted(SALARY_OPTIONS)}
+
+FLOAT_FEATURES = ('satisfaction_level', 'last_evaluation')
+
+# Number of employees read from the database at a time while loading
+LOAD_CHUNKSIZE = 100000
+
+# Line of the journal telling stores to reload every employee
+RELOAD = '*'
+
+# Number of employees re-read from the database at a time after they were written in place
+REREAD_CHUNKSIZE = 500
+
+# Room for this many more employees is made each time the arrays fill up, as a fraction of their current size, so
+# that refreshes rarely have to copy what is already loaded
+GROWTH = 0.5
+
+
+def encoders():
+    """
+    :return: Lookup table of label encoders, by column, matching the codes of the store, as used by HRmodel.proc_df
+    """
+    d = {}
+    for column, options in CATEGORIES.items():
+        d[column] = preprocessing.LabelEncoder().fit(options)
+    return d
+
+
+class FeatureStore(object):
+    """
+    Model features, labels and IDs of every employee, in arrays with room to grow. The arrays and the number of rows
+    in use are published together as one tuple, so readers never see rows that are still being written.
+    """
+
+    def __init__(self):
+        self._data = (np.empty(0, dtype=np.int64), np.empty((0, len(FEATURES)), dtype=np.float32),
+                      np.empty(0, dtype=np.int8), 0)
+        self._lock = threading.Lock()
+        self._journal_offset = 0
+        self.loaded = False
+        self.load_seconds = None
+        self.reread_count = 0
+
+    def __len__(self):
+        return self._data[3]
+
+    @property
+    def last_loaded(self):
+        """
+        :return: Greatest employee ID loaded, or None if there are none
+        """
+        emp_ids, _, _, n = self._data
+        return int(emp_ids[n - 1]) if n else None
+
+    def ids(self):
+        """
+        :return: Sorted employee IDs, as a read only view
+        """
+        emp_ids, _, _, n = self._data
+        return _read_only(emp_ids[:n])
+
+    def matrix(self):
+        """
+        :return: Feature matrix of every employee, in model feature order, as a read only view
+        """
+        _, X, _, n = self._data
+        return _read_only(X[:n])
+
+    def labels(self):
+        """
+        :return: Whether each employee left, as a read only view
+        """
+        _, _, left, n = self._data
+        return _read_only(left[:n])
+
+    def column(self, feature):
+        """
+        :param feature: Name of a model feature
+        :return: Values of the feature for every employee, as a read only view (codes, for department and salary)
+        """
+        return self.matrix()[:, FEATURES.index(feature)]
+
+    def load(self):
+        """
+        Load every employee from the database, replacing anything loaded before.
+
+        :return: Number of employees loaded
+        """
+        with self._lock:
+            return self._load()
+
+    def _load(self):
+        start = time.perf_counter()
+        # whatever was written before the load starts is read along with everything else
+        self._journal_offset = _journal_size()
+        self._data = (np.empty(0, dtype=np.int64), np.empty((0, len(FEATURES)), dtype=np.float32),
+                      np.empty(0, dtype=np.int8), 0)
+        n_added = self._append_new()
+        self.loaded = True
+        self.load_seconds = round(time.perf_counter() - start, 3)
+        return n_added
+
+    def refresh(self):
+        """
+        Re-read the employees written in place since the last check, and append the employees added to the database
+        since the last load or refresh, loading everything if nothing has been loaded yet.
+
+        :return: Number of employees added
+        """
+        if not self.loaded:
+            return self.load()
+        self.catch_up()
+        with self._lock:
+            return self._append_new()
+
+    def catch_up(self):
+        """
+        Re-read the employees that any process recorded as written in place since this store last checked, or
+        reload everything if a bulk replace was recorded. Costs a stat of the journal when nothing was written.
+
+        :return: Number of employees re-read, or of employees loaded after a reload
+        """
+        if not self.loaded or _journal_size() == self._journal_offset:
+            return 0
+        with self._lock:
+            size = _journal_size()
+            if size < self._journal_offset:
+                # the journal was removed or replaced, so what it held is unknown
+                return self._load()
+            with open(config.FEATURE_STORE_JOURNAL, 'rb') as f:
+                f.seek(self._journal_offset)
+                written = f.read(size - self._journal_offset)
+            # leave a line still being written to the next check
+            written = written[:written.rfind(b'\n') + 1]
+            self._journal_offset += len(written)
+
+            lines = written.decode().split()
+            if RELOAD in lines:
+                return self._load()
+            emp_ids = sorted({int(line) for line in lines})
+            last_loaded = self.last_loaded
+            rows = self.rows(emp_ids)
+            if any(row < 0 and last_loaded is not None and emp_id < last_loaded
+                   for emp_id, row in zip(emp_ids, rows)):
+                # a new employee in the middle of the IDs loaded, which can't be slotted in without a reload
+                return self._load()
+            # employees past the last one loaded are appended by the next refresh
+            return self._reread([emp_id for emp_id, row in zip(emp_ids, rows) if row >= 0])
+
+    @metrics.timed('feature_store_reread')
+    def _reread(self, emp_ids):
+        """
+        :param emp_ids: IDs of loaded employees to read from the database again, and overwrite in place
+        :return: Number of employees re-read
+        """
+        from database_operations import canonicalize_df, get_engine, get_session
+        from sqlite_declarative import Employee
+
+        n_reread = 0
+        for start in range(0, len(emp_ids), REREAD_CHUNKSIZE):
+            query = get_session().query(Employee.Emp_ID, *[getattr(Employee, f) for f in FEATURES] + [Employee.left]) \
+                .filter(Employee.Emp_ID.in_(emp_ids[start:start + REREAD_CHUNKSIZE]))
+            df = canonicalize_df(pd.read_sql(query.statement, get_engine()))
+            _, X, left, _ = self._data
+            self._write(X, left, self.rows(df['Emp_ID'].values), df)
+            n_reread += len(df)
+        self.reread_count += n_reread
+        return n_reread
+
+    @metrics.timed('feature_store_refresh')
+    def _append_new(self):
+        # imported here, so that the store can be built and read without a database configured
+        from database_operations import canonicalize_df, get_engine, get_session
+        from sqlite_declarative import Employee
+
+        last_loaded = self.last_loaded
+        query = get_session().query(Employee.Emp_ID, *[getattr(Employee, f) for f in FEATURES] + [Employee.left])
+        if last_loaded is not None:
+            query = query.filter(Employee.Emp_ID > last_loaded)
+        query = query.order_by(Employee.Emp_ID)
+
+        n_added = 0
+        for chunk in pd.read_sql(query.statement, get_engine(), chunksize=LOAD_CHUNKSIZE):
+            self._append(canonicalize_df(chunk))
+            n_added += len(chunk)
+        return n_added
+
+    def _append(self, df):
+        """
+        :param df: Data frame of employees with an Emp_ID, model features and label, in increasing Emp_ID order
+        """
+        emp_ids, X, left, n = self._data
+        n_new = n + len(df)
+        if n_new > len(emp_ids):
+            # grow into new arrays, leaving the published ones as they are for anyone still reading them
+            capacity = max(n_new, int(len(emp_ids) * (1 + GROWTH)))
+            emp_ids, X, left = _grown(emp_ids, n, capacity), _grown(X, n, capacity), _grown(left, n, capacity)
+
+        emp_ids[n:n_new] = df['Emp_ID'].values
+        self._write(X, left, slice(n, n_new), df)
+        self._data = (emp_ids, X, left, n_new)
+
+    @staticmethod
+    def _write(X, left, rows, df):
+        """
+        :param X: Feature matrix to write to
+        :param left: Label array to write to
+        :param rows: Rows to write, as a slice or an array of row indexes in the order of df
+        :param df: Data frame of employees with the model features and label
+        """
+        left[rows] = df['left'].values
+        for i, feature in enumerate(FEATURES):
+            if feature in NONNUMERIC_COLUMNS:
+                X[rows, i] = pd.Categorical(df[feature], categories=CATEGORIES[feature]).codes
+            else:
+                X[rows, i] = df[feature].values
+
+    def rows(self, emp_ids):
+        """
+        :param emp_ids: Employee ID numbers
+        :return: Row index of each employee, or -1 for those that aren't loaded
+        """
+        ids = self.ids()
+        emp_ids = np.asarray(emp_ids, dtype=np.int64)
+        if not len(ids):
+            return np.full(len(emp_ids), -1, dtype=np.int64)
+        index = np.minimum(np.searchsorted(ids, emp_ids), len(ids) - 1)
+        return np.where(ids[index] == emp_ids, index, -1)
+
+    def id_range(self, min_id=None, max_id=None):
+        """
+        :param min_id: Smallest employee ID included. Will start from the first employee if not provided.
+        :param max_id: Largest employee ID included. Will go up to the last employee if not provided.
+        :return: Slice of the rows holding the employees in the range, for indexing the views without a copy
+        """
+        ids = self.ids()
+        start = np.searchsorted(ids, min_id, side='left') if min_id is not None else 0
+        stop = np.searchsorted(ids, max_id, side='right') if max_id is not None else len(ids)
+        return slice(int(start), int(stop))
+
+    def segment(self, department=None, salary=None, left=None):
+        """
+        :param department: Only include employees of this department
+        :param salary: Only include employees in this salary band
+        :param left: Only include employees who left (1) or stayed (0)
+        :return: Boolean mask of the employees in the segment
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for feature, value in (('department', department), ('salary', salary)):
+            if value is not None:
+                mask &= self.column(feature) == CATEGORIES[feature].index(value)
+        if left is not None:
+            mask &= self.labels() == int(left)
+        return mask
+
+    @metrics.timed('feature_store_lookup')
+    def lookup(self, emp_id):
+        """
+        Look up the model features of an employee, checking for new employees first if it isn't loaded yet.
+
+        :param emp_id: Employee ID number
+        :return: List of feature values in model feature order, with department and salary by name, or None if there
+            is no such employee
+        """
+        self.catch_up()
+        row = self.rows([emp_id])[0]
+        if row < 0:
+            last_loaded = self.last_loaded
+            # IDs only grow, so only an employee past the last one loaded can have been added since
+            if (last_loaded is not None and emp_id < last_loaded) or not self.refresh():
+                return None
+            row = self.rows([emp_id])[0]
+            if row < 0:
+                return None
+
+        features = []
+        for feature, value in zip(FEATURES, self.matrix()[row]):
+            if feature in NONNUMERIC_COLUMNS:
+                value = CATEGORIES[feature][int(value)]
+            elif feature in FLOAT_FEATURES:
+                # the shortest decimal that reads back as the same float32, i.e. 0.38 rather than 0.3799999952
+                value = float(repr(value))
+            else:
+                value = int(value)
+            features.append(value)
+        return features
+
+    def training_frame(self, max_id=None, min_id=None):
+        """
+        Get employees in an ID range ready for training, already label encoded.
+
+        :param max_id: Largest employee ID included
+        :param min_id: Smallest employee ID included
+        :return: Data frame of Emp_ID, the model features and left, whose features share memory with the store; and
+            the lookup table of label encoders that goes with it
+        """
+        rows = self.id_range(min_id, max_id)
+        df = pd.DataFrame(self.matrix()[rows], columns=FEATURES, copy=False)
+        df.insert(0, 'Emp_ID', self.ids()[rows])
+        df['left'] = self.labels()[rows]
+        return df, encoders()
+
+    def memory_usage(self):
+        """
+        :return: Dictionary of the bytes used by the loaded employees, the bytes allocated including room to grow,
+            and the bytes used per million employees
+        """
+        emp_ids, X, left, n = self._data
+        row_bytes = emp_ids.itemsize + X.itemsize * X.shape[1] + left.itemsize
+        return {'rows': n, 'bytes': n * row_bytes, 'allocated_bytes': emp_ids.nbytes + X.nbytes + left.nbytes,
+                'mb_per_million': round(row_bytes * 10 ** 6 / 2 ** 20, 1)}
+
+    def stats(self):
+        """
+        :return: Dictionary describing what is loaded, for reporting
+        """
+        stats = self.memory_usage()
+        stats.update(loaded=self.loaded, last_loaded=self.last_loaded, load_seconds=self.load_seconds,
+                     reread_count=self.reread_count)
+        return stats
+
+
+def _grown(array, n, capacity):
+    grown = np.empty((capacity,) + array.shape[1:], dtype=array.dtype)
+    grown[:n] = array[:n]
+    return grown
+
+
+def _read_only(view):
+    view.flags.writeable = False
+    return view
+
+
+def _journal_size():
+    try:
+        return os.stat(config.FEATURE_STORE_JOURNAL).st_size if config.FEATURE_STORE_JOURNAL else 0
+    except OSError:
+        return 0
+
+
+def record_writes(emp_ids=None):
+    """
+    Tell the store of every process that employees were written in place in the database, so that they read them
+    again rather than serve what they loaded before. Each ID goes on a line of its own, appended in a single write,
+    so that lines from several processes never interleave.
+
+    :param emp_ids: IDs of the employees written, or None if so many were that every store should reload
+    :return: None
+    """
+    if not config.FEATURE_STORE_JOURNAL:
+        return
+    lines = RELOAD + '\n' if emp_ids is None else ''.join('{}\n'.format(int(emp_id)) for emp_id in emp_ids)
+    fd = os.open(config.FEATURE_STORE_JOURNAL, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, lines.encode())
+    finally:
+        os.close(fd)
+
+
+def enabled():
+    """
+    :return: Whether employee features are served from the in-memory store rather than the database
+    """
+    return bool(config.FEATURE_STORE)
+
+
+# One store per process, loaded on first use, or before forking when the app is preloaded
+store = FeatureStore()
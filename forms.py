@@ -2,7 +2,10 @@
 Keep track of all of the forms used to request predictions and retrain the model in an out of the way place
 """
 
-from wtforms import Form, BooleanField, FloatField, IntegerField, StringField, validators
+from wtforms import Form, BooleanField, FloatField, IntegerField, SelectField, StringField, validators
+
+import config
+from schema import DEPARTMENT_OPTIONS, FEATURES, RANGE_FEATURES, SALARY_OPTIONS
 
 
 class EmployeeIdForm(Form):
@@ -21,6 +24,63 @@ class RetrainModelForm(Form):
     emp_id = IntegerField('Most Recent Employee ID to Consider', [
         validators.DataRequired()
     ])
+    incremental = BooleanField('Only train on employees added since the last model, where possible')
+    tune = BooleanField('Tune boosting parameters by cross-validation first (slower, always a full retrain)')
+    backend = SelectField('Training Library', default=config.TRAINER_BACKEND, choices=[
+        ('gbc', 'scikit-learn gradient boosting'),
+        ('hist', 'scikit-learn histogram gradient boosting (faster)'),
+        ('xgboost', 'xgboost histogram trees (faster)')
+    ])
+
+
+class AtRiskForm(Form):
+    """
+    Handle backend communications for listing the employees most likely to leave, by department
+    """
+    department = SelectField('Department', default='', choices=[('', 'Every department')] + [
+        (d, d) for d in DEPARTMENT_OPTIONS
+    ])
+    n = IntegerField('Number of Employees per Department', default=10, validators=[
+        validators.NumberRange(1, 100)
+    ])
+
+
+class EmployeeQueryForm(Form):
+    """
+    Handle backend communications for filtering employees on the query page
+    """
+    department = SelectField('Department', default='', choices=[('', 'Any department')] + [
+        (d, d) for d in DEPARTMENT_OPTIONS
+    ])
+    salary = SelectField('Salary Band', default='', choices=[('', 'Any salary band')] + [
+        (s, s) for s in SALARY_OPTIONS
+    ])
+    left = SelectField('Churned', default='', choices=[('', 'Either'), ('1', 'Left'), ('0', 'Stayed')])
+    min_satisfaction_level = FloatField('Satisfaction Level, at least', [validators.Optional()])
+    max_satisfaction_level = FloatField('Satisfaction Level, at most', [validators.Optional()])
+    min_last_evaluation = FloatField('Last Evaluation, at least', [validators.Optional()])
+    max_last_evaluation = FloatField('Last Evaluation, at most', [validators.Optional()])
+    min_average_montly_hours = IntegerField('Average Monthly Hours, at least', [validators.Optional()])
+    max_average_montly_hours = IntegerField('Average Monthly Hours, at most', [validators.Optional()])
+    min_time_spend_company = IntegerField('Time Spent at Company, at least', [validators.Optional()])
+    max_time_spend_company = IntegerField('Time Spent at Company, at most', [validators.Optional()])
+    limit = IntegerField('Employees per Page', default=50, validators=[
+        validators.NumberRange(1, 500)
+    ])
+    after = IntegerField('After Employee ID', [validators.Optional()])
+    explain = BooleanField('Show how the database finds them')
+
+    def filters(self):
+        """
+        :return: Dictionary of the filters filled in, as keyword arguments for queries.query_employees
+        """
+        return {
+            'department': self.department.data or None,
+            'salary': self.salary.data or None,
+            'left': int(self.left.data) if self.left.data else None,
+            'ranges': {c: (getattr(self, 'min_' + c).data, getattr(self, 'max_' + c).data) for c in RANGE_FEATURES},
+            'after': self.after.data
+        }
 
 
 class NewEmployeeForm(Form):
@@ -63,3 +123,24 @@ class NewEmployeeForm(Form):
     salary = StringField('Salary Band', [
         validators.DataRequired()
     ])
+
+
+class WhatIfForm(Form):
+    """
+    Handle backend communications for sweeping one or two features of an employee, looked up by Employee ID or
+    entered as a hypothetical employee, to see how their churn risk would move
+    """
+    emp_id = IntegerField('Employee ID', [validators.Optional()])
+    x_feature = SelectField('Feature to Vary', default='satisfaction_level', choices=[(f, f) for f in FEATURES])
+    y_feature = SelectField('Second Feature to Vary', default='', choices=[('', 'None')] + [(f, f) for f in FEATURES])
+    steps = IntegerField('Values per Numeric Feature', default=25, validators=[
+        validators.NumberRange(2, 100)
+    ])
+
+    def features(self):
+        """
+        :return: List of the features to sweep, in the order of the axes of the grid
+        """
+        if self.y_feature.data and self.y_feature.data != self.x_feature.data:
+            return [self.x_feature.data, self.y_feature.data]
+        return [self.x_feature.data]
@@ -0,0 +1,26 @@
+"""
+Settings for serving the application with gunicorn:
+    $ gunicorn --config gunicorn.conf.py wsgi:app
+
+Unless HR_PRELOAD=0, the app is loaded in the master before the workers are forked, so that the modules it imports
+and the current model are held once and shared copy-on-write by every worker.
+"""
+
+import gc
+
+# gunicorn reads every module level name as a setting, and has one called config
+from config import PRELOAD, WEB_BIND, WEB_THREADS, WEB_WORKER_CLASS, WEB_WORKERS
+
+
+bind = WEB_BIND
+workers = WEB_WORKERS
+worker_class = WEB_WORKER_CLASS
+threads = WEB_THREADS
+preload_app = bool(PRELOAD)
+
+
+def pre_fork(server, worker):
+    # the garbage collector writes to every object it tracks, which would give each worker its own copy of the
+    # pages holding them; freezing moves what is loaded so far out of its reach (Python 3.7 and later)
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
@@ -1,30 +1,112 @@
 """
 Support the backend of the employee churn prediction model.
+
+The application is built by create_app. Modules that pull in pandas, scikit-learn or SQLAlchemy are imported by the
+views that use them, so that building the app, and serving pages that need none of them, stays fast. Under gunicorn
+the app is built with preload in the master process (see wsgi.py and gunicorn.conf.py), which imports them and loads
+the current model once, before forking the workers that then share those pages.
 """
 
-from flask import flash, Flask, redirect, render_template, request, url_for
+import sys
+
+import flask
+from flask import Blueprint, flash, Flask, jsonify, redirect, request, Response, stream_with_context, url_for
 
-from HRmodel import *
 from forms import *
-from database_operations import *
+import metrics
+import prediction_cache
+from schema import FEATURES
+
+
+views = Blueprint('views', __name__)
+
+render_template = metrics.timed('render_template')(flask.render_template)
+
+
+def create_app(preload=False):
+    """
+    Build the Flask application.
+
+    :param preload: Import the modules used to serve predictions and load the current model now, rather than on the
+        first request that needs them
+    :return: Flask application
+    """
+    app = Flask(__name__)
+    app.secret_key = 'some_secret'  # this should be replaced later on with a big, secure hash
+    app.register_blueprint(views)
+    metrics.configure_slow_request_log()
+    if preload:
+        preload_app(app)
+    return app
+
+
+def preload_app(app):
+    """
+    Import everything used to serve predictions, load and compile the current model and compile every template, so
+    that none of it happens while handling a request.
+
+    :param app: Flask application
+    :return: None
+    """
+    # churn_scores and training_jobs are imported only so that they are loaded before the fork, which is deliberate
+    import churn_scores  # noqa: F401
+    import database_operations
+    import feature_store
+    import inference_client
+    import training_jobs  # noqa: F401
+    from model_registry import registry
+
+    if inference_client.client is None:
+        try:
+            registry.compiled()
+        except IOError:
+            pass  # nothing has been published yet, the first model is loaded when it is
+    if feature_store.enabled():
+        feature_store.store.load()
+        # leave the workers to open connections of their own, rather than holding idle ones in the master
+        database_operations.dispose_engine()
+    for template in app.jinja_env.list_templates():
+        app.jinja_env.get_template(template)
+
+
+@views.before_app_request
+def start_timing():
+    metrics.start_request()
+
+
+@views.after_app_request
+def stop_timing(response):
+    metrics.end_request(request.endpoint, request.method, response.status_code, request.path)
+    return response
+
 
+@views.teardown_app_request
+def stop_timing_on_error(exception=None):
+    # an exception that propagates, as in debug and testing mode, skips the response hooks, so record the request as
+    # a server error here. Does nothing for requests stop_timing already recorded
+    metrics.end_request(request.endpoint, request.method, 500, request.path)
 
-app = Flask(__name__)
-app.secret_key = 'some_secret'  # this should be replaced later on with a big, secure hash
 
+@views.teardown_app_request
+def shutdown_session(exception=None):
+    # there's no session to close unless something in this process has used the database
+    database_operations = sys.modules.get('database_operations')
+    if database_operations is not None:
+        database_operations.remove_session(exception)
 
-@app.route('/', methods=['GET', 'POST'])
+
+@views.route('/', methods=['GET', 'POST'])
 def home():
     return render_template('index.html')
 
 
-@app.route('/train', methods=['GET', 'POST'])
+@views.route('/train', methods=['GET', 'POST'])
 def base_train():
     train_model_form = RetrainModelForm()
     return render_template('train.html', train_model_form=train_model_form)
 
 
-@app.route('/new_model', methods=['GET', 'POST'])
+@views.route('/new_model', methods=['GET', 'POST'])
 def report_model():
     train_model_form = RetrainModelForm(request.form)
     if request.method == 'POST' and train_model_form.validate():
@@ -34,96 +116,302 @@ def report_model():
             flash("We're sorry, it looks like that is too small of an employee ID.")
             return redirect('/train')
 
-        # collect employee info
-        employees = get_employees_by_max_id(emp_id)
-        employee_df = employee_group_to_df(employees)
+        from training_jobs import training_queue
 
-        # train model and report fit
-        train_df, test_df = train_test_split(employee_df, train_size=0.8)
-        train_df, d = proc_df(train_df)
-        test_df, _ = proc_df(test_df)
+        # fit in the background, and send the user to a page that follows the job's progress
+        job_id, _ = training_queue.submit(emp_id, incremental=train_model_form.incremental.data,
+                                          backend=train_model_form.backend.data, tune=train_model_form.tune.data)
+        return redirect(url_for('.training_job', job_id=job_id))
 
-        try:
-            GB = train_model(train_df)
-        except ValueError:
-            flash("We're sorry, it looks like was not an approptiate employee ID, and all \
-                    employees from this segment have left the company.")
-            return redirect('/train')
+    flash("We're sorry, it looks like there wsa an error in your form.")
+    return redirect('/train')
 
-        test_score = round(GB.score(test_df[FEATURES], test_df['left']), 4)
 
-        # Save model info for later reference, tracking creation date. In future, also include test score
-        now = str(datetime.datetime.now()).replace(" ", "_")
-        dump_pickle(GB, 'models/GB_{}.pkl'.format(now))
-        dump_pickle(d, 'encodings/le_{}.pkl'.format(now))
+@views.route('/jobs/<job_id>', methods=['GET'])
+def training_job(job_id):
+    from training_jobs import training_queue
 
-        return render_template('new_model.html', test_score=test_score, emp_id=str(emp_id))
+    job = training_queue.status(job_id)
+    if job is None:
+        flash("We're sorry, it looks like that training job doesn't exist.")
+        return redirect('/train')
+    return render_template('training_job.html', job=job)
 
-    flash("We're sorry, it looks like there wsa an error in your form.")
-    return redirect('/train')
+
+@views.route('/jobs/<job_id>/status', methods=['GET'])
+def training_job_status(job_id):
+    from training_jobs import training_queue
+
+    job = training_queue.status(job_id)
+    if job is None:
+        return jsonify(error="No such training job"), 404
+    return jsonify(job)
 
 
-@app.route('/predict', methods=['GET', 'POST'])
+@views.route('/predict', methods=['GET', 'POST'])
 def predict():
     id_form = EmployeeIdForm()
     new_emp_form = NewEmployeeForm()
     return render_template('predict.html', id_form=id_form, new_emp_form=new_emp_form)
 
 
-@app.route('/prediction', methods=['GET', 'POST'])
+@views.route('/prediction', methods=['GET', 'POST'])
 def prediction():
+    from HRmodel import df_row_to_dict, predict_employee_churn
+    from scoring import new_employee_df, score_employee
+
     emp_id_form = EmployeeIdForm(request.form)
     new_emp_form = NewEmployeeForm(request.form)
     if request.method == 'POST' and emp_id_form.validate():
         emp_id = emp_id_form.emp_id.data
-        employee = get_employee_by_id(emp_id)
+        scored = score_employee(emp_id)
 
-        if employee is None:
+        if scored is None:
             flash("We're sorry, it looks like that employee isn't in the system.")
             return redirect('/predict')
 
-        test_df = employee_to_df(employee)
-        pred, proba, info = predict_employee_churn(test_df)
+        pred, proba, info = scored
         info = df_row_to_dict(info)
+        whatif_url = url_for('.whatif', emp_id=emp_id)
 
     elif request.method == 'POST' and new_emp_form.validate():
         emp_id = "custom"
 
-        # get all the data from the form
-        satisfaction_level = float(new_emp_form.satisfaction_level.data)
-        last_evaluation = float(new_emp_form.last_evaluation.data)
-        number_project = float(new_emp_form.number_project.data)
-        average_montly_hours = int(new_emp_form.average_montly_hours.data)
-        time_spend_company = int(new_emp_form.time_spend_company.data)
-        Work_accident = bool(new_emp_form.Work_accident.data)
-        promotion_last_5years = bool(new_emp_form.promotion_last_5years.data)
-        department = str(new_emp_form.department.data)
-        salary = str(new_emp_form.salary.data)
-
-        # consider using fuzzy matching for the string fields.
-        test_df = df_new_emp(
-            clip_numeric(satisfaction_level, 0, 1),
-            clip_numeric(last_evaluation, 0, 1),
-            clip_numeric(number_project, min_val=0),
-            clip_numeric(average_montly_hours, min_val=0),
-            clip_numeric(time_spend_company, min_val=0),
-            Work_accident,
-            promotion_last_5years,
-            fuzzy_match(department, DEPARTMENT_OPTIONS),
-            fuzzy_match(salary, SALARY_OPTIONS)
-        )
+        # get all the data from the form, keeping numbers in bounds and fuzzy matching the string fields
+        test_df = new_employee_df(**{field: getattr(new_emp_form, field).data for field in FEATURES})
         pred, proba, info = predict_employee_churn(test_df)
         info = df_row_to_dict(info)
+        # sweep the employee as entered, rather than as cleaned up for the model
+        whatif_url = url_for('.whatif', **{field: request.form[field] for field in FEATURES})
 
     if request.method == 'POST' and (emp_id_form.validate() or new_emp_form.validate()):
         # totally valid request, move along
-        return render_template('prediction.html', pred=str(pred).lower(), proba=proba, info=info, emp_id=str(emp_id))
+        return render_template('prediction.html', pred=str(pred).lower(), proba=proba, info=info, emp_id=str(emp_id),
+                               whatif_url=whatif_url)
 
     # information was missing from one of the above entry fields if we've made it this far
     flash("We're sorry, it looks like you missed one of the fields.")
     return redirect('/predict')
 
 
+@views.route('/whatif', methods=['GET'])
+def whatif():
+    """
+    Sweep one or two features of an employee over a grid, scoring every point in one go, and show their churn risk
+    as a curve or a heatmap. The employee is given by ?emp_id, or by the fields of the hypothetical employee form.
+    With ?format=json, returns the sweep as JSON instead.
+    """
+    from scoring import lookup_employee, new_employee_df
+    from whatif import sweep
+
+    whatif_form = WhatIfForm(request.args)
+    new_emp_form = NewEmployeeForm(request.args)
+    if not whatif_form.validate():
+        flash("We're sorry, it looks like there was an error in your form.")
+        return redirect('/predict')
+
+    if whatif_form.emp_id.data:
+        emp_id = whatif_form.emp_id.data
+        found = lookup_employee(emp_id)
+        if found is None:
+            flash("We're sorry, it looks like that employee isn't in the system.")
+            return redirect('/predict')
+        base_df = found[0]
+    elif new_emp_form.validate():
+        emp_id = "custom"
+        base_df = new_employee_df(**{field: getattr(new_emp_form, field).data for field in FEATURES})
+    else:
+        flash("We're sorry, it looks like you missed one of the fields.")
+        return redirect('/predict')
+
+    try:
+        result = sweep(base_df, whatif_form.features(), whatif_form.steps.data)
+    except ValueError as e:
+        if request.args.get('format') == 'json':
+            return jsonify(error=str(e)), 400
+        flash("We're sorry, we couldn't sweep this employee. {}.".format(e))
+        return redirect('/predict')
+    if request.args.get('format') == 'json':
+        return jsonify(emp_id=emp_id, **result)
+    # a hypothetical employee has to be passed along to the next sweep
+    employee_args = {field: request.args[field] for field in FEATURES} if emp_id == "custom" else {}
+    return render_template('whatif.html', whatif_form=whatif_form, result=result, emp_id=str(emp_id),
+                           employee_args=employee_args)
+
+
+@views.route('/at_risk', methods=['GET'])
+def at_risk():
+    from churn_scores import score_coverage, top_at_risk, top_at_risk_by_department
+
+    at_risk_form = AtRiskForm(request.args)
+    if not at_risk_form.validate():
+        flash("We're sorry, it looks like there wsa an error in your form.")
+        at_risk_form = AtRiskForm()
+
+    n, department = at_risk_form.n.data, at_risk_form.department.data
+    if department:
+        scores = {department: top_at_risk(n, department)}
+    else:
+        scores = top_at_risk_by_department(n)
+    n_scored, n_employees = score_coverage()
+    return render_template('at_risk.html', at_risk_form=at_risk_form, scores=scores, n_scored=n_scored,
+                           n_employees=n_employees)
+
+
+@views.route('/drift', methods=['GET'])
+def drift_status():
+    """
+    Show how far the employees coming in, and the churn scores going out, have drifted from what the current model
+    was trained on, offering a full retrain when they have drifted too far. With ?format=json, returns the report as
+    JSON instead, e.g. for alerting.
+    """
+    from database_operations import get_max_id
+    from drift import monitor
+
+    report = monitor.report()
+    if request.args.get('format') == 'json':
+        return jsonify(report)
+    # a drifted population is exactly when building on the previous model isn't safe, so offer a full retrain
+    train_model_form = RetrainModelForm(emp_id=get_max_id()) if report['retrain_recommended'] else None
+    return render_template('drift.html', report=report, train_model_form=train_model_form)
+
+
+@views.route('/query_db', methods=['GET'])
+def query_db():
+    import time
+    from queries import explain_query, query_employees
+
+    query_form = EmployeeQueryForm(request.args)
+    if not query_form.validate():
+        flash("We're sorry, it looks like there wsa an error in your form.")
+        query_form = EmployeeQueryForm()
+
+    filters, limit = query_form.filters(), query_form.limit.data
+    start = time.time()
+    employees, cursor = query_employees(limit, **filters)
+    seconds = time.time() - start
+    plan = explain_query(limit, **filters) if query_form.explain.data else None
+
+    args = request.args.to_dict()
+    next_url = url_for('.query_db', **dict(args, after=cursor)) if cursor is not None else None
+    first_url = url_for('.query_db', **{k: v for k, v in args.items() if k != 'after'}) if filters['after'] else None
+    return render_template('query_db.html', query_form=query_form, employees=employees.to_dict(orient='records'),
+                           columns=list(employees.columns), next_url=next_url, first_url=first_url, plan=plan,
+                           milliseconds=round(1000 * seconds, 1))
+
+
+@views.route('/batch_prediction', methods=['POST'])
+def batch_prediction():
+    """
+    Score many employees in one request. Accepts a JSON body holding either a list of "emp_ids", an ID range given
+    by "min_id" and/or "max_id", or a list of "employees" records; or a CSV file of employees, posted as the "file"
+    field or as the request body. Results are streamed back chunk by chunk, as CSV or, with ?format=json, as one
+    JSON object per line, or with ?format=parquet, as a Parquet file.
+    """
+    from database_operations import iter_csv_frames, iter_employee_frames, iter_record_frames
+
+    if 'file' in request.files:
+        frames = iter_csv_frames(request.files['file'])
+    elif request.mimetype == 'text/csv':
+        frames = iter_csv_frames(request.stream)
+    else:
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict):
+            return jsonify(error="Expected a JSON object or a CSV file of employees"), 400
+
+        try:
+            if 'emp_ids' in payload:
+                if not isinstance(payload['emp_ids'], list):
+                    raise ValueError("Expected emp_ids to be a list")
+                frames = iter_employee_frames(emp_ids=[parse_id(i) for i in payload['emp_ids']])
+            elif 'min_id' in payload or 'max_id' in payload:
+                min_id, max_id = payload.get('min_id'), payload.get('max_id')
+                frames = iter_employee_frames(min_id=None if min_id is None else parse_id(min_id),
+                                              max_id=None if max_id is None else parse_id(max_id))
+            elif 'employees' in payload:
+                frames = iter_record_frames(payload['employees'])
+            else:
+                return jsonify(error="Expected one of emp_ids, min_id/max_id or employees"), 400
+        except ValueError as e:
+            return jsonify(error=str(e)), 400
+
+    return export_response(frames, request.args.get('format', 'csv'), features=False)
+
+
+@views.route('/export', methods=['GET'])
+def export():
+    """
+    Download predictions for every employee in the database, or for an ID range given by ?min_id and/or ?max_id,
+    alongside their features. Employees are read, scored and written out a chunk at a time, as CSV or, with
+    ?format=json or ?format=parquet, as one JSON object per line or a Parquet file.
+    """
+    from database_operations import iter_employee_frames
+
+    frames = iter_employee_frames(min_id=request.args.get('min_id', type=int),
+                                  max_id=request.args.get('max_id', type=int))
+    return export_response(frames, request.args.get('format', 'csv'), attachment='employee_churn')
+
+
+def parse_id(value):
+    """
+    :param value: Employee ID from a JSON payload
+    :return: The ID as an integer
+    :raises ValueError: If it isn't a whole number
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError("Expected an employee ID, got {!r}".format(value))
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError("Expected an employee ID, got {!r}".format(value))
+
+
+def export_response(frames, out_format, features=True, attachment=None):
+    """
+    :param frames: Iterable of data frames of employees to score
+    :param out_format: One of export.EXPORT_FORMATS
+    :param features: Keep every input column alongside the predictions, rather than just the Emp_ID
+    :param attachment: File name, without extension, to download the results as
+    :return: Response streaming the predictions as they are scored, or an error response if the format is unknown
+        or the first chunk can't be scored
+    """
+    import export
+
+    try:
+        body = export.iter_export(frames, out_format, features)
+    except (ValueError, ImportError) as e:
+        return jsonify(error=str(e)), 400
+    except KeyError as e:
+        return jsonify(error="Missing column {}".format(e)), 400
+
+    response = Response(stream_with_context(body), mimetype=export.MIMETYPES[out_format])
+    if attachment is not None:
+        response.headers['Content-Disposition'] = 'attachment; filename={}.{}'.format(attachment, out_format)
+    return response
+
+
+@views.route('/model_status', methods=['GET'])
+def model_status():
+    from model_registry import registry
+
+    return jsonify(registry.stats())
+
+
+@views.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@views.route('/cache_status', methods=['GET'])
+def cache_status():
+    import feature_store
+
+    stats = prediction_cache.stats()
+    if feature_store.enabled():
+        stats['feature_store'] = feature_store.store.stats()
+    return jsonify(stats)
+
+
 if __name__ == '__main__':
     # for testing purposes
-    app.run(host='0.0.0.0', port=8080)
+    create_app().run(host='0.0.0.0', port=8080)
@@ -0,0 +1,141 @@
+"""
+Talk to the inference server (see inference_server.py) over its Unix socket. This module only needs the standard
+library, so web workers that hand scoring off to the server never have to load the model themselves.
+
+Messages in both directions are a 4 byte big-endian length followed by that many bytes of UTF-8 encoded JSON.
+"""
+
+import json
+import socket
+import struct
+import threading
+
+import config
+
+
+HEADER = struct.Struct('>I')
+
+
+class InferenceTimeout(socket.timeout):
+    """
+    The server gave up on scoring a request in time. An OSError, like the server not being reached at all, so callers
+    that fall back to scoring locally do so for a slow server too.
+    """
+
+
+def send_message(sock, message):
+    """
+    :param sock: Connected socket
+    :param message: JSON serializable object
+    :return: None
+    """
+    payload = json.dumps(message, default=_to_python).encode('utf-8')
+    sock.sendall(HEADER.pack(len(payload)) + payload)
+
+
+def _to_python(value):
+    # NumPy scalars, as found in data frames, know how to turn themselves into plain Python values
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+def recv_message(sock):
+    """
+    :param sock: Connected socket
+    :return: Decoded message, or None if the other end closed the connection
+    """
+    header = _recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    payload = _recv_exactly(sock, HEADER.unpack(header)[0])
+    if payload is None:
+        raise ConnectionError("Connection closed in the middle of a message")
+    return json.loads(payload.decode('utf-8'))
+
+
+def _recv_exactly(sock, n_bytes):
+    chunks = []
+    while n_bytes:
+        chunk = sock.recv(min(n_bytes, 1 << 16))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        n_bytes -= len(chunk)
+    return b''.join(chunks)
+
+
+class InferenceClient(object):
+    """
+    Send employees to the inference server to be scored. Each thread keeps its own connection open between requests,
+    and reconnects once if the connection turns out to be broken, e.g. after the server restarted.
+    """
+
+    def __init__(self, socket_path, timeout=5.0):
+        """
+        :param socket_path: Path of the server's Unix socket
+        :param timeout: Seconds to wait for a reply before giving up
+        """
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self._local.sock = sock
+        return sock
+
+    def close(self):
+        sock = getattr(self._local, 'sock', None)
+        if sock is not None:
+            sock.close()
+            self._local.sock = None
+
+    def request(self, message):
+        """
+        :param message: JSON serializable request
+        :return: Decoded reply
+        :raises OSError: If the server can't be reached
+        :raises InferenceTimeout: If the server didn't score the request in time
+        :raises ValueError: If the server couldn't handle the request, e.g. because of an unseen category
+        """
+        for attempt in range(2):
+            sock = getattr(self._local, 'sock', None)
+            try:
+                if sock is None:
+                    sock = self._connect()
+                send_message(sock, message)
+                reply = recv_message(sock)
+                if reply is None:
+                    raise ConnectionError("Inference server closed the connection")
+                break
+            except OSError:
+                self.close()
+                if attempt:
+                    raise
+
+        if reply.get('timeout'):
+            raise InferenceTimeout(reply['error'])
+        if 'error' in reply:
+            raise ValueError(reply['error'])
+        return reply
+
+    def predict(self, rows):
+        """
+        :param rows: List of employees, each a list of feature values in model feature order
+        :return: Dictionary holding the model version, and lists of the hard prediction and churn probability for
+            each employee
+        """
+        return self.request({'op': 'predict', 'rows': rows})
+
+    def stats(self):
+        """
+        :return: Dictionary of counters kept by the server, e.g. the number of requests and batches scored
+        """
+        return self.request({'op': 'stats'})
+
+
+# Only set up when the web application is configured to hand scoring off to the server
+client = InferenceClient(config.INFERENCE_SOCKET, config.INFERENCE_TIMEOUT) if config.INFERENCE_SOCKET else None
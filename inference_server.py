@@ -0,0 +1,283 @@
+"""
+Local inference server, so that web workers don't each have to hold the model and spend their time scoring. A small
+pool of processes, one per core by default, each loads the model once and keeps it up to date through its own model
+registry. Web workers send employees over a Unix socket (see inference_client.py).
+
+Requests that arrive within a few milliseconds of each other, or while every pool process is busy, are gathered into
+a single batch and scored with one vectorized call, then the results are split back out to each request. A batch that
+isn't scored within config.INFERENCE_TIMEOUT, e.g. because its pool process died, fails with a timeout and gives its
+place in the pool back, so a lost batch never holds up the ones behind it.
+
+Run as main method, and point the web application at the socket with HR_INFERENCE_SOCKET:
+    $ python inference_server.py --socket inference.sock --workers 4
+    $ HR_INFERENCE_SOCKET=inference.sock gunicorn --workers 16 wsgi:app
+"""
+
+import argparse
+import multiprocessing
+import os
+import queue
+import socket
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+import numpy as np
+import pandas as pd
+
+import config
+from HRmodel import FEATURES, predict_employee_churn_batch
+from inference_client import recv_message, send_message
+from model_registry import registry
+
+
+def load_model():
+    """
+    Load the model as soon as a pool process starts, rather than on its first batch.
+    """
+    registry.compiled()
+
+
+def score_rows(rows):
+    """
+    Score a batch of employees with the most recent model. Runs in a pool process.
+
+    :param rows: List of employees, each a list of feature values in model feature order
+    :return: Tuple of model version, list of hard predictions and list of churn probabilities
+    """
+    version, GB, d, compiled = registry.compiled()
+    if compiled is not None:
+        probas = compiled.predict_proba(compiled.encode(rows))
+        churn = probas[:, list(compiled.classes).index(1)]
+        predictions = compiled.classes.take(probas.argmax(axis=1)).astype(bool)
+    else:
+        results = predict_employee_churn_batch(pd.DataFrame(rows, columns=FEATURES), GB, d, version)
+        churn, predictions = results['churn_probability'].values, results['prediction'].values
+    return version, predictions.tolist(), np.round(churn, 4).tolist()
+
+
+class InferenceServer(object):
+    """
+    Accept connections on a Unix socket, with a thread per connection. Requests go on a queue, from which a batching
+    thread builds batches and hands them to the process pool, at most one per pool process at a time. A reaper thread
+    fails the batches that run past their deadline.
+    """
+
+    def __init__(self, socket_path, n_workers=config.INFERENCE_WORKERS, max_wait=config.INFERENCE_MAX_WAIT,
+                 max_batch=config.INFERENCE_MAX_BATCH, timeout=config.INFERENCE_TIMEOUT):
+        """
+        :param socket_path: Path of the Unix socket to listen on
+        :param n_workers: Number of pool processes
+        :param max_wait: Seconds to wait for more requests to join a batch
+        :param max_batch: Most employees scored in one batch
+        :param timeout: Seconds a batch may take to score, and a request to be answered
+        """
+        self.socket_path = socket_path
+        self.n_workers = n_workers
+        self.max_wait = max_wait
+        self.max_batch = max_batch
+        self.timeout = timeout
+
+        self._requests = queue.Queue()
+        self._free_workers = threading.Semaphore(n_workers)
+        self._in_flight = {}  # batch number -> (deadline, batch), for batches holding a place in the pool
+        self._batch_number = 0
+        self._pool = None
+        self._lock = threading.Lock()
+        self.counters = {'requests': 0, 'rows': 0, 'batches': 0, 'errors': 0, 'timeouts': 0}
+
+    def serve_forever(self):
+        """
+        Start the process pool and the batching thread, then handle connections until interrupted.
+
+        :return: None
+        """
+        self._pool = multiprocessing.Pool(self.n_workers, initializer=load_model)
+        for target in (self._batch_loop, self._reap_loop):
+            thread = threading.Thread(target=target, name=target.__name__.strip('_'))
+            thread.daemon = True
+            thread.start()
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        listener.listen(128)
+        try:
+            while True:
+                conn, _ = listener.accept()
+                handler = threading.Thread(target=self._handle_connection, args=(conn,))
+                handler.daemon = True
+                handler.start()
+        finally:
+            listener.close()
+            os.remove(self.socket_path)
+            self._pool.terminate()
+
+    def _handle_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    message = recv_message(conn)
+                except (OSError, ValueError):
+                    return
+                if message is None:
+                    return
+
+                if message.get('op') == 'stats':
+                    reply = self.stats()
+                elif message.get('op') == 'predict':
+                    try:
+                        version, predictions, churn = self.submit(message['rows']).result(timeout=self.timeout)
+                        reply = {'version': version, 'prediction': predictions, 'churn_probability': churn}
+                    except TimeoutError:
+                        reply = {'error': "Scoring took longer than {}s".format(self.timeout), 'timeout': True}
+                    except Exception as e:
+                        reply = {'error': str(e)}
+                else:
+                    reply = {'error': "Unknown op '{}'".format(message.get('op'))}
+
+                try:
+                    send_message(conn, reply)
+                except OSError:
+                    return
+
+    def submit(self, rows, alone=False):
+        """
+        :param rows: List of employees, each a list of feature values in model feature order
+        :param alone: Score these rows in a batch of their own
+        :return: Future, holding the result of score_rows for just these rows once their batch is scored
+        """
+        future = Future()
+        self._requests.put((rows, future, alone))
+        return future
+
+    def _batch_loop(self):
+        held = None
+        while True:
+            # while every pool process is busy, requests pile up on the queue and go out as one batch
+            self._free_workers.acquire()
+            item = held if held is not None else self._requests.get()
+            held = None
+            batch = [item[:2]]
+            n_rows = len(item[0])
+            deadline = time.time() + self.max_wait
+            while not item[2] and n_rows < self.max_batch:
+                try:
+                    item = self._requests.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty:
+                    break
+                if item[2]:
+                    # goes out on its own, as the next batch
+                    held = item
+                    break
+                batch.append(item[:2])
+                n_rows += len(item[0])
+            self._dispatch(batch)
+
+    def _dispatch(self, batch):
+        """
+        Hand a batch to the pool, on the place in the pool taken for it by the batching loop.
+        """
+        rows = [row for request_rows, _ in batch for row in request_rows]
+        with self._lock:
+            self._batch_number += 1
+            number = self._batch_number
+            self._in_flight[number] = (time.time() + self.timeout, batch)
+            self.counters['requests'] += len(batch)
+            self.counters['rows'] += len(rows)
+            self.counters['batches'] += 1
+        self._pool.apply_async(score_rows, (rows,), callback=lambda result: self._split(number, result),
+                               error_callback=lambda e: self._fail(number, e))
+
+    def _release(self, number):
+        """
+        Give back the place in the pool held by a batch, the first time it is scored, fails or times out.
+
+        :return: The batch, or None if it was already released
+        """
+        with self._lock:
+            entry = self._in_flight.pop(number, None)
+        if entry is None:
+            return None
+        self._free_workers.release()
+        return entry[1]
+
+    def _split(self, number, result):
+        batch = self._release(number)
+        if batch is None:
+            return
+        version, predictions, churn = result
+        start = 0
+        for rows, future in batch:
+            end = start + len(rows)
+            future.set_result((version, predictions[start:end], churn[start:end]))
+            start = end
+
+    def _fail(self, number, error):
+        batch = self._release(number)
+        if batch is None:
+            return
+        if len(batch) > 1:
+            # don't let one bad request fail the others it was batched with, but retry each through the queue, so
+            # that it waits for a place in the pool and is timed like any other batch
+            for rows, future in batch:
+                retry = self.submit(rows, alone=True)
+                retry.add_done_callback(lambda done, future=future: _copy_outcome(done, future))
+            return
+        with self._lock:
+            self.counters['errors'] += 1
+        batch[0][1].set_exception(error)
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(min(self.timeout / 4., 1.0))
+            now = time.time()
+            with self._lock:
+                expired = [number for number, (deadline, _) in self._in_flight.items() if deadline < now]
+            for number in expired:
+                batch = self._release(number)
+                if batch is None:
+                    continue
+                with self._lock:
+                    self.counters['timeouts'] += 1
+                for _, future in batch:
+                    future.set_exception(TimeoutError("Scoring took longer than {}s".format(self.timeout)))
+
+    def stats(self):
+        """
+        :return: Dictionary of counters, including the mean number of employees scored per batch
+        """
+        with self._lock:
+            stats = dict(self.counters)
+        stats['rows_per_batch'] = round(stats['rows'] / stats['batches'], 2) if stats['batches'] else None
+        stats['workers'] = self.n_workers
+        return stats
+
+
+def _copy_outcome(source, target):
+    """
+    Settle a future with the result or exception of another.
+    """
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    else:
+        target.set_result(source.result())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--socket', default=config.INFERENCE_SOCKET or 'inference.sock',
+                        help="Path of the Unix socket to listen on")
+    parser.add_argument('--workers', type=int, default=config.INFERENCE_WORKERS, help="Number of pool processes")
+    parser.add_argument('--max-wait', type=float, default=config.INFERENCE_MAX_WAIT,
+                        help="Seconds to wait for more requests to join a batch")
+    parser.add_argument('--max-batch', type=int, default=config.INFERENCE_MAX_BATCH,
+                        help="Most employees scored in one batch")
+    parser.add_argument('--timeout', type=float, default=config.INFERENCE_TIMEOUT,
+                        help="Seconds a batch may take to score")
+    args = parser.parse_args()
+
+    server = InferenceServer(args.socket, args.workers, args.max_wait, args.max_batch, args.timeout)
+    print("Serving predictions on {} with {} workers".format(args.socket, args.workers))
+    server.serve_forever()
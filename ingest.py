@@ -0,0 +1,158 @@
+"""
+Load employee records from CSV files into the HR database in bulk. Files are streamed in chunks, so memory use stays
+flat however large they are. Department and salary values are fuzzy matched once per distinct value in each chunk,
+and each chunk is written with a single executemany of plain tuples inside its own transaction, skipping the
+per-row overhead of building dictionaries and binding them through SQLAlchemy. Secondary indexes on the employee
+table are dropped for the duration of the load and rebuilt at the end, which is much faster than updating them row
+by row. These are the indexes declared on Employee in sqlite_declarative.py, which the query layer relies on, and
+they are built at the end of every load even if the database didn't have them before.
+
+Run as main method with the files to load, e.g.:
+    $ python ingest.py data/train.csv data/test.csv
+"""
+
+import argparse
+import time
+
+import pandas as pd
+from sqlalchemy import bindparam, inspect, select
+
+import config
+import database_operations
+import drift
+import feature_store
+import prediction_cache
+from sqlite_declarative import Base, ChurnScore, Employee
+
+
+# Chunk size that keeps a chunk of the HR data at a few tens of MB
+CHUNKSIZE = 100000
+
+# Columns of the original Kaggle HR dataset that are named differently in the database
+COLUMN_ALIASES = {'sales': 'department'}
+
+ON_CONFLICT = ('abort', 'ignore', 'replace')
+
+
+def prepare_chunk(chunk, next_id):
+    """
+    Get a chunk of a CSV file ready for inserting: rename columns, number employees if the file has no Emp_ID
+    column, drop incomplete rows and canonicalize department and salary.
+
+    :param chunk: Data frame read from a CSV file
+    :param next_id: Employee ID given to the first row, if the file has no Emp_ID column
+    :return: Data frame holding exactly the Employee columns, and the number of incomplete rows dropped
+    """
+    chunk = chunk.rename(columns=COLUMN_ALIASES)
+    if 'Emp_ID' not in chunk.columns:
+        chunk['Emp_ID'] = range(next_id, next_id + len(chunk))
+
+    columns = [c.name for c in Employee.__table__.columns]
+    missing = [c for c in columns if c not in chunk.columns]
+    if missing:
+        raise ValueError("CSV is missing the columns {}".format(missing))
+
+    n_rows = len(chunk)
+    chunk = chunk[columns].dropna()
+    return database_operations.canonicalize_df(chunk), n_rows - len(chunk)
+
+
+def ingest_csv(paths, chunksize=CHUNKSIZE, on_conflict='abort'):
+    """
+    Load CSV files of employees into the database, creating the tables first if needed.
+
+    :param paths: Paths of the CSV files, loaded in order
+    :param chunksize: Number of rows read, and inserted in one transaction, at a time
+    :param on_conflict: What to do with a row whose Emp_ID is already in the database: 'abort' the load, 'ignore'
+        the row, or 'replace' the employee
+    :return: List of result dictionaries, one per file, and the seconds taken to rebuild indexes at the end. Each
+        result counts the complete rows read, and those of them ignored for a conflict.
+    """
+    if on_conflict not in ON_CONFLICT:
+        raise ValueError("Unknown on_conflict '{}', expected one of {}".format(on_conflict, ON_CONFLICT))
+
+    engine = database_operations.get_engine()
+    Base.metadata.create_all(engine)
+    insert = Employee.__table__.insert()
+    if on_conflict != 'abort':
+        insert = insert.prefix_with('OR {}'.format(on_conflict.upper()))
+    # compiled once, with a positional parameter for each column in table order
+    columns = [c.name for c in Employee.__table__.columns]
+    insert_sql = str(insert.compile(dialect=engine.dialect))
+    delete_scores = ChurnScore.__table__.delete().where(ChurnScore.Emp_ID == bindparam('emp_id'))
+
+    # updating indexes row by row is what makes large loads slow, so rebuild them once at the end. Building every
+    # declared index there, rather than only those dropped, also gives them to databases created before they existed
+    indexes = list(Employee.__table__.indexes)
+    existing = {index['name'] for index in inspect(engine).get_indexes(Employee.__tablename__)}
+    for index in indexes:
+        if index.name in existing:
+            index.drop(engine)
+
+    results = []
+    try:
+        next_id = (database_operations.get_max_id() or 0) + 1
+        database_operations.remove_session()
+        for path in paths:
+            start = time.perf_counter()
+            result = {'file': path, 'rows': 0, 'skipped': 0, 'ignored': 0}
+            for chunk in pd.read_csv(path, header=0, chunksize=chunksize):
+                chunk, skipped = prepare_chunk(chunk, next_id)
+                # Series.tolist gives plain Python values, which the driver binds without any conversion
+                records = list(zip(*[chunk[c].tolist() for c in columns]))
+                written = chunk
+                with engine.begin() as conn:
+                    if on_conflict == 'ignore' and records:
+                        # rows already in the database, or earlier in the chunk, are left out by the insert, so they
+                        # aren't incoming employees either
+                        existing = conn.execute(select([Employee.Emp_ID]).where(
+                            Employee.Emp_ID.between(int(chunk['Emp_ID'].min()), int(chunk['Emp_ID'].max()))))
+                        existing = [row[0] for row in existing]
+                        written = chunk[~chunk['Emp_ID'].isin(existing) & ~chunk['Emp_ID'].duplicated()]
+                    if records:
+                        conn.connection.cursor().executemany(insert_sql, records)
+                    if on_conflict == 'replace' and records:
+                        # replaced employees must be rescored
+                        conn.execute(delete_scores, [{'emp_id': emp_id} for emp_id in chunk['Emp_ID'].tolist()])
+
+                drift.monitor.observe('incoming', written)
+                result['rows'] += len(records)
+                result['ignored'] += len(chunk) - len(written)
+                result['skipped'] += skipped
+                if len(chunk):
+                    next_id = max(next_id, int(chunk['Emp_ID'].max()) + 1)
+
+            result['seconds'] = round(time.perf_counter() - start, 3)
+            result['rows_per_second'] = int(result['rows'] / result['seconds']) if result['seconds'] else None
+            results.append(result)
+    finally:
+        start = time.perf_counter()
+        for index in indexes:
+            index.create(engine)
+        if engine.dialect.name == 'sqlite':
+            # refresh the statistics the query planner uses to pick indexes
+            engine.execute('ANALYZE')
+        index_seconds = round(time.perf_counter() - start, 3)
+
+    if on_conflict == 'replace':
+        prediction_cache.employee_features.clear()
+        feature_store.record_writes()
+    return results, index_seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help="CSV files of employees")
+    parser.add_argument('--database', default=None, help="Database address. Will use config.DATABASE_URL if not "
+                                                         "provided.")
+    parser.add_argument('--chunksize', type=int, default=CHUNKSIZE)
+    parser.add_argument('--on-conflict', default='abort', choices=ON_CONFLICT,
+                        help="What to do with rows whose Emp_ID is already in the database")
+    args = parser.parse_args()
+
+    if args.database is not None:
+        config.DATABASE_URL = args.database
+
+    results, index_seconds = ingest_csv(args.paths, args.chunksize, args.on_conflict)
+    print(pd.DataFrame(results).to_string(index=False))
+    print("Rebuilt indexes in {}s".format(index_seconds))
@@ -0,0 +1,219 @@
+"""
+Load generator for the web application. A number of clients each send one request after another, as soon as the
+previous one is answered, picking every request at random from a mix of:
+    lookup   POST /prediction with an employee ID
+    custom   POST /prediction with a hypothetical employee
+    retrain  POST /new_model, submitting a full retrain up to a random employee ID (timed up to the redirect to the
+             job page, while the job itself keeps the server busy in the background)
+and reports the latency percentiles, throughput and error rate of each, so that the number and class of gunicorn
+workers can be sized from measurements. Only the standard library and schema.py are used, so it can run from
+another machine than the one under test.
+
+Run as main method against a running server, e.g.:
+    $ python loadtest.py http://127.0.0.1:8080 --mix lookup=80,custom=18,retrain=2 --clients 16 --duration 30
+
+To start gunicorn on a synthetic database and sweep worker counts and worker classes, see `benchmarks.py load`.
+"""
+
+import argparse
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from schema import DEPARTMENT_OPTIONS, SALARY_OPTIONS
+
+
+REQUEST_TYPES = ('lookup', 'custom', 'retrain')
+
+DEFAULT_MIX = {'lookup': 80, 'custom': 18, 'retrain': 2}
+
+PERCENTILES = (50, 95, 99)
+
+# Smallest employee ID /new_model accepts
+MIN_RETRAIN_ID = 340
+
+
+def parse_mix(text):
+    """
+    :param text: Relative weight of each request type, e.g. 'lookup=80,custom=18,retrain=2'. Types left out are not
+        sent.
+    :return: Dictionary of request type to weight
+    :raises ValueError: If a request type is unknown, or a weight isn't a number at least zero
+    """
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in REQUEST_TYPES:
+            raise ValueError("Unknown request type '{}', expected one of {}".format(name, REQUEST_TYPES))
+        mix[name] = float(weight) if weight else 1.0
+        if mix[name] < 0:
+            raise ValueError("The weight of {} can't be negative".format(name))
+    if not sum(mix.values()):
+        raise ValueError("Expected at least one request type with a positive weight")
+    return mix
+
+
+def format_mix(mix):
+    return ','.join('{}={:g}'.format(name, mix[name]) for name in REQUEST_TYPES if name in mix)
+
+
+def random_employee(rng):
+    """
+    :param rng: random.Random
+    :return: Form fields of a hypothetical employee, as entered on the prediction page
+    """
+    return {
+        'satisfaction_level': round(rng.uniform(0.09, 1.0), 2),
+        'last_evaluation': round(rng.uniform(0.36, 1.0), 2),
+        'number_project': rng.randint(2, 7),
+        'average_montly_hours': rng.randint(96, 310),
+        'time_spend_company': rng.randint(2, 10),
+        'Work_accident': str(rng.random() < 0.15),
+        'promotion_last_5years': str(rng.random() < 0.02),
+        'department': rng.choice(DEPARTMENT_OPTIONS),
+        'salary': rng.choice(SALARY_OPTIONS),
+    }
+
+
+def build_request(request_type, rng, max_id):
+    """
+    :param request_type: One of REQUEST_TYPES
+    :param rng: random.Random
+    :param max_id: Largest employee ID in the database
+    :return: Path and form fields of a request of the given type
+    """
+    if request_type == 'lookup':
+        return '/prediction', {'emp_id': rng.randint(1, max_id)}
+    if request_type == 'custom':
+        return '/prediction', random_employee(rng)
+    return '/new_model', {'emp_id': rng.randint(min(max(MIN_RETRAIN_ID, max_id // 2), max_id), max_id)}
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # a redirect is the answer, e.g. /new_model sending the user to the job page, so don't follow it
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+_opener = urllib.request.build_opener(_NoRedirect)
+
+
+def send(url, data, timeout):
+    """
+    :param url: URL to POST to
+    :param data: Form fields
+    :param timeout: Seconds to wait for the response
+    :return: HTTP status code, or None if no response came back
+    """
+    try:
+        with _opener.open(url, urllib.parse.urlencode(data).encode(), timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except (IOError, OSError):
+        return None
+
+
+def percentile(sorted_values, q):
+    """
+    :return: The q-th percentile of a sorted list, by linear interpolation between the closest ranks
+    """
+    position = (len(sorted_values) - 1) * q / 100.
+    low = int(position)
+    high = min(low + 1, len(sorted_values) - 1)
+    return sorted_values[low] + (sorted_values[high] - sorted_values[low]) * (position - low)
+
+
+def summarize(request_type, samples, seconds):
+    """
+    :param request_type: Name to report the samples under
+    :param samples: List of (latency in seconds, HTTP status code or None) of the requests answered
+    :param seconds: Length of the measurement
+    :return: Dictionary of the number of requests, throughput, error rate and latency percentiles of the successful
+        requests, in milliseconds
+    """
+    latencies = sorted(latency for latency, status in samples if status is not None and status < 400)
+    errors = len(samples) - len(latencies)
+    result = {'request': request_type, 'requests': len(samples), 'errors': errors,
+              'error_rate': round(errors / float(len(samples)), 4) if samples else 0.0,
+              'requests_per_second': round(len(latencies) / seconds, 2)}
+    for q in PERCENTILES:
+        result['latency_p{}_ms'.format(q)] = round(1000 * percentile(latencies, q), 2) if latencies else None
+    result['latency_max_ms'] = round(1000 * latencies[-1], 2) if latencies else None
+    return result
+
+
+def run_load(base_url, mix=None, clients=8, duration=30.0, warmup=5.0, max_id=15000, timeout=60.0, seed=1234):
+    """
+    Send a mix of requests from many clients at once for a while, and measure how the server copes.
+
+    :param base_url: Address of the web application, e.g. 'http://127.0.0.1:8080'
+    :param mix: Dictionary of request type to its relative weight. Will use DEFAULT_MIX if not provided.
+    :param clients: Number of clients sending requests at the same time
+    :param duration: Seconds to measure for
+    :param warmup: Seconds to send requests for before measuring, e.g. for the workers to load the model
+    :param max_id: Largest employee ID in the database, to look up and retrain up to
+    :param timeout: Seconds a request may take before counting as an error
+    :param seed: Random seed, so that runs send the same requests in the same order
+    :return: List of result dictionaries, one per request type in the mix and one for every request together
+    """
+    mix = mix or DEFAULT_MIX
+    names = [name for name in REQUEST_TYPES if mix.get(name)]
+    weights = [mix[name] for name in names]
+    base_url = base_url.rstrip('/')
+
+    measure_from = time.perf_counter() + warmup
+    stop_at = measure_from + duration
+    samples = [[] for _ in range(clients)]
+
+    def client(i):
+        rng = random.Random(seed + i)
+        while True:
+            start = time.perf_counter()
+            if start >= stop_at:
+                return
+            request_type = rng.choices(names, weights)[0]
+            path, data = build_request(request_type, rng, max_id)
+            status = send(base_url + path, data, timeout)
+            if start >= measure_from:
+                samples[i].append((request_type, time.perf_counter() - start, status))
+
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # requests still in flight when the clock ran out are answered afterwards, and count towards the throughput
+    seconds = max(time.perf_counter(), stop_at) - measure_from
+
+    answered = [sample for client_samples in samples for sample in client_samples]
+    results = [summarize(name, [(latency, status) for request_type, latency, status in answered
+                                if request_type == name], seconds) for name in names]
+    results.append(summarize('all', [(latency, status) for _, latency, status in answered], seconds))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('url', help="Address of the web application, e.g. http://127.0.0.1:8080")
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help="Relative weight of each request type (default: {})".format(format_mix(DEFAULT_MIX)))
+    parser.add_argument('--clients', type=int, default=8, help="Number of clients sending requests at the same time")
+    parser.add_argument('--duration', type=float, default=30.0, help="Seconds to measure for")
+    parser.add_argument('--warmup', type=float, default=5.0, help="Seconds to send requests for before measuring")
+    parser.add_argument('--max-id', type=int, default=15000, help="Largest employee ID in the database")
+    parser.add_argument('--timeout', type=float, default=60.0, help="Seconds before a request counts as an error")
+    args = parser.parse_args()
+
+    print("{} clients sending {} to {} for {:g}s".format(args.clients, format_mix(args.mix), args.url,
+                                                          args.duration))
+    header = ['request', 'requests', 'errors', 'error_rate', 'requests_per_second'] + \
+        ['latency_p{}_ms'.format(q) for q in PERCENTILES] + ['latency_max_ms']
+    print(' '.join('{:>20}'.format(h) for h in header))
+    for row in run_load(args.url, args.mix, args.clients, args.duration, args.warmup, args.max_id, args.timeout):
+        print(' '.join('{:>20}'.format(str(row[h])) for h in header))
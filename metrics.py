@@ -0,0 +1,264 @@
+"""
+Time the stages of handling a request (database queries, fuzzy matching, encoding, loading and running the model,
+rendering templates) and the requests themselves, and serve the results in the Prometheus text format.
+
+Every process aggregates its own timings into latency histograms, and writes them to a file of its own in
+config.METRICS_DIR every so often. The /metrics endpoint adds up the files of every process, so a scrape reports on
+all gunicorn workers and training processes, whichever worker happens to serve it.
+
+Requests slower than config.SLOW_REQUEST_SECONDS are written to the slow request log, with the time spent in each
+stage. Stages can nest, e.g. proc_df runs within predict_employee_churn.
+"""
+
+import atexit
+import bisect
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import config
+
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Seconds between writes of this process's histograms to the metrics directory
+FLUSH_INTERVAL = 1.0
+
+HELP = {
+    'hr_request_seconds': "Time taken to handle requests, by endpoint",
+    'hr_stage_seconds': "Time spent in each stage of handling requests and training models",
+}
+
+slow_request_log = logging.getLogger('hr.slow_requests')
+
+
+class Histogram(object):
+    """
+    Counts of observations falling in each bucket, along with their sum, as in a Prometheus histogram.
+    """
+
+    def __init__(self, counts=None, total=0.0, count=0):
+        self.counts = list(counts) if counts is not None else [0] * (len(BUCKETS) + 1)
+        self.total = total
+        self.count = count
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.total += other.total
+        self.count += other.count
+
+
+_histograms = {}  # (metric name, sorted label items) -> Histogram
+_lock = threading.Lock()
+_local = threading.local()
+_pid = os.getpid()
+_last_flush = 0.0
+
+
+def _check_fork():
+    # a forked process starts with a copy of its parent's timings, which the parent already reports
+    global _histograms, _pid, _last_flush
+    if os.getpid() != _pid:
+        _histograms, _pid, _last_flush = {}, os.getpid(), 0.0
+
+
+def observe(name, seconds, **labels):
+    """
+    Record one observation of a histogram.
+
+    :param name: Metric name
+    :param seconds: Observed duration
+    :param labels: Labels of the metric
+    :return: None
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _check_fork()
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+
+@contextmanager
+def span(stage):
+    """
+    Time a block of code as a stage, e.g.:
+        with metrics.span('render_template'):
+            ...
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        observe('hr_stage_seconds', seconds, stage=stage)
+        stages = getattr(_local, 'stages', None)
+        if stages is not None:
+            stages.append((stage, seconds))
+
+
+def timed(stage):
+    """
+    Decorator timing every call of a function as a stage.
+
+    :param stage: Name of the stage
+    :return: Decorator
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_request():
+    """
+    Start timing a request handled by this thread.
+
+    :return: None
+    """
+    _local.stages = []
+    _local.start = time.perf_counter()
+
+
+def end_request(endpoint, method, status, path=None):
+    """
+    Record the time taken by the request handled by this thread, and log it if it was slow. Does nothing if it was
+    already recorded.
+
+    :param endpoint: Name of the view that handled the request
+    :param method: HTTP method
+    :param status: HTTP status code of the response
+    :param path: Path of the request, for the slow request log
+    :return: None
+    """
+    start, stages = getattr(_local, 'start', None), getattr(_local, 'stages', None)
+    _local.start, _local.stages = None, None
+    if start is None:
+        return
+
+    seconds = time.perf_counter() - start
+    observe('hr_request_seconds', seconds, endpoint=endpoint or 'unknown', method=method, status=str(status))
+    if config.SLOW_REQUEST_SECONDS and seconds >= config.SLOW_REQUEST_SECONDS:
+        log_slow_request(path or endpoint, method, status, seconds, stages)
+    if time.time() - _last_flush >= FLUSH_INTERVAL:
+        flush()
+
+
+def log_slow_request(path, method, status, seconds, stages):
+    """
+    Write a slow request to the slow request log as a line of JSON, with the total time and number of calls of
+    each stage it went through.
+    """
+    breakdown = defaultdict(lambda: {'seconds': 0.0, 'calls': 0})
+    for stage, stage_seconds in stages or []:
+        breakdown[stage]['seconds'] += stage_seconds
+        breakdown[stage]['calls'] += 1
+    for stage in breakdown.values():
+        stage['seconds'] = round(stage['seconds'], 6)
+    slow_request_log.warning(json.dumps({'path': path, 'method': method, 'status': status,
+                                         'seconds': round(seconds, 6), 'pid': os.getpid(), 'stages': breakdown}))
+
+
+def configure_slow_request_log(path=None):
+    """
+    Send the slow request log to a file, unless it already has somewhere to go.
+
+    :param path: Path of the log file. Will use config.SLOW_REQUEST_LOG if not provided.
+    :return: None
+    """
+    if not slow_request_log.handlers and config.SLOW_REQUEST_SECONDS:
+        handler = logging.FileHandler(path or config.SLOW_REQUEST_LOG)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        slow_request_log.addHandler(handler)
+        slow_request_log.propagate = False
+
+
+def flush():
+    """
+    Write this process's histograms to its file in the metrics directory.
+
+    :return: None
+    """
+    global _last_flush
+    if not config.METRICS_DIR:
+        return
+    with _lock:
+        _check_fork()
+        _last_flush = time.time()
+        if not _histograms:
+            return
+        snapshot = [[name, dict(labels), h.counts, h.total, h.count] for (name, labels), h in _histograms.items()]
+
+    if not os.path.isdir(config.METRICS_DIR):
+        os.makedirs(config.METRICS_DIR, exist_ok=True)
+    path = os.path.join(config.METRICS_DIR, '{}.json'.format(os.getpid()))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+
+# write out whatever was timed since the last flush when the process exits
+atexit.register(flush)
+
+
+def collect():
+    """
+    :return: Dictionary of (metric name, sorted label items) to the histogram summed over every process
+    """
+    if not config.METRICS_DIR:
+        with _lock:
+            return {key: Histogram(h.counts, h.total, h.count) for key, h in _histograms.items()}
+
+    flush()
+    totals = {}
+    for file_name in os.listdir(config.METRICS_DIR):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(config.METRICS_DIR, file_name)) as f:
+                snapshot = json.load(f)
+        except (IOError, ValueError):
+            continue
+        for name, labels, counts, total, count in snapshot:
+            key = (name, tuple(sorted(labels.items())))
+            totals.setdefault(key, Histogram()).merge(Histogram(counts, total, count))
+    return totals
+
+
+def render():
+    """
+    :return: Every histogram, in the Prometheus text exposition format
+    """
+    lines = []
+    histograms = collect()
+    for name in sorted({name for name, _ in histograms}):
+        lines.append('# HELP {} {}'.format(name, HELP.get(name, name)))
+        lines.append('# TYPE {} histogram'.format(name))
+        for (metric, labels), histogram in sorted(histograms.items()):
+            if metric != name:
+                continue
+            label_text = ','.join('{}="{}"'.format(k, v) for k, v in labels)
+            cumulative = 0
+            for bound, n in zip(BUCKETS + ('+Inf',), histogram.counts):
+                cumulative += n
+                lines.append('{}_bucket{{{}}} {}'.format(name, ','.join(filter(None, [
+                    label_text, 'le="{}"'.format(bound)])), cumulative))
+            lines.append('{}_sum{{{}}} {}'.format(name, label_text, round(histogram.total, 6)))
+            lines.append('{}_count{{{}}} {}'.format(name, label_text, histogram.count))
+    return '\n'.join(lines) + '\n'
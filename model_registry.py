@@ -0,0 +1,274 @@
+"""
+Keep the most recently trained model and its encodings loaded in memory, so that predictions don't have to load
+them from disk on every request. Each gunicorn worker holds its own registry, which reloads only when a new model
+gets published.
+
+Every model is saved as a single versioned bundle, holding the model along with its encoder vocabularies, feature
+list, training employee ID range and test score. A manifest in the model directory lists every bundle and names the
+latest one, so finding it never requires listing the directory.
+
+When run as main method, convert models saved as separate timestamped pickles into bundles.
+"""
+
+import datetime
+import fcntl
+import json
+import os
+import pickle
+import threading
+import time
+from collections import defaultdict
+
+import numpy as np
+from sklearn import preprocessing
+
+from fast_predict import CompiledEnsemble
+from schema import FEATURES
+
+
+MODEL_DIR = 'models'
+MANIFEST_NAME = 'manifest.json'
+BUNDLE_TEMPLATE = 'model_{}.pkl'
+BUNDLE_FORMAT_VERSION = 1
+
+# Fields of a manifest entry that are filled in on publishing, rather than taken from the model's metadata
+PUBLISHED_FIELDS = ('version', 'path', 'features', 'created_at', 'size_bytes')
+
+
+class ModelRegistry(object):
+    """
+    In-process cache of the current (model, encodings) pair.
+
+    The pair is stored as a single tuple and replaced in one assignment, so a request that grabbed it can never see
+    a model matched with the encodings of another version. Reloads are triggered by a change in the modification time
+    of the manifest, which is checked at most once every `check_interval` seconds.
+    """
+
+    def __init__(self, model_dir=MODEL_DIR, check_interval=1.0):
+        self.model_dir = model_dir
+        self.check_interval = check_interval
+
+        self._current = None  # (version, model, encodings)
+        self._compiled = (None, None)  # (version, CompiledEnsemble or None)
+        self._manifest_mtime = None
+        self._last_check = 0.0
+        self._latest = (None, 0.0)  # (version, time read)
+        self._lock = threading.Lock()
+
+        self.load_count = 0
+        self.loaded_at = None
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.model_dir, MANIFEST_NAME)
+
+    def manifest(self):
+        """
+        :return: Dictionary naming the latest version, and describing every published artifact by version
+        """
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'latest': None, 'artifacts': {}}
+
+    def latest_version(self):
+        """
+        :return: Version string of the most recently published model
+        """
+        version = self.manifest()['latest']
+        if version is None:
+            raise IOError("No published model found in '{}'".format(self.model_dir))
+        return version
+
+    def load(self, version):
+        """
+        Load a given version of the model and its encodings from disk, without touching the current pair.
+
+        :param version: Version string
+        :return: Tuple of version, model and encodings
+        """
+        with open(os.path.join(self.model_dir, BUNDLE_TEMPLATE.format(version)), 'rb') as f:
+            bundle = pickle.load(f)
+        return version, bundle['model'], encoders_from_arrays(bundle['encoders'])
+
+    def get(self):
+        """
+        Get the current model and encodings, reloading them first if a newer model has been published.
+
+        :return: Tuple of version, model and encodings
+        """
+        current = self._current
+        if current is not None and time.time() - self._last_check < self.check_interval:
+            return current
+
+        with self._lock:
+            self._last_check = time.time()
+            try:
+                mtime = os.stat(self.manifest_path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if self._current is not None and mtime == self._manifest_mtime:
+                return self._current
+
+            version = self.latest_version()
+            if self._current is None or version != self._current[0]:
+                # swap in the freshly loaded pair in one assignment
+                self._current = self.load(version)
+                self.load_count += 1
+                self.loaded_at = time.time()
+            self._manifest_mtime = mtime
+            return self._current
+
+    def current_version(self):
+        """
+        Get the version of the most recently published model without loading it, for processes that hand scoring off
+        to the inference server. The manifest is read at most once every `check_interval` seconds.
+
+        :return: Version string
+        """
+        version, read_at = self._latest
+        if version is None or time.time() - read_at >= self.check_interval:
+            version = self.latest_version()
+            self._latest = (version, time.time())
+        return version
+
+    def compiled(self):
+        """
+        Get the current model flattened for fast scoring, flattening it first if it is new.
+
+        :return: Tuple of version, model, encodings and CompiledEnsemble (None if the model can't be flattened)
+        """
+        version, model, encodings = self.get()
+        compiled_version, compiled = self._compiled
+        if compiled_version != version:
+            features = (self.metadata(version) or {}).get('features') or list(getattr(model, 'feature_names_in_', []))
+            compiled = CompiledEnsemble.from_model(model, encodings, features)
+            self._compiled = (version, compiled)
+        return version, model, encodings, compiled
+
+    def metadata(self, version):
+        """
+        Get the metadata published with a model, such as the range of employee IDs it was trained on.
+
+        :param version: Version string
+        :return: Dictionary of metadata, or None if there is no such version
+        """
+        return self.manifest()['artifacts'].get(version)
+
+    def publish(self, model, encodings, features, metadata=None):
+        """
+        Save a trained model as a new bundle, and make it the latest in the manifest. Both files are written under a
+        temporary name and then renamed, so that readers never pick up a partially written artifact. The bundle is a
+        single pickle using the highest protocol, which loads the many small arrays of a tree ensemble faster than
+        memory mapping them would.
+
+        :param model: Trained model
+        :param encodings: Lookup table for label encoding, used to train the model
+        :param features: Names of the columns the model was trained on, in order
+        :param metadata: Dictionary to publish along with the model, e.g. the employee ID range and test score
+        :return: Version of the published model
+        """
+        if not os.path.isdir(self.model_dir):
+            os.makedirs(self.model_dir)
+
+        now = datetime.datetime.now()
+        version = now.strftime('%Y-%m-%d_%H-%M-%S.%f')
+        metadata = {k: v for k, v in (metadata or {}).items() if k not in PUBLISHED_FIELDS}
+        bundle = {
+            'format_version': BUNDLE_FORMAT_VERSION,
+            'version': version,
+            'model': model,
+            'encoders': encoders_to_arrays(encodings),
+            'features': list(features),
+            'metadata': metadata
+        }
+        path = os.path.join(self.model_dir, BUNDLE_TEMPLATE.format(version))
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(bundle, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+        entry = dict(metadata, version=version, path=os.path.basename(path), features=list(features),
+                     created_at=now.isoformat(), size_bytes=os.path.getsize(path))
+        self._update_manifest(version, entry)
+        return version
+
+    def _update_manifest(self, version, entry):
+        # hold a lock across the read and the write, as several training processes may publish at once
+        with open(self.manifest_path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            manifest = self.manifest()
+            manifest['artifacts'][version] = entry
+            manifest['latest'] = version
+
+            tmp_path = '{}.{}.tmp'.format(self.manifest_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.manifest_path)
+
+    def stats(self):
+        """
+        :return: Dictionary of counters, to confirm that the registry is only reloading when it should
+        """
+        current = self._current
+        return {
+            'version': current[0] if current is not None else None,
+            'load_count': self.load_count,
+            'seconds_since_load': round(time.time() - self.loaded_at, 3) if self.loaded_at is not None else None
+        }
+
+
+def encoders_to_arrays(encodings):
+    """
+    :param encodings: Lookup table of fitted label encoders, by column
+    :return: Dictionary of the classes known to each encoder, as plain arrays
+    """
+    return {column: np.asarray(encoder.classes_) for column, encoder in encodings.items()}
+
+
+def encoders_from_arrays(arrays):
+    """
+    :param arrays: Dictionary of the classes known to each encoder, as plain arrays
+    :return: Lookup table of fitted label encoders, by column, as used by HRmodel.proc_df
+    """
+    encodings = defaultdict(preprocessing.LabelEncoder)
+    for column, classes in arrays.items():
+        encodings[column].classes_ = np.array(classes)
+    return encodings
+
+
+def migrate_legacy_models(model_dir=MODEL_DIR, encoding_dir='encodings'):
+    """
+    Publish every model saved as a pair of models/GB_<timestamp>.pkl and encodings/le_<timestamp>.pkl pickles as a
+    bundle, oldest first, so that the most recent pair ends up as the latest version.
+
+    :return: List of published versions
+    """
+    target = ModelRegistry(model_dir)
+    models = {f[3:-4] for f in os.listdir(model_dir) if f.startswith('GB_') and f.endswith('.pkl')}
+    encodings = {f[3:-4] for f in os.listdir(encoding_dir) if f.startswith('le_') and f.endswith('.pkl')}
+
+    versions = []
+    for timestamp in sorted(models & encodings):
+        with open(os.path.join(model_dir, 'GB_{}.pkl'.format(timestamp)), 'rb') as f:
+            model = pickle.load(f)
+        with open(os.path.join(encoding_dir, 'le_{}.pkl'.format(timestamp)), 'rb') as f:
+            d = pickle.load(f)
+        try:
+            with open(os.path.join(model_dir, 'GB_{}.json'.format(timestamp))) as f:
+                metadata = json.load(f)
+        except IOError:
+            metadata = {}
+        metadata['migrated_from'] = timestamp
+        versions.append(target.publish(model, d, FEATURES, metadata))
+    return versions
+
+
+# One registry per process (i.e. per gunicorn worker)
+registry = ModelRegistry()
+
+
+if __name__ == "__main__":
+    for version in migrate_legacy_models():
+        print("Published {}".format(version))
@@ -0,0 +1,291 @@
+"""
+Caches shared by every worker process, so that the dashboard doesn't query, fuzzy match and score the same employee
+each time it is looked up. Entries live in a small SQLite file next to the application, are bounded in number (the
+least recently used go first) and expire after a fixed time.
+
+Two caches are kept:
+    - predictions, keyed by model version and the canonicalized feature values of an employee. A newly published
+      model has a new version, so it never sees predictions made by an older one, and those are dropped the first
+      time a worker predicts with the new model.
+    - employee features, keyed by employee ID. An entry is dropped whenever add_employee writes that employee.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import config
+
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS entries (namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, '
+    'expires_at REAL NOT NULL, last_used REAL NOT NULL, PRIMARY KEY (namespace, key))',
+    'CREATE INDEX IF NOT EXISTS entries_last_used ON entries (namespace, last_used)',
+    'CREATE TABLE IF NOT EXISTS counters (namespace TEXT PRIMARY KEY, hits INTEGER NOT NULL DEFAULT 0, '
+    'misses INTEGER NOT NULL DEFAULT 0, evictions INTEGER NOT NULL DEFAULT 0)',
+]
+
+
+class SharedCache(object):
+    """
+    LRU cache with a time to live, stored in a SQLite database that any number of processes can open at once.
+
+    Reads only write back the time an entry was last used if it is more than `touch_interval` seconds old, so the
+    eviction order is approximate but a hit rarely costs a write. The cache is trimmed back to `max_entries` every
+    `trim_every` writes. Hit and miss counts are gathered per process and added to the shared counters every
+    `flush_every` lookups. Database errors, e.g. the file being locked for too long, are treated as misses, so the
+    cache can slow a request down but never fail it.
+    """
+
+    def __init__(self, namespace, path=None, max_entries=10000, ttl=3600, touch_interval=1.0, trim_every=100,
+                 flush_every=50):
+        """
+        :param namespace: Name of the cache, so that several can share one database
+        :param path: Path to the database file. Will use config.CACHE_PATH if not provided.
+        :param max_entries: Number of entries kept
+        :param ttl: Seconds before an entry expires
+        :param touch_interval: Seconds between updates of the time an entry was last used
+        :param trim_every: Number of writes between evictions of expired and least recently used entries
+        :param flush_every: Number of lookups between updates of the shared hit and miss counters
+        """
+        self.namespace = namespace
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.touch_interval = touch_interval
+        self.trim_every = trim_every
+        self.flush_every = flush_every
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._pending = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._writes = 0
+
+    def _connect(self):
+        # one connection per thread, reopened after a fork so that child processes never share the parent's
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+
+        connection = sqlite3.connect(self.path or config.CACHE_PATH, timeout=1.0, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=OFF')
+        for statement in SCHEMA:
+            connection.execute(statement)
+        self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def close(self):
+        """
+        Close this thread's connection, so that the next use opens a new one, e.g. after config.CACHE_PATH changed.
+
+        :return: None
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            connection.close()
+        self._local.connection = None
+
+    def get(self, key):
+        """
+        :param key: String key
+        :return: Cached value, or None if there is no live entry for the key
+        """
+        now = time.time()
+        try:
+            connection = self._connect()
+            row = connection.execute('SELECT value, expires_at, last_used FROM entries WHERE namespace = ? AND key = ?',
+                                     (self.namespace, key)).fetchone()
+            if row is not None and row[1] > now:
+                if now - row[2] > self.touch_interval:
+                    connection.execute('UPDATE entries SET last_used = ? WHERE namespace = ? AND key = ?',
+                                       (now, self.namespace, key))
+                self._count('hits')
+                return json.loads(row[0])
+        except sqlite3.Error:
+            pass
+        self._count('misses')
+        return None
+
+    def set(self, key, value):
+        """
+        :param key: String key
+        :param value: Value to cache, which must be JSON serializable (NumPy scalars are converted)
+        :return: None
+        """
+        now = time.time()
+        try:
+            self._connect().execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)',
+                                    (self.namespace, key, json.dumps(value, default=_to_python), now + self.ttl, now))
+        except sqlite3.Error:
+            return
+
+        with self._lock:
+            self._writes += 1
+            trim = self._writes % self.trim_every == 0
+        if trim:
+            self.trim()
+
+    def delete(self, key):
+        """
+        :param key: String key
+        :return: None
+        """
+        try:
+            self._connect().execute('DELETE FROM entries WHERE namespace = ? AND key = ?', (self.namespace, key))
+        except sqlite3.Error:
+            pass
+
+    def delete_other_prefixes(self, prefix):
+        """
+        Drop every entry whose key doesn't start with the given prefix, e.g. predictions of other model versions.
+
+        :param prefix: Prefix of the keys to keep
+        :return: Number of entries dropped
+        """
+        try:
+            cursor = self._connect().execute(
+                'DELETE FROM entries WHERE namespace = ? AND substr(key, 1, ?) != ?',
+                (self.namespace, len(prefix), prefix))
+        except sqlite3.Error:
+            return 0
+        self._count('evictions', cursor.rowcount)
+        return cursor.rowcount
+
+    def clear(self):
+        """
+        Drop every entry in this cache.
+
+        :return: None
+        """
+        try:
+            self._connect().execute('DELETE FROM entries WHERE namespace = ?', (self.namespace,))
+        except sqlite3.Error:
+            pass
+
+    def trim(self):
+        """
+        Drop expired entries, then the least recently used ones beyond max_entries.
+
+        :return: Number of entries dropped
+        """
+        try:
+            connection = self._connect()
+            expired = connection.execute('DELETE FROM entries WHERE namespace = ? AND expires_at <= ?',
+                                         (self.namespace, time.time())).rowcount
+            evicted = connection.execute(
+                'DELETE FROM entries WHERE namespace = ? AND key IN (SELECT key FROM entries WHERE namespace = ? '
+                'ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                (self.namespace, self.namespace, self.max_entries)).rowcount
+        except sqlite3.Error:
+            return 0
+        self._count('evictions', expired + evicted)
+        return expired + evicted
+
+    def _count(self, counter, n=1):
+        with self._lock:
+            if counter == 'hits':
+                self._hits += n
+            elif counter == 'misses':
+                self._misses += n
+            self._pending[counter] += n
+            if self._pending['hits'] + self._pending['misses'] < self.flush_every and counter != 'evictions':
+                return
+            pending, self._pending = self._pending, {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._flush(pending)
+
+    def _flush(self, pending):
+        try:
+            connection = self._connect()
+            connection.execute('INSERT OR IGNORE INTO counters (namespace) VALUES (?)', (self.namespace,))
+            connection.execute('UPDATE counters SET hits = hits + ?, misses = misses + ?, evictions = evictions + ? '
+                               'WHERE namespace = ?',
+                               (pending['hits'], pending['misses'], pending['evictions'], self.namespace))
+        except sqlite3.Error:
+            pass
+
+    def stats(self):
+        """
+        :return: Dictionary of hit, miss and eviction counts across all processes, and hits and misses in this one
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._flush(pending)
+
+        stats = {'entries': None, 'hits': None, 'misses': None, 'evictions': None,
+                 'process_hits': self._hits, 'process_misses': self._misses}
+        try:
+            connection = self._connect()
+            stats['entries'] = connection.execute('SELECT count(*) FROM entries WHERE namespace = ?',
+                                                  (self.namespace,)).fetchone()[0]
+            row = connection.execute('SELECT hits, misses, evictions FROM counters WHERE namespace = ?',
+                                     (self.namespace,)).fetchone()
+        except sqlite3.Error:
+            return stats
+        stats['hits'], stats['misses'], stats['evictions'] = row or (0, 0, 0)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else None
+        return stats
+
+
+def _to_python(value):
+    # NumPy scalars, as found in data frames, know how to turn themselves into plain Python values
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError("{!r} is not JSON serializable".format(value))
+
+
+def prediction_key(version, features):
+    """
+    :param version: Version of the model making the prediction
+    :param features: Feature values of an employee, in model feature order
+    :return: Cache key, the same for feature values that only differ in type (e.g. True, 1 and 1.0)
+    """
+    values = [v if isinstance(v, str) else float(v) for v in features]
+    return '{}:{}'.format(version, json.dumps(values))
+
+
+predictions = SharedCache('predictions', max_entries=config.PREDICTION_CACHE_SIZE, ttl=config.PREDICTION_CACHE_TTL)
+employee_features = SharedCache('employee_features', max_entries=config.EMPLOYEE_CACHE_SIZE,
+                                ttl=config.EMPLOYEE_CACHE_TTL)
+
+# Model version that this process last cached predictions for
+_prediction_version = None
+
+
+def get_prediction(version, features):
+    """
+    :param version: Version of the model making the prediction
+    :param features: Feature values of an employee, in model feature order
+    :return: Tuple of hard prediction and class probability, or None if not cached
+    """
+    global _prediction_version
+    if version != _prediction_version:
+        # the first prediction with a new model clears out those made by older ones
+        predictions.delete_other_prefixes('{}:'.format(version))
+        _prediction_version = version
+
+    cached = predictions.get(prediction_key(version, features))
+    return tuple(cached) if cached is not None else None
+
+
+def set_prediction(version, features, pred, proba):
+    """
+    :param version: Version of the model making the prediction
+    :param features: Feature values of an employee, in model feature order
+    :param pred: Hard prediction
+    :param proba: Class probability
+    :return: None
+    """
+    predictions.set(prediction_key(version, features), [bool(pred), float(proba)])
+
+
+def stats():
+    """
+    :return: Dictionary of counters for each cache
+    """
+    return {'predictions': predictions.stats(), 'employee_features': employee_features.stats()}
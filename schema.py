@@ -0,0 +1,40 @@
+"""
+Names and accepted values of the employee fields the model uses. These are kept apart from HRmodel.py, which imports
+pandas and scikit-learn, so that the forms and the web application can use them without loading either.
+"""
+
+# Use all the features from the original dataset (note typo in 'average_montly_hours')
+FEATURES = [
+    'satisfaction_level',
+    'last_evaluation',
+    'number_project',
+    'average_montly_hours',
+    'time_spend_company',
+    'Work_accident',
+    'promotion_last_5years',
+    'department', 'salary'
+]
+
+DEPARTMENT_OPTIONS = [
+    'IT',
+    'RandD',
+    'accounting',
+    'hr',
+    'management',
+    'marketing',
+    'product_mng',
+    'sales',
+    'support',
+    'technical']
+
+SALARY_OPTIONS = ['high', 'low', 'medium']
+
+# sklearn doesn't handle categorical features automatically, so we need to change them to columns of integer values.
+NONNUMERIC_COLUMNS = ['department', 'salary']
+
+# Libraries that can be used to train the model: scikit-learn's exact gradient boosting, which is single threaded, and
+# the histogram based gradient boosting of scikit-learn and xgboost, which are much faster and use every core.
+TRAINER_BACKENDS = ['gbc', 'hist', 'xgboost']
+
+# Numeric features employees can be filtered on by range on the query page
+RANGE_FEATURES = ['satisfaction_level', 'last_evaluation', 'average_montly_hours', 'time_spend_company']
@@ -0,0 +1,81 @@
+"""
+Score single employees the way the prediction page always has, for every front end: the HTML views in index.py and
+the JSON API in api.py. Both going through here is what keeps their probabilities the same for the same employee.
+"""
+
+import pandas as pd
+
+from HRmodel import df_new_emp, predict_employee_churn
+from churn_scores import get_churn_score
+from database_operations import clip_numeric, fuzzy_match, get_employee_features
+from schema import DEPARTMENT_OPTIONS, FEATURES, SALARY_OPTIONS
+
+
+def lookup_employee(emp_id, version=None):
+    """
+    Get an employee's features, along with their precomputed churn score if the current model has scored them.
+
+    :param emp_id: Employee ID number
+    :param version: Version of the current model. Will use the most recent model if not provided.
+    :return: Data frame of the employee's model features, and a tuple of their hard prediction and the probability
+        of that prediction (None if they haven't been scored yet); or None if there is no such employee
+    """
+    features = get_employee_features(emp_id)
+    if features is None:
+        return None
+
+    test_df = pd.DataFrame([features], columns=FEATURES)
+    score = get_churn_score(emp_id, version)
+    if score is None:
+        return test_df, None
+    # already scored by the current model, so there is nothing left to predict
+    pred = bool(score.label)
+    return test_df, (pred, round(score.probability if pred else 1 - score.probability, 4))
+
+
+def score_employee(emp_id):
+    """
+    :param emp_id: Employee ID number
+    :return: Hard prediction, probability of the prediction and data frame of the employee, or None if there is no
+        such employee
+    """
+    found = lookup_employee(emp_id)
+    if found is None:
+        return None
+
+    test_df, scored = found
+    if scored is not None:
+        return scored[0], scored[1], test_df
+    return predict_employee_churn(test_df)
+
+
+def new_employee_df(satisfaction_level, last_evaluation, number_project, average_montly_hours, time_spend_company,
+                    Work_accident, promotion_last_5years, department, salary):
+    """
+    Build the data frame of a hypothetical employee, keeping numbers in bounds and fuzzy matching department and
+    salary band onto their accepted values.
+
+    :return: Data frame with a row for the employee
+    :raises ValueError: If a numeric field isn't a number
+    """
+    return df_new_emp(
+        clip_numeric(float(satisfaction_level), 0, 1),
+        clip_numeric(float(last_evaluation), 0, 1),
+        clip_numeric(float(number_project), min_val=0),
+        clip_numeric(int(average_montly_hours), min_val=0),
+        clip_numeric(int(time_spend_company), min_val=0),
+        parse_flag(Work_accident),
+        parse_flag(promotion_last_5years),
+        fuzzy_match(str(department), DEPARTMENT_OPTIONS),
+        fuzzy_match(str(salary), SALARY_OPTIONS)
+    )
+
+
+def parse_flag(value):
+    """
+    :param value: Boolean, number, or text as accepted by the forms ("True", "false", "1", ...)
+    :return: Boolean
+    """
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', '1')
+    return bool(value)
@@ -18,8 +18,10 @@ pip install -r requirements.txt
 # initialize baseline model
 python HRmodel.py
 
-# instantiate database context
+# instantiate database context, and load the raw data into it
 python sqlite_declarative.py
+python ingest.py data/train.csv data/test.csv
 
-# launch server
-gunicorn --bind 0.0.0.0:8080 wsgi:app
+# launch the JSON API in the background, then the server
+python api.py &
+gunicorn --config gunicorn.conf.py wsgi:app
@@ -3,5 +3,10 @@
 # source activate environment
 source activate emp_churn
 
-# launch server
-gunicorn --bind 0.0.0.0:8080 wsgi:app
+# create any indexes queries rely on that databases created by older versions lack. Rewriting the malformed field
+# values they may hold is a one-off, run by hand: python queries.py migrate
+python queries.py indexes
+
+# launch the JSON API in the background, then the server
+python api.py &
+gunicorn --config gunicorn.conf.py wsgi:app
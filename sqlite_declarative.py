@@ -6,9 +6,11 @@ When run as main method, initialize class references.
 import os
 import sys
 from sqlalchemy import create_engine
-from sqlalchemy import BIGINT, Column, FLOAT, INTEGER, TEXT
+from sqlalchemy import BIGINT, Column, DateTime, FLOAT, Index, INTEGER, TEXT
 from sqlalchemy.ext.declarative import declarative_base
 
+import config
+
 
 Base = declarative_base()
 
@@ -26,12 +28,37 @@ class Employee(Base):
     department = Column(TEXT, nullable=False)
     salary = Column(TEXT, nullable=False)
     left = Column(BIGINT, nullable=False)
+    # filtered on by queries.py, which pages through employees in Emp_ID order
+    __table_args__ = (
+        Index('ix_all_HR_data_department_Emp_ID', 'department', 'Emp_ID'),
+        Index('ix_all_HR_data_salary_Emp_ID', 'salary', 'Emp_ID'),
+        Index('ix_all_HR_data_left_Emp_ID', 'left', 'Emp_ID'),
+    )
+
+
+class ChurnScore(Base):
+    """
+    Most recent churn prediction for each employee, and the version of the model that made it. Scores made by an
+    older model are stale, and get replaced by churn_scores.refresh_churn_scores. The department is copied over,
+    already fuzzy matched, so that the most at risk employees of a department can be read straight off an index.
+    """
+    __tablename__ = 'churn_scores'
+    Emp_ID = Column(INTEGER, primary_key=True)
+    model_version = Column(TEXT, nullable=False)
+    probability = Column(FLOAT, nullable=False)
+    label = Column(BIGINT, nullable=False)
+    department = Column(TEXT, nullable=False)
+    scored_at = Column(DateTime, nullable=False)
+    __table_args__ = (
+        Index('ix_churn_scores_version_probability', 'model_version', 'probability'),
+        Index('ix_churn_scores_department_version_probability', 'department', 'model_version', 'probability'),
+    )
 
 
-if __name__ == "main":
-    # Create an engine that stores data in the local directory's
-    # sqlalchemy_example.db file.
-    engine = create_engine('sqlite:///sqlalchemy_example.db')
+if __name__ == "__main__":
+    # Create an engine for the configured database, by default the local directory's
+    # HR_sqlite.db file.
+    engine = create_engine(config.DATABASE_URL)
 
     # Create all tables in the engine. This is equivalent to "Create Table"
     # statements in raw SQL.
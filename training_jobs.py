@@ -0,0 +1,475 @@
+"""
+Retrain the model in the background, so that a fit never ties up a web worker for its whole duration. Jobs run in a
+local process pool, and report their state, progress and final test score through a small JSON file per job. Since
+these live on disk, any gunicorn worker can report on a job, no matter which one submitted it.
+
+Every gunicorn worker has a pool of its own, so a job first takes one of config.MAX_TRAINING_JOBS slots shared through
+lock files in the job directory, and stays queued until one comes free. That caps the fits running at once across
+the whole server, however many workers there are.
+"""
+
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+from sklearn.model_selection import train_test_split
+
+import config
+import drift
+import feature_store
+import metrics
+import tuning
+from HRmodel import FEATURES, NONNUMERIC_COLUMNS, backend_of, continue_training, n_trees, proc_df, save_model, \
+    train_model
+from churn_scores import refresh_churn_scores
+from database_operations import load_employees_df
+from model_registry import registry
+
+
+TERMINAL_STATES = ('done', 'failed')
+
+# Jobs still marked as queued or running after this long are assumed to have died with their worker
+STALE_AFTER = 60 * 60
+
+# Seconds between attempts to take a training slot while every one is held
+SLOT_POLL_INTERVAL = 1.0
+
+# Number of times progress is written out over the course of a fit
+PROGRESS_UPDATES = 20
+
+# Incremental retraining falls back to a full retrain when the new employees are more than this fraction of those the
+# previous model saw, when the previous model's accuracy on them drops by more than DRIFT_TOLERANCE from its test
+# score, or when a feature mean moves by more than MAX_MEAN_SHIFT of its standard deviation.
+MAX_DELTA_FRACTION = 0.5
+DRIFT_TOLERANCE = 0.05
+MAX_MEAN_SHIFT = 0.5
+
+# Cap on the size of a model grown through incremental retraining, before it gets rebuilt from scratch
+MAX_ESTIMATORS = 500
+MIN_EXTRA_ESTIMATORS = 10
+
+NUMERIC_FEATURES = [f for f in FEATURES if f not in NONNUMERIC_COLUMNS]
+
+# Seed of the train/test split, so that test scores of successive models are comparable
+SPLIT_SEED = 1234
+
+# Share of the progress of a tuned retrain given to the search, the rest going to the final fit
+TUNING_PROGRESS = 0.9
+
+
+class FullRetrainNeeded(Exception):
+    """
+    Raised when a model can't be safely updated incrementally, with the reason why.
+    """
+
+
+class TrainingQueue(object):
+    """
+    Submit retraining jobs to a process pool of limited size, whose jobs then wait for one of the training slots
+    shared by every process (see training_slot). Requests to retrain on the same employee ID cutoff while a job for it
+    is still in flight are pointed at that job rather than starting another.
+    """
+
+    def __init__(self, job_dir=config.JOB_DIR, max_workers=config.MAX_TRAINING_JOBS):
+        self.job_dir = job_dir
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def shutdown(self, wait=True):
+        """
+        Stop the process pool. A later submit starts a new one.
+
+        :param wait: Wait for jobs in flight to finish first
+        :return: None
+        """
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def _claim_path(self, emp_id):
+        return os.path.join(self.job_dir, 'emp_id_{}.claim'.format(emp_id))
+
+    def status(self, job_id):
+        """
+        :param job_id: ID of the job, as returned by submit
+        :return: Dictionary describing the job, or None if there is no such job
+        """
+        if len(job_id) != 32 or not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        return read_status(self.job_dir, job_id)
+
+    def submit(self, emp_id, incremental=False, backend=None, tune=False):
+        """
+        Queue up retraining on all employees up to an employee ID, unless a job for it is already in flight.
+
+        :param emp_id: Max employee ID considered
+        :param incremental: Continue training the most recent model on the employees added since, if possible
+        :param backend: Library to train with, one of HRmodel.TRAINER_BACKENDS
+        :param tune: Search for the best boosting parameters by cross-validation first. Implies a full retrain.
+        :return: Job ID, and whether a new job was started
+        """
+        backend = backend or config.TRAINER_BACKEND
+        if not os.path.isdir(self.job_dir):
+            os.makedirs(self.job_dir)
+
+        with self._lock:
+            job_id = self._in_flight(emp_id)
+            if job_id is not None:
+                return job_id, False
+
+            job_id = uuid.uuid4().hex
+            try:
+                # claim this cutoff atomically, in case another worker is submitting the same one
+                fd = os.open(self._claim_path(emp_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except OSError:
+                existing = self._in_flight(emp_id)
+                if existing is not None:
+                    return existing, False
+                fd = os.open(self._claim_path(emp_id), os.O_CREAT | os.O_WRONLY | os.O_TRUNC)
+            with os.fdopen(fd, 'w') as f:
+                f.write(job_id)
+
+            now = time.time()
+            write_status(self.job_dir, job_id, {
+                'job_id': job_id, 'emp_id': emp_id, 'state': 'queued', 'progress': 0.0, 'incremental': incremental,
+                'backend': backend, 'tune': tune, 'test_score': None, 'version': None, 'error': None,
+                'submitted_at': now, 'updated_at': now
+            })
+            future = self._get_executor().submit(run_training_job, self.job_dir, job_id, emp_id, incremental, backend,
+                                                 tune)
+            future.add_done_callback(partial(self._finish, job_id, emp_id))
+            return job_id, True
+
+    def _in_flight(self, emp_id):
+        """
+        :return: ID of the job in flight for an employee ID cutoff, or None if there isn't one
+        """
+        try:
+            with open(self._claim_path(emp_id)) as f:
+                job_id = f.read().strip()
+        except IOError:
+            return None
+
+        status = self.status(job_id)
+        if (status is not None and status['state'] not in TERMINAL_STATES
+                and time.time() - status['updated_at'] < STALE_AFTER):
+            return job_id
+        return None
+
+    def _finish(self, job_id, emp_id, future):
+        """
+        Release the claim on the employee ID cutoff once a job completes, recording the failure if the job never got
+        to report one itself (e.g. the pool broke).
+        """
+        if future.exception() is not None:
+            status = self.status(job_id) or {}
+            if status.get('state') not in TERMINAL_STATES:
+                update_status(self.job_dir, job_id, state='failed', error=str(future.exception()))
+
+        try:
+            with open(self._claim_path(emp_id)) as f:
+                claimed_by = f.read().strip()
+            if claimed_by == job_id:
+                os.remove(self._claim_path(emp_id))
+        except (IOError, OSError):
+            pass
+
+
+@contextmanager
+def training_slot(job_dir, n_slots=config.MAX_TRAINING_JOBS, waiting=None):
+    """
+    Hold one of a fixed number of slots shared by every process using the job directory, waiting until one comes
+    free. Each slot is a lock file held with flock, which the system releases when its holder exits, so a job that
+    dies never keeps its slot.
+
+    :param job_dir: Directory holding job status files
+    :param n_slots: Number of jobs that may hold a slot at once
+    :param waiting: Called every time all the slots are found taken
+    :return: Context manager, giving the number of the slot held
+    """
+    while True:
+        for slot in range(max(n_slots, 1)):
+            lock = open(os.path.join(job_dir, 'slot_{}.lock'.format(slot)), 'w')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                lock.close()
+                continue
+            try:
+                yield slot
+            finally:
+                # closing the file releases the lock
+                lock.close()
+            return
+        if waiting is not None:
+            waiting()
+        time.sleep(SLOT_POLL_INTERVAL)
+
+
+def run_training_job(job_dir, job_id, emp_id, incremental=False, backend=None, tune=False):
+    """
+    Retrain the model once a training slot is free, recording progress as we go. Runs in a pool process.
+
+    :param job_dir: Directory holding job status files
+    :param job_id: ID of the job
+    :param emp_id: Max employee ID considered
+    :param incremental: Continue training the most recent model on the employees added since, if possible
+    :param backend: Library to train with, one of HRmodel.TRAINER_BACKENDS
+    :param tune: Search for the best boosting parameters by cross-validation first
+    :return: None
+    """
+    try:
+        # keep the job from looking stale while it waits its turn
+        with training_slot(job_dir, waiting=partial(update_status, job_dir, job_id, state='queued')):
+            update_status(job_dir, job_id, state='running', started_at=time.time())
+            result = retrain(emp_id, partial(update_status, job_dir, job_id), incremental=incremental,
+                             backend=backend, tune=tune)
+    except Exception as e:
+        update_status(job_dir, job_id, state='failed', error=str(e))
+        return
+    finally:
+        # pool processes don't serve requests, so their timings only get written out here
+        metrics.flush()
+    update_status(job_dir, job_id, state='done', progress=1.0, **result)
+
+    # the job is already reported as done, so a failure here only leaves scores to the next refresh
+    if result['mode'] != 'unchanged':
+        try:
+            refreshed = refresh_churn_scores(result['version'])
+            update_status(job_dir, job_id, scores_refreshed=refreshed['n_rows'])
+        except Exception as e:
+            update_status(job_dir, job_id, scores_refresh_error=str(e))
+
+
+def retrain(emp_id, update=None, n_est=100, incremental=False, backend=None, tune=False):
+    """
+    Retrain the model on all employees up to an employee ID, holding out a fifth of them to report the test score,
+    and save it so that it gets picked up for predictions. The held out fifth is the same from one retrain to the
+    next, as long as the employees are.
+
+    :param emp_id: Max employee ID considered
+    :param update: Called with progress=<fraction done> as the model is fit
+    :param n_est: Number of estimators to use, unless tuning picks another number
+    :param incremental: Continue training the most recent model on the employees added since, if possible
+    :param backend: Library to train with, one of HRmodel.TRAINER_BACKENDS
+    :param tune: Search for the best boosting parameters by cross-validation on the training part first. Every trial
+        of the search is published along with the model.
+    :return: Dictionary holding the version of the saved model, its test score, and how it was trained
+    :raises ValueError: If every employee up to emp_id has left the company, so there is nothing to learn from
+    """
+    backend = backend or config.TRAINER_BACKEND
+    fallback_reason = None
+    if incremental and not tune:
+        try:
+            return retrain_incremental(emp_id, update, backend)
+        except FullRetrainNeeded as e:
+            fallback_reason = str(e)
+
+    if feature_store.enabled():
+        # already label encoded, and the features are the store's own memory until split
+        feature_store.store.refresh()
+        employee_df, d = feature_store.store.training_frame(emp_id)
+        train_df, test_df = train_test_split(employee_df, train_size=0.8, random_state=SPLIT_SEED)
+    else:
+        employee_df = load_employees_df(emp_id)
+        train_df, test_df = train_test_split(employee_df, train_size=0.8, random_state=SPLIT_SEED)
+        train_df, d = proc_df(train_df)
+        test_df, _ = proc_df(test_df, d)
+
+    params, search = None, None
+    if tune:
+        start = time.time()
+        params, trials = tuning.search(train_df, backend, update=_scaled(update, 0, TUNING_PROGRESS))
+        search = {'best_params': params, 'best_score': max(t['mean_score'] for t in trials if t['params'] == params),
+                  'n_folds': config.TUNING_FOLDS, 'seconds': round(time.time() - start, 3), 'trials': trials}
+        n_est = params.get('n_estimators', params.get('max_iter', n_est))
+        update = _scaled(update, TUNING_PROGRESS, 1.0)
+
+    try:
+        GB = train_model(train_df, n_est=n_est, monitor=_progress_monitor(update, n_est), backend=backend,
+                         params=params)
+    except ValueError:
+        # the fit fails when every employee in the segment has left, leaving a single class
+        raise ValueError("That was not an appropriate employee ID, as all employees from this segment have left the "
+                         "company.")
+    test_score = round(GB.score(test_df[FEATURES], test_df['left']), 4)
+    metadata = {
+        'mode': 'full',
+        'backend': backend,
+        'min_emp_id': int(employee_df['Emp_ID'].min()),
+        'max_emp_id': int(emp_id),
+        'n_rows': len(employee_df),
+        'n_estimators': n_trees(GB),
+        'test_score': test_score,
+        'feature_means': employee_df[NUMERIC_FEATURES].astype(float).mean().to_dict(),
+        'feature_stds': employee_df[NUMERIC_FEATURES].astype(float).std().to_dict(),
+        # what the drift monitor compares incoming employees and scores against
+        'drift_reference': drift.reference_histograms(
+            employee_df, GB.predict_proba(test_df[FEATURES])[:, list(GB.classes_).index(1)], d)
+    }
+    if search is not None:
+        metadata['params'] = params
+        metadata['tuning'] = search
+    version = save_model(GB, d, metadata)
+    return {'version': version, 'test_score': test_score, 'mode': 'full', 'n_rows': len(employee_df),
+            'fallback_reason': fallback_reason, 'best_params': params,
+            'cv_score': search['best_score'] if search is not None else None}
+
+
+def retrain_incremental(emp_id, update=None, backend=None):
+    """
+    Continue training the most recent model on only the employees added since it was trained, with a number of
+    extra trees in proportion to how many there are, so that the cost scales with the new data rather than the whole
+    table. A fifth of the new employees is held out and scored, and reported as the delta test score. That holdout is
+    too small to stand in for the test score, which is kept from the last full retrain, so that it stays the bar
+    check_delta holds later employees to.
+
+    :param emp_id: Max employee ID considered
+    :param update: Called with progress=<fraction done> as the model is fit
+    :param backend: Library the model is expected to be trained with
+    :return: Dictionary holding the version of the saved model, the test score of its last full retrain, its score
+        on the held out new employees, and how it was trained
+    :raises FullRetrainNeeded: If the previous model can't be safely built upon
+    """
+    try:
+        version, GB, d = registry.load(registry.latest_version())
+    except (IOError, OSError):
+        raise FullRetrainNeeded("there is no previous model to build on")
+    previous = registry.metadata(version)
+    if previous is None or 'max_emp_id' not in previous:
+        raise FullRetrainNeeded("the previous model didn't record which employees it was trained on")
+    if backend is not None and backend != backend_of(GB):
+        raise FullRetrainNeeded("the previous model was trained with {} rather than {}".format(backend_of(GB), backend))
+
+    if emp_id == previous['max_emp_id']:
+        return {'version': version, 'test_score': previous['test_score'], 'mode': 'unchanged', 'n_rows': 0,
+                'fallback_reason': None}
+    if emp_id < previous['max_emp_id']:
+        raise FullRetrainNeeded("the previous model was trained on employees past this one")
+
+    delta_df = load_employees_df(emp_id, min_Emp_ID=previous['max_emp_id'])
+    check_delta(delta_df, previous, GB, d)
+
+    train_df, test_df = train_test_split(delta_df, train_size=0.8, stratify=delta_df['left'], random_state=SPLIT_SEED)
+    train_df, _ = proc_df(train_df, d)
+    test_df, _ = proc_df(test_df, d)
+
+    n_extra = max(MIN_EXTRA_ESTIMATORS, int(round(previous['n_estimators'] * len(delta_df) / previous['n_rows'])))
+    if n_trees(GB) + n_extra > MAX_ESTIMATORS:
+        raise FullRetrainNeeded("the model would grow past {} trees".format(MAX_ESTIMATORS))
+
+    try:
+        GB = continue_training(GB, train_df, n_extra, monitor=_progress_monitor(update, n_extra, n_trees(GB)))
+    except ValueError as e:
+        raise FullRetrainNeeded("the new employees can't be fit on their own ({})".format(e))
+    delta_test_score = round(GB.score(test_df[FEATURES], test_df['left']), 4)
+
+    # test_score carries over from the previous model, i.e. from the last full retrain
+    metadata = dict(previous,
+                    mode='incremental',
+                    base_version=version,
+                    max_emp_id=int(emp_id),
+                    n_rows=previous['n_rows'] + len(delta_df),
+                    n_estimators=n_trees(GB),
+                    delta_test_score=delta_test_score,
+                    delta_test_rows=len(test_df))
+    new_version = save_model(GB, d, metadata)
+    return {'version': new_version, 'test_score': previous['test_score'], 'delta_test_score': delta_test_score,
+            'delta_test_rows': len(test_df), 'mode': 'incremental', 'n_rows': len(delta_df), 'fallback_reason': None}
+
+
+def check_delta(delta_df, previous, GB, d):
+    """
+    Check that the employees added since the previous model look enough like the ones it was trained on for it to
+    be built upon.
+
+    :param delta_df: Employees added since the previous model was trained
+    :param previous: Metadata of the previous model
+    :param GB: Previous model
+    :param d: Lookup table for label encoding of the previous model
+    :return: None
+    :raises FullRetrainNeeded: If any check fails
+    """
+    if len(delta_df) < MIN_EXTRA_ESTIMATORS:
+        raise FullRetrainNeeded("there are too few new employees to fit on")
+    if len(delta_df) > MAX_DELTA_FRACTION * previous['n_rows']:
+        raise FullRetrainNeeded("too many employees were added since the previous model")
+    if delta_df['left'].nunique() < 2 or delta_df['left'].value_counts().min() < 2:
+        raise FullRetrainNeeded("nearly all of the new employees have either left or stayed")
+
+    for feature in NUMERIC_FEATURES:
+        shift = abs(delta_df[feature].mean() - previous['feature_means'][feature])
+        if shift > MAX_MEAN_SHIFT * max(previous['feature_stds'][feature], 1e-9):
+            raise FullRetrainNeeded("the distribution of {} has drifted".format(feature))
+
+    try:
+        encoded_df, _ = proc_df(delta_df.copy(), d)
+    except ValueError:
+        raise FullRetrainNeeded("the new employees have department or salary values the model hasn't seen")
+    score = GB.score(encoded_df[FEATURES], encoded_df['left'])
+    if score < previous['test_score'] - DRIFT_TOLERANCE:
+        raise FullRetrainNeeded("the previous model's accuracy on the new employees dropped to {}".format(
+            round(score, 4)))
+
+
+def _scaled(update, low, high):
+    """
+    :return: Version of update that maps progress from 0 to 1 onto progress from low to high
+    """
+    if update is None:
+        return None
+    return lambda progress: update(progress=round(low + (high - low) * progress, 2))
+
+
+def _progress_monitor(update, n_est, start=0):
+    """
+    :return: Monitor for train_model, reporting progress through update every so many trees
+    """
+    step = max(1, n_est // PROGRESS_UPDATES)
+
+    def monitor(i, model, local_vars):
+        if update is not None and (i + 1 - start) % step == 0:
+            update(progress=round(float(i + 1 - start) / n_est, 2))
+        return False
+
+    return monitor
+
+
+def read_status(job_dir, job_id):
+    try:
+        with open(os.path.join(job_dir, '{}.json'.format(job_id))) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write_status(job_dir, job_id, status):
+    path = os.path.join(job_dir, '{}.json'.format(job_id))
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp_path, path)
+
+
+def update_status(job_dir, job_id, **changes):
+    status = read_status(job_dir, job_id) or {'job_id': job_id}
+    status.update(changes)
+    status['updated_at'] = time.time()
+    write_status(job_dir, job_id, status)
+
+
+# One queue per process (i.e. per gunicorn worker)
+training_queue = TrainingQueue()
@@ -0,0 +1,129 @@
+"""
+Search for the boosting parameters that generalize best, by cross-validation over a small grid per trainer backend.
+
+The feature matrix is pulled out of the data frame once, and the folds are drawn once, so every candidate is fit on
+exactly the same splits without encoding anything again. Candidates are fit in parallel on all cores, with joblib
+sharing the matrix between worker processes rather than copying it for every fit. The search races the candidates
+fold by fold: after each fold, those whose mean score so far is clearly behind the leader are dropped, so most of the
+time goes to candidates that still have a chance.
+"""
+
+import time
+
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.model_selection import ParameterGrid, StratifiedKFold
+
+import config
+from HRmodel import FEATURES, make_classifier
+
+
+PARAM_GRIDS = {
+    'gbc': {
+        'n_estimators': [100, 300],
+        'learning_rate': [0.05, 0.1, 0.2],
+        'max_depth': [3, 5],
+        'subsample': [0.8, 1.0]
+    },
+    'hist': {
+        'max_iter': [100, 300],
+        'learning_rate': [0.05, 0.1, 0.2],
+        'max_leaf_nodes': [15, 31, 63],
+        'l2_regularization': [0.0, 1.0]
+    },
+    'xgboost': {
+        'n_estimators': [100, 300],
+        'learning_rate': [0.05, 0.1, 0.2],
+        'max_depth': [3, 6],
+        'subsample': [0.8, 1.0]
+    }
+}
+
+# A candidate is dropped once its mean fold score is behind the leader's by more than this, or by more than two
+# standard errors of the leader's fold scores if that is larger
+DROP_MARGIN = 0.005
+
+
+def make_folds(y, n_folds=config.TUNING_FOLDS, seed=1234):
+    """
+    :param y: Labels of the training data
+    :param n_folds: Number of folds
+    :param seed: Random seed for reproducible folds
+    :return: List of (train indices, test indices), stratified by label
+    """
+    return list(StratifiedKFold(n_splits=n_folds, shuffle=True, random_state=seed).split(np.zeros(len(y)), y))
+
+
+def fit_and_score(backend, params, X, y, train_index, test_index, seed=1234):
+    """
+    Fit a single candidate on one fold. Runs in a joblib worker, using a single thread so that candidates don't
+    compete for cores.
+
+    :return: Accuracy on the held out part of the fold, and seconds taken to fit
+    """
+    start = time.time()
+    GB = make_classifier(backend, seed=seed, n_jobs=1, params=params)
+    GB.fit(X[train_index], y[train_index])
+    seconds = time.time() - start
+    return GB.score(X[test_index], y[test_index]), seconds
+
+
+def search(train_df, backend=None, grid=None, n_folds=config.TUNING_FOLDS, seed=1234, n_jobs=config.TUNING_N_JOBS,
+           update=None):
+    """
+    Cross-validate every combination of parameters in a grid, dropping candidates that are clearly losing as the
+    folds come in.
+
+    :param train_df: Training data frame, already label encoded
+    :param backend: One of HRmodel.TRAINER_BACKENDS. Will use config.TRAINER_BACKEND if not provided.
+    :param grid: Dictionary of parameter name to the values to try. Will use PARAM_GRIDS for the backend if not
+        provided.
+    :param n_folds: Number of cross-validation folds
+    :param seed: Random seed for reproducible folds and fits
+    :param n_jobs: Number of candidates fit at once, -1 for one per core
+    :param update: Called with progress=<fraction of folds done> after each fold
+    :return: Parameters of the best candidate, and a list describing every trial
+    """
+    backend = backend or config.TRAINER_BACKEND
+    X = np.asarray(train_df[FEATURES].values, dtype=np.float64)
+    y = train_df['left'].values
+    folds = make_folds(y, n_folds, seed)
+
+    trials = [{'params': params, 'fold_scores': [], 'fit_seconds': 0.0, 'status': 'running'}
+              for params in ParameterGrid(grid or PARAM_GRIDS[backend])]
+
+    # keep one pool of workers for the whole search, rather than starting one per fold
+    with Parallel(n_jobs=n_jobs) as parallel:
+        for k, (train_index, test_index) in enumerate(folds):
+            running = [t for t in trials if t['status'] == 'running']
+            results = parallel(delayed(fit_and_score)(backend, t['params'], X, y, train_index, test_index, seed)
+                               for t in running)
+            for trial, (score, seconds) in zip(running, results):
+                trial['fold_scores'].append(round(float(score), 4))
+                trial['fit_seconds'] = round(trial['fit_seconds'] + seconds, 3)
+
+            if 0 < k < len(folds) - 1:
+                _drop_losing(running)
+            if update is not None:
+                update(progress=round(float(k + 1) / len(folds), 2))
+
+    for trial in trials:
+        if trial['status'] == 'running':
+            trial['status'] = 'finished'
+        trial['mean_score'] = round(float(np.mean(trial['fold_scores'])), 4)
+        trial['std_score'] = round(float(np.std(trial['fold_scores'])), 4)
+
+    best = max((t for t in trials if t['status'] == 'finished'), key=lambda t: t['mean_score'])
+    return best['params'], trials
+
+
+def _drop_losing(running):
+    """
+    Mark candidates whose mean score is clearly behind the leader's as dropped.
+    """
+    means = [np.mean(t['fold_scores']) for t in running]
+    leader = running[int(np.argmax(means))]
+    margin = max(DROP_MARGIN, 2 * np.std(leader['fold_scores']) / np.sqrt(len(leader['fold_scores'])))
+    for trial, mean in zip(running, means):
+        if mean < max(means) - margin:
+            trial['status'] = 'dropped after {} folds'.format(len(trial['fold_scores']))
@@ -0,0 +1,178 @@
+"""
+Sweep one or two features of an employee over a grid of values, to see how their churn risk would move if, say, their
+satisfaction or hours changed. The whole grid is built as a single encoded feature matrix, with the employee's own
+values in every column but the swept ones, and scored with one call to predict_proba. A 2-D sweep of a few thousand
+points takes milliseconds, where scoring each variant as its own prediction would take seconds.
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+import inference_client
+import metrics
+from HRmodel import proc_df
+from model_registry import registry
+from schema import DEPARTMENT_OPTIONS, FEATURES, NONNUMERIC_COLUMNS, SALARY_OPTIONS
+
+
+# Lowest and highest values swept for each numeric feature, covering the employees the model was trained on
+SWEEP_RANGES = {
+    'satisfaction_level': (0.0, 1.0),
+    'last_evaluation': (0.0, 1.0),
+    'number_project': (1, 10),
+    'average_montly_hours': (80, 320),
+    'time_spend_company': (1, 12),
+}
+
+INTEGER_FEATURES = ('number_project', 'average_montly_hours', 'time_spend_company')
+
+# Every value of the features that only take a few
+CATEGORY_VALUES = {
+    'Work_accident': [False, True],
+    'promotion_last_5years': [False, True],
+    'department': DEPARTMENT_OPTIONS,
+    'salary': SALARY_OPTIONS,
+}
+
+DEFAULT_STEPS = 25
+MAX_STEPS = 100
+
+
+def sweep_values(feature, steps=DEFAULT_STEPS):
+    """
+    :param feature: Name of a model feature
+    :param steps: Number of values to sweep a numeric feature over. Integer features may get fewer, as values
+        are not repeated.
+    :return: List of values to sweep the feature over
+    """
+    if feature in CATEGORY_VALUES:
+        return list(CATEGORY_VALUES[feature])
+    if feature not in SWEEP_RANGES:
+        raise ValueError("Unknown feature '{}', expected one of {}".format(feature, FEATURES))
+
+    low, high = SWEEP_RANGES[feature]
+    values = np.linspace(low, high, max(2, min(int(steps), MAX_STEPS)))
+    if feature in INTEGER_FEATURES:
+        return np.unique(np.round(values).astype(int)).tolist()
+    return np.round(values, 4).tolist()
+
+
+def build_grid(base_df, features, values):
+    """
+    Build the raw rows of a sweep: the employee repeated once per point of the grid, with the swept features set to
+    that point's values. The first swept feature varies slowest, so the rows reshape into a grid of
+    (len(values[0]), len(values[1])).
+
+    :param base_df: Data frame whose first row holds the employee's model features, with category names
+    :param features: Names of the one or two features to sweep
+    :param values: List of the values to sweep each feature over
+    :return: Data frame of model features, with a row per point of the grid
+    """
+    n_points = int(np.prod([len(v) for v in values]))
+    grid = pd.DataFrame({f: np.repeat(base_df[f].values[:1], n_points) for f in FEATURES}, columns=FEATURES)
+    for feature, column in zip(features, np.meshgrid(*values, indexing='ij')):
+        grid[feature] = column.ravel()
+    return grid
+
+
+def known_values(features, values, d):
+    """
+    :param features: Names of the one or two features to sweep
+    :param values: List of the values to sweep each feature over
+    :param d: Lookup table for label encoding, matching the model
+    :return: The values, leaving out any category the model's encoder wasn't fitted on
+    :raises ValueError: If the model knows none of the categories of a swept feature
+    """
+    kept = []
+    for feature, feature_values in zip(features, values):
+        if feature in NONNUMERIC_COLUMNS:
+            classes = set(d[feature].classes_)
+            feature_values = [v for v in feature_values if v in classes]
+            if not feature_values:
+                raise ValueError("The model wasn't trained on any {} to sweep over".format(feature))
+        kept.append(feature_values)
+    return kept
+
+
+def encode_employee(base_df, d):
+    """
+    :param base_df: Data frame whose first row holds the employee's model features, with category names
+    :param d: Lookup table for label encoding, matching the model
+    :return: 1-D vector of the employee's label encoded features, in model feature order
+    """
+    base, _ = proc_df(base_df[FEATURES].iloc[:1].copy(), d)
+    return np.asarray(base.values[0], dtype=np.float64)
+
+
+def encode_grid(base, features, values, d):
+    """
+    Encode a sweep straight into a feature matrix. The employee is encoded once and tiled, and only the values of
+    the swept features are encoded, rather than every row of the grid.
+
+    :param base: Encoded employee, as from encode_employee
+    :param features: Names of the one or two features to sweep
+    :param values: List of the values to sweep each feature over
+    :param d: Lookup table for label encoding, matching the model
+    :return: 2-D feature matrix in model feature order, with a row per point of the grid, in the order of build_grid
+    """
+    codes = [d[f].transform(v) if f in NONNUMERIC_COLUMNS else np.asarray(v, dtype=np.float64)
+             for f, v in zip(features, values)]
+    X = np.tile(base, (int(np.prod([len(v) for v in values])), 1))
+    for feature, column in zip(features, np.meshgrid(*codes, indexing='ij')):
+        X[:, FEATURES.index(feature)] = column.ravel()
+    return X
+
+
+@metrics.timed('whatif_sweep')
+def sweep(base_df, features, steps=DEFAULT_STEPS):
+    """
+    Score an employee at every point of a grid over one or two of their features.
+
+    :param base_df: Data frame whose first row holds the employee's model features, e.g. as from
+        scoring.lookup_employee or scoring.new_employee_df
+    :param features: Names of the one or two features to sweep
+    :param steps: Number of values to sweep each numeric feature over
+    :return: Dictionary holding the swept features, the values each was swept over, the churn probability at every
+        point (a list for one feature, a list of rows for two), the employee's own churn probability, the model
+        version and the milliseconds taken
+    :raises ValueError: If a feature is unknown or repeated, if there isn't one or two of them, or if the model
+        wasn't trained on the employee's department or salary
+    """
+    start = time.perf_counter()
+    features = list(features)
+    if not 1 <= len(features) <= 2 or len(set(features)) != len(features):
+        raise ValueError("Expected one or two different features to sweep, got {}".format(features))
+    values = [sweep_values(f, steps) for f in features]
+
+    version = None
+    if inference_client.client is not None:
+        try:
+            # the base employee goes first, so one request scores them along with the grid
+            rows = base_df[FEATURES].iloc[:1].values.tolist() + build_grid(base_df, features, values).values.tolist()
+            result = inference_client.client.predict(rows)
+            version, churn = result['version'], np.asarray(result['churn_probability'])
+            base_churn, churn = churn[0], churn[1:]
+        except (OSError, ValueError):
+            # the server can't be reached, or the grid holds a category its model wasn't trained on, so score here,
+            # where the grid can be cut down to the categories the model knows
+            version = None
+
+    if version is None:
+        # the compiled ensemble wins on single employees, but the model's own predict_proba is faster on a grid
+        version, GB, d = registry.get()
+        values = known_values(features, values, d)
+        try:
+            base = encode_employee(base_df, d)
+        except ValueError:
+            raise ValueError("The model wasn't trained on employees with this department or salary")
+        # one call for the whole grid, with the employee themselves as the last row
+        X = pd.DataFrame(np.vstack([encode_grid(base, features, values, d), base]), columns=FEATURES)
+        probas = np.asarray(GB.predict_proba(X), dtype=np.float64)[:, list(GB.classes_).index(1)]
+        base_churn, churn = probas[-1], probas[:-1]
+
+    churn = np.round(churn, 4).reshape([len(v) for v in values])
+    return {'features': features, 'values': values, 'churn_probability': churn.tolist(),
+            'base_churn_probability': round(float(base_churn), 4), 'version': version,
+            'milliseconds': round((time.perf_counter() - start) * 1000, 2)}
@@ -1,4 +1,7 @@
-from index import app
+import config
+from index import create_app
+
+app = create_app(preload=config.PRELOAD)
 
 if __name__ == "__main__":
     app.run()